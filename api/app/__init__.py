@@ -1,5 +1,5 @@
 # Importing models to ensure they are registered for migrations
-from .models import Base, Conversation, Message, Tag, ConversationTag, Character, Persona, Prompt
+from .models import Base, Conversation, Message, MessageTokenCount, Tag, ConversationTag, Character, Persona, Prompt
 
 # Importing the database setup
 from .api import get_db
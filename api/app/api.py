@@ -1,21 +1,55 @@
 import os
 from app.image_utils import get_image_path, save_image, validate_image
-from app.tokens import apply_template_with_context_limit, count_tokens
-from fastapi import Body, APIRouter, HTTPException, Depends, UploadFile, File, Query
+from app.tokens import (
+    CONTEXT_SHIFT_MODE,
+    SHIFT_MODES,
+    apply_template_with_context_limit,
+    content_hash,
+    count_chat_tokens,
+    count_message_tokens,
+    count_messages_cached,
+    count_tokens,
+    describe_template,
+    load_durable_counts,
+    store_durable_counts,
+    tokenizer_registry,
+)
+from app.token_pool import run_tokenization, tokenizer_pool
+from app.generation import GenerationSettings, generate_candidates, get_engine_adapter, sse_event, stream_completion
+from app.backend_router import backend_router
+from app.generation_scheduler import PRIORITIES, GenerationCancelled, generation_scheduler
+from app.pagination import decode_cursor, encode_cursor, estimate_count
+from app.training_export import TRAINING_EXPORT_DIR, TRAINING_MAX_SEQ_LENGTH, load_training_export, training_exports, write_training_shards
+from app.cache import CACHE_TTL, bump_conversation_version, bump_conversation_versions, get_conversation_version, get_conversation_versions, prompt_components_key
+from app.token_index import (
+    ConversationTokenIndex,
+    get_indexed_models,
+    load_token_indexes,
+    save_token_indexes,
+    token_index_key,
+    update_token_index,
+)
+from fastapi import BackgroundTasks, Body, APIRouter, HTTPException, Depends, UploadFile, File, Query
 from typing import Annotated, Optional, List
-from sqlalchemy.orm import Session
+from sqlalchemy import case, delete, exists, func, select, true, tuple_, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, joinedload
 from pydantic import BaseModel
-from app.database import SessionLocal
-from app.models import Character, CharacterTag, Conversation, Message, Persona, Preset, Prompt, Tag, ConversationTag, TagCategory
+from app.database import AsyncSessionLocal, SessionLocal
+from app.models import Character, CharacterTag, Conversation, Message, MessageTokenCount, Persona, Preset, Prompt, Tag, ConversationTag, TagCategory
 from fastapi.responses import StreamingResponse, FileResponse
-from io import StringIO
 import json
 import logging
+import httpx
+import uuid
+import zlib
 from redis import asyncio as aioredis
 
 REDIS_HOST = os.getenv("REDIS_HOSTNAME", "chatterboxredis")
 REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
 REDIS_URL = f"redis://{REDIS_HOST}:{REDIS_PORT}"
+# Messages read per page when loading the tail of a conversation for templating.
+CONTEXT_PAGE_SIZE = int(os.getenv("CONTEXT_PAGE_SIZE", 200))
 
 redis = aioredis.from_url(REDIS_URL, decode_responses=True)
 router = APIRouter()
@@ -48,6 +82,11 @@ class CharacterUpdate(BaseModel):
     system_prompt: Optional[str] = None
     post_history_instructions: Optional[str] = None
 
+class TokenCountRequest(BaseModel):
+    model_identifier: str
+    message_ids: List[int] = []
+    conversation_ids: List[int] = []
+
 class ProposedMessage(BaseModel):
     conversation_id: int
     author: str
@@ -61,9 +100,30 @@ def get_db():
     finally:
         db.close()
 
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+# Everything replace_placeholders reads; async sessions can't lazy-load it later.
+CONVERSATION_RELATIONSHIPS = (
+    joinedload(Conversation.character),
+    joinedload(Conversation.persona),
+    joinedload(Conversation.prompt),
+)
+MESSAGE_CONVERSATION_RELATIONSHIPS = (
+    joinedload(Message.conversation).joinedload(Conversation.character),
+    joinedload(Message.conversation).joinedload(Conversation.persona),
+    joinedload(Message.conversation).joinedload(Conversation.prompt),
+)
+
+async def load_conversation(db: AsyncSession, conversation_id: int) -> Optional[Conversation]:
+    return await db.scalar(select(Conversation).options(*CONVERSATION_RELATIONSHIPS).where(Conversation.id == conversation_id))
+
 def replace_placeholders(content: str, conversation: Conversation):
     if not content:
         return None
+    if "{{" not in content and "\r" not in content:
+        return content
 
     persona = conversation.persona if conversation.persona else None
     character = conversation.character if conversation.character else None
@@ -120,21 +180,309 @@ def parse_example_messages(example_messages_raw: str, conversation) -> list:
             examples.append({"role": "assistant", "content": formatted_message})
     return examples
 
-async def invalidate_caches(message_id=None, conversation_id=None):
-    if message_id:
-        pattern = f"message:{message_id}:*"
-        keys = await redis.keys(pattern)
-        for key in keys:
-            await redis.delete(key)
-        second_pattern = f"prompt:message:{message_id}:*"
-        second_keys = await redis.keys(second_pattern)
-        for key in second_keys:
-            await redis.delete(key)
-    if conversation_id:
-        pattern = f"conversation:{conversation_id}:*"
-        keys = await redis.keys(pattern)
-        for key in keys:
-            await redis.delete(key)
+def render_prompt_components(conversation: Conversation) -> dict:
+    character = conversation.character
+    post_history_instructions = None
+    if character and character.post_history_instructions:
+        post_history_instructions = replace_placeholders(character.post_history_instructions, conversation)
+
+    example_messages = []
+    if character and character.example_messages:
+        example_messages = parse_example_messages(character.example_messages, conversation)
+
+    return {
+        "post_history_instructions": post_history_instructions,
+        "example_messages": example_messages,
+        # Keyed by the author of the latest message.
+        "postfixes": {
+            "user": replace_placeholders('{{char}}: ', conversation),
+            "assistant": replace_placeholders('{{user}}: ', conversation),
+        },
+    }
+
+async def get_prompt_components(conversation: Conversation) -> dict:
+    """
+    The parts of a prompt that only change when the character, persona or prompt is edited,
+    rendered once and kept in Redis. Their token counts are cached by content in tokens.py.
+    """
+    key = prompt_components_key(conversation.character, conversation.persona, conversation.prompt)
+    cached = await redis.get(key)
+    if cached:
+        return json.loads(cached)
+
+    components = render_prompt_components(conversation)
+    await redis.set(key, json.dumps(components), ex=CACHE_TTL)
+    return components
+
+def message_role(author: str) -> str:
+    return "user" if author.lower() == "user" else "assistant" if author.lower() == "assistant" else "system"
+
+def render_message_texts(message: Message, conversation: Conversation) -> tuple:
+    """Returns the chosen and rejected text of a message with placeholders replaced."""
+    if message.variants and message.content_variant_index and 0 <= message.content_variant_index < len(message.variants):
+        content = message.variants[message.content_variant_index]
+    else:
+        content = message.content
+
+    content = replace_placeholders(content, conversation)
+
+    rejected = None
+    if message.rejected or message.rejected_variant_index:
+        if message.variants and message.rejected_variant_index and 0 <= message.rejected_variant_index < len(message.variants):
+            rejected = message.variants[message.rejected_variant_index]
+        else:
+            rejected = message.rejected
+
+        rejected = replace_placeholders(rejected, conversation)
+
+    return content, rejected
+
+async def invalidate_caches(conversation_id: int):
+    # Token counts are keyed by content hash, so only conversation-level entries need to move.
+    await bump_conversation_version(redis, conversation_id)
+
+async def invalidate_linked_conversations(column, value: int, db: AsyncSession):
+    """Invalidates the conversations whose `column` is `value`, whose placeholders render from it."""
+    conversation_ids = (await db.scalars(select(Conversation.id).where(column == value))).all()
+    await bump_conversation_versions(redis, conversation_ids)
+
+def format_message_for_count(message: Message, conversation: Conversation) -> dict:
+    content, _ = render_message_texts(message, conversation)
+    return {"id": message.id, "role": message_role(message.author), "content": content or ""}
+
+def format_message_for_template(msg: Message, conversation: Conversation, invert: str) -> dict:
+    author = msg.author.lower()
+    if (invert == 'invert' and msg.author.lower() == 'user'):
+        author = 'assistant'
+    if (invert == 'invert' and msg.author.lower() == 'assistant'):
+        author = 'user'
+    
+    prepend = ""
+
+    if (msg.author.lower()) == 'user':
+        prepend = "{{user}}: "
+    if (msg.author.lower()) == 'assistant':
+        prepend = "{{char}}: "
+    
+    if msg.variants and 0 <= msg.content_variant_index < len(msg.variants):
+        content = msg.variants[msg.content_variant_index]
+    else:
+        content = msg.content
+
+    return {
+        "id": msg.id,
+        "role": author,
+        "content": replace_placeholders(f"{prepend}{content}", conversation)
+    }
+
+async def load_context_messages(
+    conversation: Conversation,
+    model_identifier: str,
+    invert: str,
+    max_context: int,
+    db: AsyncSession,
+    before_order: Optional[int] = None,
+) -> tuple:
+    """
+    Loads the messages a prompt can use: the conversation's first message (the system
+    message) plus, reading newest-first in pages, only as much recent history as it
+    takes to fill max_context. Returns the messages in order, how many older messages
+    were never loaded, and the author of the latest message.
+    """
+    conditions = [Message.conversation_id == conversation.id]
+    if before_order is not None:
+        conditions.append(Message.order < before_order)
+
+    first_message = await db.scalar(select(Message).where(*conditions).order_by(Message.order).limit(1))
+    if not first_message:
+        return [], 0, None
+
+    history_conditions = [*conditions, Message.order > first_message.order]
+    pages = []
+    loaded_tokens = 0
+    oldest_order = None
+    last_author = first_message.author.lower()
+
+    # Keyset pagination on order; stop once the loaded tail alone fills the context.
+    while loaded_tokens < max_context:
+        page_query = select(Message).where(*history_conditions)
+        if oldest_order is not None:
+            page_query = page_query.where(Message.order < oldest_order)
+        page = (await db.scalars(page_query.order_by(Message.order.desc()).limit(CONTEXT_PAGE_SIZE))).all()
+        if not page:
+            break
+
+        formatted = [format_message_for_template(msg, conversation, invert) for msg in reversed(page)]
+        loaded_tokens += sum(await count_formatted_messages(formatted, model_identifier, db))
+        if not pages:
+            last_author = page[0].author.lower()
+        pages.insert(0, formatted)
+        oldest_order = page[-1].order
+
+        if len(page) < CONTEXT_PAGE_SIZE:
+            break
+
+    older_message_count = 0
+    if loaded_tokens >= max_context and oldest_order is not None:
+        older_message_count = await db.scalar(
+            select(func.count(Message.id)).where(*history_conditions, Message.order < oldest_order)
+        )
+
+    chat_messages = [format_message_for_template(first_message, conversation, invert)]
+    for formatted in pages:
+        chat_messages.extend(formatted)
+
+    return chat_messages, older_message_count, last_author
+
+async def count_formatted_messages(formatted_messages: list, model_identifier: str, db: AsyncSession) -> list:
+    """Per-message token counts, with empty messages counted as zero without tokenizing."""
+    counts = [0] * len(formatted_messages)
+    non_empty = [index for index, message in enumerate(formatted_messages) if message["content"]]
+    non_empty_counts = await count_messages_cached(
+        [formatted_messages[index] for index in non_empty],
+        model_identifier,
+        redis,
+        db
+    )
+
+    for index, count in zip(non_empty, non_empty_counts):
+        counts[index] = count
+
+    return counts
+
+async def build_token_indexes(versions: dict, model_identifier: str, db: AsyncSession) -> dict:
+    """Builds token indexes for several conversations with one message query and one tokenizer batch."""
+    conversation_ids = list(versions.keys())
+    conversations = {
+        conversation.id: conversation
+        for conversation in await db.scalars(
+            select(Conversation)
+              .options(*CONVERSATION_RELATIONSHIPS)
+              .where(Conversation.id.in_(conversation_ids))
+        )
+    }
+    messages = (await db.scalars(
+        select(Message)
+          .where(Message.conversation_id.in_(conversation_ids))
+          .order_by(Message.conversation_id, Message.order)
+    )).all()
+
+    formatted_by_conversation = {conversation_id: [] for conversation_id in conversation_ids}
+    for msg in messages:
+        formatted_by_conversation[msg.conversation_id].append(
+            format_message_for_count(msg, conversations[msg.conversation_id])
+        )
+
+    all_formatted = [message for conversation_id in conversation_ids for message in formatted_by_conversation[conversation_id]]
+    all_counts = iter(await count_formatted_messages(all_formatted, model_identifier, db))
+    counts_by_conversation = {
+        conversation_id: [next(all_counts) for _ in formatted_by_conversation[conversation_id]]
+        for conversation_id in conversation_ids
+    }
+
+    # Calibrate against templating each whole conversation once, so totals match count_tokens.
+    whole_conversations = {
+        conversation_id: [
+            {"role": message["role"], "content": message["content"]}
+            for message in formatted_by_conversation[conversation_id]
+            if message["content"]
+        ]
+        for conversation_id in conversation_ids
+    }
+    to_calibrate = [conversation_id for conversation_id in conversation_ids if whole_conversations[conversation_id]]
+    whole_counts = {}
+    if to_calibrate:
+        whole_counts = dict(zip(
+            to_calibrate,
+            await run_tokenization(count_chat_tokens, [whole_conversations[conversation_id] for conversation_id in to_calibrate], model_identifier)
+        ))
+
+    indexes = {
+        conversation_id: ConversationTokenIndex(
+            [message["id"] for message in formatted_by_conversation[conversation_id]],
+            counts_by_conversation[conversation_id],
+            whole_counts[conversation_id] - sum(counts_by_conversation[conversation_id]) if conversation_id in whole_counts else 0
+        )
+        for conversation_id in conversation_ids
+    }
+    await save_token_indexes(redis, versions, model_identifier, indexes)
+    return indexes
+
+async def get_token_indexes(conversation_ids: list, model_identifier: str, db: AsyncSession) -> dict:
+    versions = await get_conversation_versions(redis, conversation_ids)
+    indexes = await load_token_indexes(redis, versions, model_identifier)
+
+    # Rebuild if a concurrent write left an index out of step with the table.
+    message_counts = dict((await db.execute(
+        select(Message.conversation_id, func.count(Message.id))
+          .where(Message.conversation_id.in_(conversation_ids))
+          .group_by(Message.conversation_id)
+    )).all())
+    stale = {
+        conversation_id: versions[conversation_id]
+        for conversation_id, index in indexes.items()
+        if index is None or len(index) != message_counts.get(conversation_id, 0)
+    }
+    if stale:
+        indexes.update(await build_token_indexes(stale, model_identifier, db))
+
+    return indexes
+
+async def get_token_index(conversation_id: int, model_identifier: str, db: AsyncSession) -> ConversationTokenIndex:
+    return (await get_token_indexes([conversation_id], model_identifier, db))[conversation_id]
+
+async def get_message_token_counts(messages: list, model_identifier: str, db: AsyncSession) -> dict:
+    """
+    Chosen and rejected token counts for several messages, looked up and tokenized together.
+    The messages need their conversation loaded with MESSAGE_CONVERSATION_RELATIONSHIPS.
+    """
+    formatted_messages = []
+    texts_by_message = {}
+    for message in messages:
+        content, rejected = render_message_texts(message, message.conversation)
+        texts_by_message[message.id] = (content, rejected)
+        for text in (content, rejected):
+            if text:
+                formatted_messages.append({"id": message.id, "role": message_role(message.author), "content": text})
+
+    counts = await count_messages_cached(formatted_messages, model_identifier, redis, db)
+    counts_by_text = {
+        (message["id"], message["content"]): count
+        for message, count in zip(formatted_messages, counts)
+    }
+
+    return {
+        message_id: {
+            "token_count": counts_by_text.get((message_id, content), 0),
+            "rejected_token_count": counts_by_text.get((message_id, rejected), 0),
+        }
+        for message_id, (content, rejected) in texts_by_message.items()
+    }
+
+async def update_token_indexes(conversation: Conversation, db: AsyncSession, message: Message = None, removed_message_id: int = None):
+    """Applies an added, edited or deleted message to every token index of the conversation."""
+    version = await get_conversation_version(redis, conversation.id)
+
+    for model_identifier in await get_indexed_models(redis, conversation.id, version):
+        try:
+            if removed_message_id is not None:
+                def change(index: ConversationTokenIndex):
+                    if removed_message_id in index.message_ids:
+                        index.remove(removed_message_id)
+            else:
+                [count] = await count_formatted_messages([format_message_for_count(message, conversation)], model_identifier, db)
+
+                def change(index: ConversationTokenIndex):
+                    if message.id in index.message_ids:
+                        index.set_count(message.id, count)
+                    else:
+                        index.append(message.id, count)
+
+            await update_token_index(redis, conversation.id, version, model_identifier, change)
+        except Exception:
+            # Never fail the write over a token index; drop it so the next read rebuilds it.
+            logging.exception(f"Updating token index for conversation {conversation.id} ({model_identifier}) failed")
+            await redis.delete(token_index_key(conversation.id, version, model_identifier))
 
 # Add a conversation
 @router.post("/conversations")
@@ -179,14 +527,14 @@ async def add_message(
     content_variant_index: Annotated[int, Body()] = None,
     rejected_variant_index: Annotated[int, Body()] = None,
     variants: Annotated[List[str], Body()] = None,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
-    conversation = db.query(Conversation).filter_by(id=conversation_id).first()
+    conversation = await load_conversation(db, conversation_id)
     if not conversation:
         raise HTTPException(status_code=404, detail="Conversation not found")
 
-    highest_order = db.query(Message.order).filter_by(conversation_id=conversation_id).order_by(Message.order.desc()).first()
-    order = (highest_order[0] + 1) if highest_order else 1
+    highest_order = await db.scalar(select(func.max(Message.order)).where(Message.conversation_id == conversation_id))
+    order = (highest_order + 1) if highest_order is not None else 1
 
     if author == 'assistant':
         message = Message(
@@ -219,8 +567,7 @@ async def add_message(
         )
 
     db.add(message)
-    db.commit()
-    db.refresh(message)
+    await db.commit()
 
     content = message.content
     rejected = message.rejected
@@ -242,7 +589,7 @@ async def add_message(
           "variants": message.variants
       }
 
-    await invalidate_caches(conversation_id=conversation_id)
+    await update_token_indexes(conversation, db, message=message)
 
     return full_message
 
@@ -322,9 +669,9 @@ async def edit_message(
     content_variant_index: Annotated[int, Body(embed=True)] = None,
     rejected_variant_index: Annotated[int, Body(embed=True)] = None,
     variants: Annotated[List[str], Body(embed=True)] = None,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
 ):
-    message = db.query(Message).filter_by(id=message_id).first()
+    message = await db.scalar(select(Message).options(*MESSAGE_CONVERSATION_RELATIONSHIPS).where(Message.id == message_id))
     if not message:
         raise HTTPException(status_code=404, detail="Message not found")
 
@@ -336,9 +683,10 @@ async def edit_message(
         message.rejected = rejected
         message.rejected_variant_index = rejected_variant_index
 
-    db.commit()
+    await db.execute(delete(MessageTokenCount).where(MessageTokenCount.message_id == message_id).execution_options(synchronize_session=False))
+    await db.commit()
 
-    await invalidate_caches(message_id=message_id, conversation_id=message.conversation_id)
+    await update_token_indexes(message.conversation, db, message=message)
 
     return {"message": "Message updated"}
 
@@ -351,116 +699,226 @@ async def edit_conversation(
     character_id: Annotated[int, Body()] = None, 
     persona_id: Annotated[int, Body()] = None, 
     prompt_id: Annotated[int, Body()] = None,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
-    conversation = db.query(Conversation).filter_by(id=conversation_id).first()
+    conversation = await db.get(Conversation, conversation_id)
     if not conversation:
         raise HTTPException(status_code=404, detail="Conversation not found")
     
     # Changing these will change the placeholders
     if (prompt_id != conversation.prompt_id or persona_id != conversation.persona_id or character_id != conversation.character_id):
-        await invalidate_caches(conversation_id=conversation.id)
+        await invalidate_caches(conversation.id)
 
-        messages = db.query(Message).filter(Message.conversation_id == conversation.id).order_by(Message.order).all()
-        for msg in messages:
-            await invalidate_caches(message_id=msg.id)
+        # Stored counts were for the old placeholders.
+        message_ids = select(Message.id).where(Message.conversation_id == conversation.id)
+        await db.execute(delete(MessageTokenCount).where(MessageTokenCount.message_id.in_(message_ids)).execution_options(synchronize_session=False))
 
     if name:
         conversation.name = name
     if description:
         conversation.description = description
     if character_id:
-        character = db.query(Character).filter_by(id=character_id).first()
-        if not character:
+        if not await db.get(Character, character_id):
             raise HTTPException(status_code=404, detail="Character not found")
         conversation.character_id = character_id
     if persona_id:
-        persona = db.query(Persona).filter_by(id=persona_id).first()
-        if not persona:
+        if not await db.get(Persona, persona_id):
             raise HTTPException(status_code=404, detail="Persona not found")
         conversation.persona_id = persona_id
     if prompt_id:
-        prompt = db.query(Prompt).filter_by(id=prompt_id).first()
-        if not prompt:
+        if not await db.get(Prompt, prompt_id):
             raise HTTPException(status_code=404, detail="Prompt not found")
         conversation.prompt_id = prompt_id
 
-    db.commit()
+    await db.commit()
     
     return {"message": "Conversation updated"}
 
+CONVERSATION_SORT_COLUMNS = {
+    "id": (Conversation.id,),
+    "updated_at": (Conversation.updated_at, Conversation.id),
+}
+MAX_CONVERSATION_PAGE_SIZE = int(os.getenv("MAX_CONVERSATION_PAGE_SIZE", 200))
+
+def conversation_summary(conversation: Conversation) -> dict:
+    return {column.key: getattr(conversation, column.key) for column in Conversation.__table__.columns}
+
 @router.get("/conversations")
 async def get_conversations(
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     tags: Optional[List[str]] = Query(default=None),  # List of tags to filter by
     character_ids: Optional[List[int]] = Query(default=None),  # List of character IDs
     persona_ids: Optional[List[int]] = Query(default=None),   # List of persona IDs
     prompt_ids: Optional[List[int]] = Query(default=None),    # List of prompt IDs
+    limit: Optional[int] = Query(default=None, ge=1, le=MAX_CONVERSATION_PAGE_SIZE),
+    cursor: Optional[str] = Query(default=None),
+    sort: str = Query(default="id"),
+    include_total: bool = Query(default=False),
 ):
-    query = db.query(Conversation)
+    """
+    Newest first by `sort` ("id" or "updated_at"). Without `limit` every match is returned
+    as a list. With it, one page comes back as {"conversations", "next_cursor",
+    "total_estimate"}; pass next_cursor as `cursor` to get the page after it.
+    """
+    if sort not in CONVERSATION_SORT_COLUMNS:
+        raise HTTPException(status_code=400, detail=f"Unknown sort: {sort}")
+    sort_columns = CONVERSATION_SORT_COLUMNS[sort]
+
+    filters = []
 
     # Filter by tags
     if tags:
-        query = (
-            query.join(ConversationTag)
-                 .join(Tag)
-                 .filter(Tag.name.in_(tags))
-                 .distinct()
+        filters.append(
+            exists().where(ConversationTag.conversation_id == Conversation.id, ConversationTag.tag_name.in_(tags))
         )
 
     # Filter by characters (OR search)
     if character_ids:
-        query = query.filter(Conversation.character_id.in_(character_ids))
+        filters.append(Conversation.character_id.in_(character_ids))
 
     # Filter by personas (OR search)
     if persona_ids:
-        query = query.filter(Conversation.persona_id.in_(persona_ids))
+        filters.append(Conversation.persona_id.in_(persona_ids))
 
     # Filter by prompts (OR search)
     if prompt_ids:
-        query = query.filter(Conversation.prompt_id.in_(prompt_ids))
+        filters.append(Conversation.prompt_id.in_(prompt_ids))
 
-    query = query.order_by(Conversation.id.desc())
+    query = select(Conversation).where(*filters).order_by(*(column.desc() for column in sort_columns))
 
-    conversations = query.all()
-    return conversations
+    if limit is None:
+        return [conversation_summary(conversation) for conversation in await db.scalars(query)]
+
+    if cursor:
+        query = query.where(tuple_(*sort_columns) < tuple_(*decode_cursor(cursor, sort, sort_columns)))
 
+    # One extra row tells us whether there's another page.
+    conversations = (await db.scalars(query.limit(limit + 1))).all()
+    next_cursor = None
+    if len(conversations) > limit:
+        conversations = conversations[:limit]
+        next_cursor = encode_cursor(sort, [getattr(conversations[-1], column.key) for column in sort_columns])
+
+    total_estimate = None
+    if include_total:
+        total_estimate = await estimate_count(db, select(Conversation.id).where(*filters))
+
+    return {
+        "conversations": [conversation_summary(conversation) for conversation in conversations],
+        "next_cursor": next_cursor,
+        "total_estimate": total_estimate,
+    }
+
+
+MAX_MESSAGE_PAGE_SIZE = int(os.getenv("MAX_MESSAGE_PAGE_SIZE", 500))
+
+def chosen_variant(variant_index, fallback):
+    """The variant a message has selected, or `fallback` when it hasn't, picked in SQL so the array isn't loaded."""
+    return case(
+        (variant_index > 0, func.coalesce(Message.variants[variant_index + 1], fallback)),
+        else_=fallback
+    )
+
+def message_window_query(conversation_id: int, include_variants: bool):
+    columns = [
+        Message.id,
+        Message.author,
+        Message.order,
+        chosen_variant(Message.content_variant_index, Message.content).label("content"),
+        chosen_variant(Message.rejected_variant_index, Message.rejected).label("rejected"),
+        Message.content_variant_index,
+        Message.rejected_variant_index,
+        func.coalesce(func.cardinality(Message.variants), 0).label("variant_count"),
+    ]
+    if include_variants:
+        columns.append(Message.variants)
+    return select(*columns).where(Message.conversation_id == conversation_id)
+
+def window_message(row, conversation: Conversation) -> dict:
+    message = dict(row._mapping)
+    message["full_content"] = replace_placeholders(row.content, conversation)
+    message["full_rejected"] = replace_placeholders(row.rejected, conversation)
+    return message
 
 # Get a list of messages for a conversation
 @router.get("/conversations/{conversation_id}/messages")
-def get_messages(conversation_id: int, db: Session = Depends(get_db)):
-    conversation = db.query(Conversation).filter_by(id=conversation_id).first()
-    messages = db.query(Message).filter_by(conversation_id=conversation_id).order_by(Message.order).all()
-
-    full_messages = []
+async def get_messages(
+    conversation_id: int,
+    limit: Optional[int] = Query(default=None, ge=1, le=MAX_MESSAGE_PAGE_SIZE),
+    before: Optional[int] = Query(default=None),
+    after: Optional[int] = Query(default=None),
+    around: Optional[int] = Query(default=None),
+    include_variants: bool = Query(default=False),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    Messages in order. Without `limit` the whole conversation is returned as a list. With
+    it, a window of up to `limit` messages comes back as {"messages", "has_before",
+    "has_after"}: the latest ones, or those just before or after a message order, or
+    centered on one with `around`. Variant arrays are left out unless `include_variants`
+    is set; `variant_count` is always there.
+    """
+    anchors = [anchor for anchor in (before, after, around) if anchor is not None]
+    if len(anchors) > 1:
+        raise HTTPException(status_code=400, detail="Use only one of before, after and around.")
+    if anchors and limit is None:
+        raise HTTPException(status_code=400, detail="A limit is required with before, after or around.")
+
+    conversation = await load_conversation(db, conversation_id)
+    if not conversation:
+        raise HTTPException(status_code=404, detail="Conversation not found")
 
-    for message in messages:
-        if message.content_variant_index and message.variants and 0 <= message.content_variant_index < len(message.variants):
-            content = message.variants[message.content_variant_index]
-        else:
-            content = message.content
-        
-        if message.rejected_variant_index and message.variants and 0 <= message.rejected_variant_index < len(message.variants):
-            rejected = message.variants[message.rejected_variant_index]
-        else:
-            rejected = message.rejected
+    query = message_window_query(conversation_id, include_variants)
+
+    if limit is None:
+        rows = (await db.execute(query.order_by(Message.order))).all()
+        return [window_message(row, conversation) for row in rows]
+
+    async def any_message(condition) -> bool:
+        return await db.scalar(select(exists().where(Message.conversation_id == conversation_id, condition)))
+
+    async def nearest(condition, count: int, descending: bool) -> tuple:
+        """Up to `count` matching messages closest to the anchor, in order, and whether more lie past them."""
+        if count == 0:
+            return [], await any_message(condition)
+        rows = (await db.execute(
+            query.where(condition).order_by(Message.order.desc() if descending else Message.order).limit(count + 1)
+        )).all()
+        page = rows[:count]
+        return (page[::-1] if descending else page), len(rows) > count
+
+    if after is not None:
+        rows, has_after = await nearest(Message.order > after, limit, descending=False)
+        has_before = await any_message(Message.order <= after)
+    elif around is not None:
+        # The anchor and the messages before it get the larger half of the window.
+        older_rows, has_before = await nearest(Message.order <= around, limit - limit // 2, descending=True)
+        newer_rows, has_after = await nearest(Message.order > around, limit // 2, descending=False)
+        rows = older_rows + newer_rows
+    elif before is not None:
+        rows, has_before = await nearest(Message.order < before, limit, descending=True)
+        has_after = await any_message(Message.order >= before)
+    else:
+        rows, has_before = await nearest(true(), limit, descending=True)
+        has_after = False
 
-        full_message = {
-            "id": message.id,
-            "author": message.author,
-            "order": message.order,
-            "content": content,
-            "rejected": rejected,
-            "variants": message.variants,
-            "content_variant_index": message.content_variant_index,
-            "rejected_variant_index": message.rejected_variant_index,
-            "full_content": replace_placeholders(content, conversation),
-            "full_rejected": replace_placeholders(rejected, conversation)
-        }
+    return {
+        "messages": [window_message(row, conversation) for row in rows],
+        "has_before": has_before,
+        "has_after": has_after,
+    }
 
-        full_messages.append(full_message)
+@router.get("/messages/{message_id}/variants")
+async def get_message_variants(message_id: int, db: AsyncSession = Depends(get_async_db)):
+    message = await db.get(Message, message_id)
+    if not message:
+        raise HTTPException(status_code=404, detail="Message not found")
 
-    return full_messages
+    return {
+        "variants": message.variants or [],
+        "content_variant_index": message.content_variant_index,
+        "rejected_variant_index": message.rejected_variant_index,
+    }
 
 @router.get("/conversations/{conversation_id}/with_chat_template")
 async def get_conversation_with_chat_template(
@@ -472,59 +930,40 @@ async def get_conversation_with_chat_template(
     authors_note: Optional[str] = Query(None),
     authors_note_loc: Optional[int] = Query(None),
     message_id: Optional[int] = Query(None),
-    db: Session = Depends(get_db)
+    shift_mode: str = Query(CONTEXT_SHIFT_MODE),
+    include_token_ids: bool = Query(False),
+    db: AsyncSession = Depends(get_async_db)
 ):
-    conversation = db.query(Conversation).filter_by(id=conversation_id).first()
+    # The generation routes come through here too, before anything reaches a backend.
+    if shift_mode not in SHIFT_MODES:
+        raise HTTPException(status_code=400, detail=f"Unknown shift_mode: {shift_mode}")
+
+    conversation = await load_conversation(db, conversation_id)
     if not conversation:
         raise HTTPException(status_code=404, detail="Conversation not found.")
     
-    messages = db.query(Message).filter_by(conversation_id=conversation_id).order_by(Message.order).all()
+    before_order = None
+    if message_id:
+        before_order = await db.scalar(
+            select(Message.order).where(Message.id == message_id, Message.conversation_id == conversation_id)
+        )
 
-    chat_messages = []
-    for msg in messages:
-        if message_id and message_id == msg.id:
-            break
-            
-        author = msg.author.lower()
-        if (invert == 'invert' and msg.author.lower() == 'user'):
-            author = 'assistant'
-        if (invert == 'invert' and msg.author.lower() == 'assistant'):
-            author = 'user'
-        
-        prepend = ""
+    chat_messages, older_message_count, last_author = await load_context_messages(
+        conversation, model_identifier, invert, max_context, db, before_order
+    )
+    if not chat_messages:
+        raise HTTPException(status_code=400, detail="Conversation has no messages to template.")
 
-        if (msg.author.lower()) == 'user':
-            prepend = "{{user}}: "
-        if (msg.author.lower()) == 'assistant':
-            prepend = "{{char}}: "
-        
-        if msg.variants and 0 <= msg.content_variant_index < len(msg.variants):
-            content = msg.variants[msg.content_variant_index]
-        else:
-            content = msg.content
+    components = await get_prompt_components(conversation)
 
-        chat_messages.append({
-            "id": msg.id,
-            "role": author,
-            "content": replace_placeholders(f"{prepend}{content}", conversation)
-        })
-        last_author = msg.author.lower()
-    
-    if conversation and conversation.character and conversation.character.post_history_instructions:
+    if components["post_history_instructions"]:
         chat_messages.append({
             "role": "user",
-            "content": replace_placeholders(conversation.character.post_history_instructions, conversation)
+            "content": components["post_history_instructions"]
         })
 
-    postfix = ""
-    if (last_author == 'user'):
-        postfix = replace_placeholders('{{char}}: ', conversation)
-    if (last_author == 'assistant'):
-        postfix = replace_placeholders('{{user}}: ', conversation)
-    
-    example_messages = []
-    if conversation and conversation.character and conversation.character.example_messages:
-        example_messages = parse_example_messages(conversation.character.example_messages, conversation)
+    postfix = components["postfixes"].get(last_author, "")
+    example_messages = components["example_messages"]
     
     try:
         return await apply_template_with_context_limit(
@@ -537,10 +976,243 @@ async def get_conversation_with_chat_template(
             example_messages,
             replace_placeholders(authors_note, conversation),
             authors_note_loc,
+            db,
+            conversation_id,
+            shift_mode,
+            older_message_count,
+            include_token_ids,
         )
+    except HTTPException:
+        # Already says what went wrong, e.g. a 429 from a full tokenizer queue.
+        raise
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Error loading tokenizer: {str(e)}")
 
+class GenerateRequest(BaseModel):
+    preset_id: int
+    invert: str = "no"
+    authors_note: Optional[str] = None
+    authors_note_loc: Optional[int] = None
+    message_id: Optional[int] = None
+    shift_mode: str = CONTEXT_SHIFT_MODE
+    priority: str = "interactive"
+    # Lets the client cancel the generation later; one is made up when it isn't given.
+    request_id: Optional[str] = None
+
+def generation_request_id(priority: str, request_id: Optional[str]) -> str:
+    if priority not in PRIORITIES:
+        raise HTTPException(status_code=400, detail=f"Unknown priority: {priority}")
+    return request_id or str(uuid.uuid4())
+
+@router.post("/conversations/{conversation_id}/generate")
+async def generate(conversation_id: int, request: GenerateRequest, db: AsyncSession = Depends(get_async_db)):
+    request_id = generation_request_id(request.priority, request.request_id)
+
+    preset = await db.get(Preset, request.preset_id)
+    if not preset:
+        raise HTTPException(status_code=404, detail="Preset not found.")
+    settings = GenerationSettings.from_preset(preset)
+
+    conversation = await load_conversation(db, conversation_id)
+    if not conversation:
+        raise HTTPException(status_code=404, detail="Conversation not found.")
+
+    adapter = get_engine_adapter(settings.engine)
+    context = await get_conversation_with_chat_template(
+        conversation_id,
+        preset.model_name,
+        request.invert,
+        settings.max_context,
+        settings.samplers.get("max_tokens", 512),
+        request.authors_note,
+        request.authors_note_loc,
+        request.message_id,
+        request.shift_mode,
+        adapter.accepts_token_ids,
+        db,
+    )
+
+    eos_tokens = [context["eos_token"]]
+    if conversation.character:
+        eos_tokens.append(f"\n{conversation.character.name}:")
+    if conversation.persona:
+        eos_tokens.append(f"\n{conversation.persona.name}:")
+
+    async def events():
+        text = ""
+        finish_reason = None
+        try:
+            async for delta, reason in stream_completion(
+                settings,
+                context["history"],
+                eos_tokens,
+                context["prompt_token_ids"],
+                request.priority,
+                request_id,
+                f"conversation:{conversation_id}",
+            ):
+                text += delta
+                finish_reason = reason or finish_reason
+                if delta:
+                    yield sse_event({"text": delta})
+        except GenerationCancelled:
+            yield sse_event({"text": text}, "cancelled")
+            return
+        except HTTPException as e:
+            yield sse_event({"message": e.detail}, "error")
+            return
+        except httpx.HTTPError as e:
+            yield sse_event({"message": f"Error contacting LLM server: {str(e)}"}, "error")
+            return
+
+        yield sse_event({"text": text, "finish_reason": finish_reason}, "done")
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "X-Generation-Id": request_id},
+    )
+
+# Upper bound on variants generated by one batch request.
+MAX_BATCH_VARIANTS = int(os.getenv("MAX_BATCH_VARIANTS", 8))
+
+class GenerateVariantsRequest(BaseModel):
+    preset_id: int
+    n: int = 4
+    authors_note: Optional[str] = None
+    authors_note_loc: Optional[int] = None
+    shift_mode: str = CONTEXT_SHIFT_MODE
+    priority: str = "batch"
+    request_id: Optional[str] = None
+
+async def seed_message_variants(message: Message, db: AsyncSession):
+    """Starts a variant list from content/rejected the same way the message editor does."""
+    if message.variants is not None:
+        return
+
+    variants = []
+    if message.content:
+        variants.append(message.content)
+        message.content_variant_index = len(variants) - 1
+    if message.rejected:
+        variants.append(message.rejected)
+        message.rejected_variant_index = len(variants) - 1
+
+    message.variants = variants
+    await db.commit()
+
+async def append_message_variant(message_id: int, text: str) -> int:
+    """Appends one variant in a single UPDATE so concurrent candidates can't overwrite each other."""
+    async with AsyncSessionLocal() as db:
+        length = await db.scalar(
+            update(Message)
+            .where(Message.id == message_id)
+            .values(variants=func.array_append(Message.variants, text))
+            .returning(func.cardinality(Message.variants))
+        )
+        await db.commit()
+        return length - 1
+
+# Generate several candidate regenerations of a message and add them to its variants
+@router.post("/messages/{message_id}/generate_variants")
+async def generate_variants(message_id: int, request: GenerateVariantsRequest, db: AsyncSession = Depends(get_async_db)):
+    request_id = generation_request_id(request.priority, request.request_id)
+    if not 1 <= request.n <= MAX_BATCH_VARIANTS:
+        raise HTTPException(status_code=400, detail=f"n must be between 1 and {MAX_BATCH_VARIANTS}.")
+
+    preset = await db.get(Preset, request.preset_id)
+    if not preset:
+        raise HTTPException(status_code=404, detail="Preset not found.")
+    settings = GenerationSettings.from_preset(preset)
+
+    message = await db.scalar(select(Message).options(*MESSAGE_CONVERSATION_RELATIONSHIPS).where(Message.id == message_id))
+    if not message:
+        raise HTTPException(status_code=404, detail="Message not found")
+    conversation = message.conversation
+
+    adapter = get_engine_adapter(settings.engine)
+    context = await get_conversation_with_chat_template(
+        conversation.id,
+        preset.model_name,
+        "no" if message.author == "assistant" else "invert",
+        settings.max_context,
+        settings.samplers.get("max_tokens", 512),
+        request.authors_note,
+        request.authors_note_loc,
+        message.id,
+        request.shift_mode,
+        adapter.accepts_token_ids,
+        db,
+    )
+
+    eos_tokens = [context["eos_token"]]
+    if conversation.character:
+        eos_tokens.append(f"\n{conversation.character.name}:")
+    if conversation.persona:
+        eos_tokens.append(f"\n{conversation.persona.name}:")
+
+    affinity_key = f"conversation:{conversation.id}"
+
+    # The chosen content is unchanged, so token counts and indexes stay valid.
+    await seed_message_variants(message, db)
+
+    async def events():
+        saved = []
+        try:
+            async for candidate in generate_candidates(
+                settings,
+                context["history"],
+                eos_tokens,
+                request.n,
+                context["prompt_token_ids"],
+                request.priority,
+                request_id,
+                affinity_key,
+            ):
+                if candidate["error"]:
+                    yield sse_event({"index": candidate["index"], "message": candidate["error"]}, "error")
+                    continue
+
+                # Same rule as the browser: only completions that stopped cleanly are kept.
+                variant_index = None
+                if candidate["finish_reason"] == "stop" and candidate["text"].strip():
+                    variant_index = await append_message_variant(message_id, candidate["text"])
+                    saved.append(variant_index)
+
+                yield sse_event({**candidate, "variant_index": variant_index}, "variant")
+        except GenerationCancelled:
+            yield sse_event({"variant_indexes": saved}, "cancelled")
+            return
+        except HTTPException as e:
+            yield sse_event({"message": e.detail}, "error")
+        except httpx.HTTPError as e:
+            yield sse_event({"message": f"Error contacting LLM server: {str(e)}"}, "error")
+
+        yield sse_event({"variant_indexes": saved}, "done")
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "X-Generation-Id": request_id},
+    )
+
+# Cancel a queued or running generation
+@router.delete("/generations/{request_id}")
+def cancel_generation(request_id: str):
+    if not generation_scheduler.cancel(request_id):
+        raise HTTPException(status_code=404, detail="Generation not found")
+    return {"message": "Generation cancelled"}
+
+# Per-backend generation queue statistics
+@router.get("/generations/stats")
+def get_generation_stats():
+    return generation_scheduler.stats()
+
+# Per-instance routing, latency and prompt cache statistics
+@router.get("/generations/backends")
+def get_generation_backend_stats():
+    return backend_router.stats()
+
 @router.get("/conversations/{conversation_id}/tags")
 def get_tags(conversation_id: int, db: Session = Depends(get_db)):
     tags = db.query(ConversationTag).filter_by(conversation_id=conversation_id).all()
@@ -571,102 +1243,123 @@ def get_message_count(conversation_id: int, db: Session = Depends(get_db)):
 
 # Token count for a conversation
 @router.get("/conversations/{conversation_id}/token_count")
-async def get_token_count(conversation_id: int, model_identifier: str, db: Session = Depends(get_db)):
-    cache_key = f"conversation:{conversation_id}:{model_identifier}"
-    cached_value = await redis.get(cache_key)
-    if cached_value:
-        return {"token_count": int(cached_value)}
-
-    messages = db.query(Message).filter_by(conversation_id=conversation_id).order_by(Message.order).all()
-    if not messages:
-        await redis.set(cache_key, 0, ex=3600)
-        return {"token_count": 0}
-    
-    conversation = db.query(Conversation).filter_by(id=conversation_id).first()
-
-    formatted_messages = []
-
-    for msg in messages:
-        if msg.variants and msg.content_variant_index and 0 <= msg.content_variant_index < len(msg.variants):
-            content = msg.variants[msg.content_variant_index]
-        else:
-            content = msg.content
-        
-        content = replace_placeholders(content, conversation)
-
-        if not content:
-            continue
-        
-        formatted_messages.append({
-            "role": "user" if msg.author.lower() == "user" else "assistant" if msg.author.lower() == "assistant" else "system",
-            "content": content,
-        })
-
-    token_count = count_tokens(formatted_messages, model_identifier)
-    await redis.set(cache_key, token_count, ex=3600)
-    return {"token_count": token_count}
+async def get_token_count(conversation_id: int, model_identifier: str, db: AsyncSession = Depends(get_async_db)):
+    index = await get_token_index(conversation_id, model_identifier, db)
+    return {"token_count": index.total}
 
 # Token count for a single message
 @router.get("/messages/{message_id}/token_count")
-async def get_message_token_count(message_id: int, model_identifier: str, db: Session = Depends(get_db)):
-    cache_key = f"message:{message_id}:{model_identifier}"
-    cached_value = await redis.get(cache_key)
-    if cached_value:
-        return json.loads(cached_value)
-
-    message = db.query(Message).filter_by(id=message_id).first()
+async def get_message_token_count(message_id: int, model_identifier: str, db: AsyncSession = Depends(get_async_db)):
+    message = await db.scalar(select(Message).options(*MESSAGE_CONVERSATION_RELATIONSHIPS).where(Message.id == message_id))
     if not message:
         raise HTTPException(status_code=404, detail="Message not found")
     
-    conversation = db.query(Conversation).filter_by(id=message.conversation_id).first()
+    return (await get_message_token_counts([message], model_identifier, db))[message.id]
 
-    if message.variants and message.content_variant_index and 0 <= message.content_variant_index < len(message.variants):
-        content = message.variants[message.content_variant_index]
-    else:
-        content = message.content
-    
-    content = replace_placeholders(content, conversation)
+def backfill_message_token_counts(model_identifier: str, batch_size: int = 500):
+    """Stores token counts for every message that has none for this model yet."""
+    db = SessionLocal()
+    try:
+        last_id = 0
+        while True:
+            messages = (
+                db.query(Message)
+                  .options(*MESSAGE_CONVERSATION_RELATIONSHIPS)
+                  .filter(Message.id > last_id)
+                  .order_by(Message.id)
+                  .limit(batch_size)
+                  .all()
+            )
+            if not messages:
+                break
+            last_id = messages[-1].id
+
+            formatted_messages = []
+            for message in messages:
+                for text in render_message_texts(message, message.conversation):
+                    if text:
+                        formatted_messages.append({"id": message.id, "role": message_role(message.author), "content": text})
+
+            hashes = [content_hash([message]) for message in formatted_messages]
+            existing = load_durable_counts(db, formatted_messages, hashes, model_identifier)
+            missing = [
+                index for index, message in enumerate(formatted_messages)
+                if (message["id"], hashes[index]) not in existing
+            ]
+            if not missing:
+                continue
+
+            counts = count_message_tokens([formatted_messages[index] for index in missing], model_identifier)
+            store_durable_counts(db, [
+                {
+                    "message_id": formatted_messages[index]["id"],
+                    "model_identifier": model_identifier,
+                    "content_hash": hashes[index],
+                    "token_count": count,
+                }
+                for index, count in zip(missing, counts)
+            ])
+    except Exception:
+        logging.exception(f"Token count backfill for {model_identifier} failed")
+    finally:
+        db.close()
 
-    if not content:
-        token_count = 0
-    else:
-        formatted_message = [
-            {
-                "role": "user" if message.author.lower() == "user" else "assistant" if message.author.lower() == "assistant" else "system",
-                "content": content,
+# Token counts for many messages and conversations in one request
+@router.post("/token_counts")
+async def get_token_counts(token_count_request: TokenCountRequest, db: AsyncSession = Depends(get_async_db)):
+    model_identifier = token_count_request.model_identifier
+
+    message_counts = {}
+    if token_count_request.message_ids:
+        messages = (await db.scalars(
+            select(Message)
+              .options(*MESSAGE_CONVERSATION_RELATIONSHIPS)
+              .where(Message.id.in_(token_count_request.message_ids))
+        )).all()
+        message_counts = await get_message_token_counts(messages, model_identifier, db)
+
+    conversation_counts = {}
+    if token_count_request.conversation_ids:
+        conversation_ids = (await db.scalars(
+            select(Conversation.id).where(Conversation.id.in_(token_count_request.conversation_ids))
+        )).all()
+        if conversation_ids:
+            indexes = await get_token_indexes(conversation_ids, model_identifier, db)
+            conversation_counts = {
+                conversation_id: {"token_count": index.total}
+                for conversation_id, index in indexes.items()
             }
-        ]
 
-        token_count = count_tokens(formatted_message, model_identifier, False)
+    return {"messages": message_counts, "conversations": conversation_counts}
 
-    rejected_count = 0
-    if message.rejected or message.rejected_variant_index:
-        if message.variants and message.rejected_variant_index and 0 <= message.rejected_variant_index < len(message.variants):
-            rejected = message.variants[message.rejected_variant_index]
-        else:
-            rejected = message.rejected
+# Fill message_token_count for every message in the background
+@router.post("/token_counts/backfill")
+def start_token_count_backfill(model_identifier: str, background_tasks: BackgroundTasks):
+    background_tasks.add_task(backfill_message_token_counts, model_identifier)
+    return {"message": "Token count backfill started"}
 
-        rejected = replace_placeholders(rejected, conversation)
+# Tokenizer cache statistics
+@router.get("/tokenizers/stats")
+def get_tokenizer_stats():
+    return tokenizer_registry.stats()
 
-        formatted_rejected = [
-            {
-                "role": "user" if message.author.lower() == "user" else "assistant" if message.author.lower() == "assistant" else "system",
-                "content": rejected,
-            }
-        ]
-        rejected_count = count_tokens(formatted_rejected, model_identifier, False)
+# Chat template capabilities probed for a model's tokenizer
+@router.get("/tokenizers/profile")
+async def get_tokenizer_profile(model_identifier: str):
+    return await run_tokenization(describe_template, model_identifier)
 
-    result = {"token_count": token_count, "rejected_token_count": rejected_count}
-    await redis.set(cache_key, json.dumps(result), ex=3600)
-    return result
+# Tokenizer worker pool queue statistics
+@router.get("/tokenizers/queue")
+def get_tokenizer_queue_stats():
+    return tokenizer_pool.stats()
 
 @router.post("/proposed_messages/token_count")
 async def count_proposed_message_tokens(
     proposed_message: ProposedMessage, 
     model_identifier: str,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
-    conversation = db.query(Conversation).filter_by(id=proposed_message.conversation_id).first()
+    conversation = await load_conversation(db, proposed_message.conversation_id)
 
     # Handle a weird case when it sends empty content.
     # @TODO: Find out why.
@@ -682,7 +1375,7 @@ async def count_proposed_message_tokens(
         }
     ]
 
-    token_count = count_tokens(formatted_message, model_identifier, False)
+    token_count = await run_tokenization(count_tokens, formatted_message, model_identifier, False)
     rejected_count = 0
 
     if proposed_message.rejected:
@@ -695,21 +1388,22 @@ async def count_proposed_message_tokens(
             }
         ]
 
-        rejected_count = count_tokens(formatted_rejected, model_identifier, False)
+        rejected_count = await run_tokenization(count_tokens, formatted_rejected, model_identifier, False)
 
     return {"token_count": token_count, "rejected_token_count": rejected_count}
 
 # Delete a message
 @router.delete("/messages/{message_id}")
-async def delete_message(message_id: int, db: Session = Depends(get_db)):
-    message = db.query(Message).filter_by(id=message_id).first()
+async def delete_message(message_id: int, db: AsyncSession = Depends(get_async_db)):
+    message = await db.scalar(select(Message).options(*MESSAGE_CONVERSATION_RELATIONSHIPS).where(Message.id == message_id))
     if not message:
         raise HTTPException(status_code=404, detail="Message not found")
 
-    db.delete(message)
-    db.commit()
+    conversation = message.conversation
+    await db.delete(message)
+    await db.commit()
 
-    await invalidate_caches(message_id=message_id, conversation_id=message.conversation_id)
+    await update_token_indexes(conversation, db, removed_message_id=message_id)
 
     return {"message": "Message deleted"}
 
@@ -821,8 +1515,8 @@ def get_character(character_id: int, db: Session = Depends(get_db)):
 
 # Edit a character
 @router.put("/characters/{character_id}", response_model=dict)
-def update_character(character_id: int, character_update: CharacterUpdate, db: Session = Depends(get_db)):
-    character = db.query(Character).filter(Character.id == character_id).first()
+async def update_character(character_id: int, character_update: CharacterUpdate, db: AsyncSession = Depends(get_async_db)):
+    character = await db.get(Character, character_id)
 
     if not character:
         raise HTTPException(status_code=404, detail="Character not found")
@@ -831,8 +1525,8 @@ def update_character(character_id: int, character_update: CharacterUpdate, db: S
     for field, value in character_update.dict(exclude_unset=True).items():
         setattr(character, field, value)
 
-    db.commit()
-    db.refresh(character)
+    await db.commit()
+    await invalidate_linked_conversations(Conversation.character_id, character.id, db)
     return {"message": "Character updated successfully", "id": character.id}
 
 # Add a persona
@@ -867,22 +1561,24 @@ def get_persona(persona_id: int, db: Session = Depends(get_db)):
 
 # Edit a persona
 @router.put("/personas/{persona_id}")
-def edit_persona(
+async def edit_persona(
     persona_id: int,
     name: Annotated[str, Body()], 
     content: Annotated[str, Body()],
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
-    persona = db.query(Persona).filter_by(id=persona_id).first()
+    persona = await db.get(Persona, persona_id)
+    if not persona:
+        raise HTTPException(status_code=404, detail="Persona not found")
 
     if name:
         persona.name = name
     if content:
         persona.content = content
 
-    db.add(persona)
-    db.commit()
-    db.refresh(persona)
+    await db.commit()
+    await db.refresh(persona)
+    await invalidate_linked_conversations(Conversation.persona_id, persona.id, db)
     return persona
 
 # Add a prompt
@@ -917,79 +1613,280 @@ def get_prompt(prompt_id: int, db: Session = Depends(get_db)):
 
 # Edit a prompt
 @router.put("/prompts/{prompt_id}")
-def edit_prompt(
+async def edit_prompt(
     prompt_id: int,
     name: Annotated[str, Body()], 
     content: Annotated[str, Body()],
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
-    prompt = db.query(Prompt).filter_by(id=prompt_id).first()
+    prompt = await db.get(Prompt, prompt_id)
+    if not prompt:
+        raise HTTPException(status_code=404, detail="Prompt not found")
 
     if name:
         prompt.name = name
     if content:
         prompt.content = content
 
-    db.add(prompt)
-    db.commit()
-    db.refresh(prompt)
+    await db.commit()
+    await db.refresh(prompt)
+    await invalidate_linked_conversations(Conversation.prompt_id, prompt.id, db)
     return prompt
 
-@router.post("/conversations_jsonl", response_class=StreamingResponse)
-async def get_conversations_jsonl(request: dict = Body(...), db: Session = Depends(get_db)):
-    buffer = StringIO()
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", 100))
+
+async def export_conversation_batches(conversation_ids: Optional[list], include_variants: bool = False):
+    """
+    Yields lists of (conversation, tag names, messages) in conversation id order, for every
+    conversation when `conversation_ids` is None. Conversations come off a server-side
+    cursor EXPORT_BATCH_SIZE at a time and each batch's tags and messages take one query
+    apiece, so memory stays flat however much is exported. Messages are rows of their text
+    columns, plus variants with `include_variants`. The session is its own because the
+    response is streamed after the request's session has closed.
+    """
+    message_columns = [
+        Message.conversation_id,
+        Message.id,
+        Message.author,
+        Message.content,
+        Message.rejected,
+        Message.content_variant_index,
+        Message.rejected_variant_index,
+    ]
+    if include_variants:
+        message_columns.append(Message.variants)
+
+    async with AsyncSessionLocal() as db:
+        query = select(Conversation).options(*CONVERSATION_RELATIONSHIPS).order_by(Conversation.id)
+        if conversation_ids is not None:
+            query = query.where(Conversation.id.in_(conversation_ids))
+
+        result = await db.stream_scalars(query.execution_options(yield_per=EXPORT_BATCH_SIZE))
+        async for conversations in result.partitions():
+            ids = [conversation.id for conversation in conversations]
+
+            tag_names = {conversation_id: [] for conversation_id in ids}
+            for conversation_id, tag_name in await db.execute(
+                select(ConversationTag.conversation_id, ConversationTag.tag_name).where(ConversationTag.conversation_id.in_(ids))
+            ):
+                tag_names[conversation_id].append(tag_name)
+
+            messages = {conversation_id: [] for conversation_id in ids}
+            for message in await db.execute(
+                select(*message_columns)
+                  .where(Message.conversation_id.in_(ids))
+                  .order_by(Message.conversation_id, Message.order)
+            ):
+                messages[message.conversation_id].append(message)
+
+            yield [(conversation, tag_names[conversation.id], messages[conversation.id]) for conversation in conversations]
+
+def sharegpt_record(conversation: Conversation, tag_names: list, messages: list) -> dict:
+    return {
+        "id": conversation.id,
+        "name": conversation.name,
+        "tags": tag_names,
+        "length": len(messages),
+        "conversation": [
+            {"from": message.author, "value": replace_placeholders(message.content, conversation)}
+            for message in messages
+        ]
+    }
+
+def preference_records(conversation: Conversation, tag_names: list, messages: list, implicit_prompt: bool = False):
+    """
+    Yields a prompt/chosen/rejected pair, as encoded JSON, for each alternative of each
+    assistant message: its explicit rejected text and every other variant. The prompt is
+    the conversation before the message in chat format. With `implicit_prompt` (ORPO) the
+    chosen and rejected sides are whole conversations ending in each reply instead, as
+    preference trainers take either.
+
+    Each message is rendered and JSON-encoded once into a running list that the prefix is
+    joined from, only for messages that have pairs and once for all of them, so the work
+    grows with the size of the output rather than with re-rendering the history for every
+    pair or with the conversation's length squared.
+    """
+    encoded_messages = []
+    for message in messages:
+        role = message_role(message.author)
+        chosen, rejected = render_message_texts(message, conversation)
+        if not chosen:
+            continue
+        encoded_chosen = json.dumps({"role": role, "content": chosen})
+
+        if role == "assistant":
+            alternatives = [rejected] + [replace_placeholders(variant, conversation) for variant in message.variants or []]
+            # Without a variant index the chosen text can still sit in the variants.
+            alternatives = list(dict.fromkeys(alternative for alternative in alternatives if alternative and alternative != chosen))
+            prefix = ", ".join(encoded_messages) if alternatives else ""
+            for alternative in alternatives:
+                encoded_rejected = json.dumps({"role": role, "content": alternative})
+                ids = f'"conversation_id": {conversation.id}, "message_id": {message.id}'
+                if implicit_prompt:
+                    separator = ", " if prefix else ""
+                    yield f'{{"chosen": [{prefix}{separator}{encoded_chosen}], "rejected": [{prefix}{separator}{encoded_rejected}], {ids}}}'
+                else:
+                    yield f'{{"prompt": [{prefix}], "chosen": [{encoded_chosen}], "rejected": [{encoded_rejected}], {ids}}}'
+
+        encoded_messages.append(encoded_chosen)
+
+EXPORT_FORMATS = {
+    "sharegpt": lambda *entry: [sharegpt_record(*entry)],
+    "dpo": preference_records,
+    "orpo": lambda *entry: preference_records(*entry, implicit_prompt=True),
+}
+
+async def jsonl_chunks(batches, to_records, compress: bool = False):
+    """
+    Encodes the records `to_records(conversation, tag_names, messages)` returns for each
+    exported conversation as JSONL, gzipped as one stream when `compress` is set. Records
+    may come already encoded as strings.
+    """
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS) if compress else None
+
+    async for batch in batches:
+        chunk = "".join(
+            (record if isinstance(record, str) else json.dumps(record)) + "\n"
+            for entry in batch
+            for record in to_records(*entry)
+        ).encode("utf-8")
+        if compressor:
+            chunk = compressor.compress(chunk)
+        if chunk:
+            yield chunk
+
+    if compressor:
+        yield compressor.flush()
+
+def export_response(chunks, filename: str, compress: bool) -> StreamingResponse:
+    if compress:
+        filename += ".gz"
+    return StreamingResponse(
+        chunks,
+        media_type="application/gzip" if compress else "application/jsonlines",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
 
-    conversation_ids = request.get("conversation_ids", [])
-    conversations = db.query(Conversation).filter(Conversation.id.in_(conversation_ids)).all()
+async def export_conversation_ids(request: dict, db: AsyncSession) -> Optional[list]:
+    """The conversations an export request asks for, or None for all of them. 404s if there are none."""
+    conversation_ids = None if request.get("all") else request.get("conversation_ids", [])
 
-    if not conversations:
+    query = select(Conversation.id).limit(1)
+    if conversation_ids is not None:
+        query = query.where(Conversation.id.in_(conversation_ids))
+    if await db.scalar(query) is None:
         raise HTTPException(status_code=404, detail="No conversations found")
 
-    for conversation in conversations:
-        tags = db.query(Tag).join(ConversationTag).filter(ConversationTag.conversation_id == conversation.id).all()
-        tag_names = [tag.name for tag in tags]
-        messages = db.query(Message).filter(Message.conversation_id == conversation.id).order_by(Message.order).all()
-
-        conversation_data = {
-            "id": conversation.id,
-            "name": conversation.name,
-            "tags": tag_names,
-            "length": len(messages),
-            "conversation": []
-        }
+    return conversation_ids
 
-        for message in messages:
-            content = replace_placeholders(message.content, conversation)
+@router.post("/conversations_jsonl", response_class=StreamingResponse)
+async def get_conversations_jsonl(request: dict = Body(...), db: AsyncSession = Depends(get_async_db)):
+    """
+    Streams JSONL for `conversation_ids`, or every conversation when `all` is set.
+    `format` is "sharegpt" (the default, one line per conversation) or "dpo"/"orpo" for
+    preference pairs. `gzip` compresses the download.
+    """
+    export_format = request.get("format", "sharegpt")
+    if export_format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unknown export format: {export_format}")
+
+    conversation_ids = await export_conversation_ids(request, db)
+    compress = bool(request.get("gzip"))
+    batches = export_conversation_batches(conversation_ids, include_variants=export_format != "sharegpt")
+
+    return export_response(
+        jsonl_chunks(batches, EXPORT_FORMATS[export_format], compress),
+        "conversations.jsonl" if export_format == "sharegpt" else f"{export_format}.jsonl",
+        compress
+    )
+
+class TrainingExportRequest(BaseModel):
+    model_identifier: str
+    conversation_ids: Optional[List[int]] = None
+    all: bool = False
+    max_seq_length: int = 4096
+    packing: bool = True
+
+def training_chat(conversation: Conversation, messages: list) -> list:
+    chat = []
+    for message in messages:
+        content, _ = render_message_texts(message, conversation)
+        if content:
+            chat.append({"role": message_role(message.author), "content": content})
+    return chat
+
+async def training_chat_batches(conversation_ids: Optional[list]):
+    async for batch in export_conversation_batches(conversation_ids, include_variants=True):
+        entries = []
+        for conversation, tag_names, messages in batch:
+            chat = training_chat(conversation, messages)
+            if chat:
+                metadata = {
+                    "conversation_id": conversation.id,
+                    "name": conversation.name,
+                    "tags": tag_names,
+                    "character": conversation.character.name if conversation.character else None,
+                }
+                entries.append((metadata, chat))
+        yield entries
+
+async def run_training_export(export_id: str, conversation_ids: Optional[list], request: TrainingExportRequest):
+    try:
+        manifest = await write_training_shards(
+            training_chat_batches(conversation_ids),
+            request.model_identifier,
+            os.path.join(TRAINING_EXPORT_DIR, export_id),
+            request.max_seq_length,
+            request.packing
+        )
+        training_exports[export_id] = {"status": "done", "manifest": manifest}
+    except Exception as e:
+        logging.exception(f"Training export {export_id} failed")
+        training_exports[export_id] = {"status": "failed", "error": str(e)}
+
+# Tokenize conversations into memory-mappable training shards in the background
+@router.post("/training_exports")
+async def start_training_export(
+    request: TrainingExportRequest,
+    background_tasks: BackgroundTasks,
+    db: AsyncSession = Depends(get_async_db)
+):
+    if not 1 <= request.max_seq_length <= TRAINING_MAX_SEQ_LENGTH:
+        raise HTTPException(status_code=400, detail=f"max_seq_length must be between 1 and {TRAINING_MAX_SEQ_LENGTH}.")
 
-            conversation_data["conversation"].append({
-                "from": message.author,
-                "value": content
-            })
+    conversation_ids = await export_conversation_ids({"all": request.all, "conversation_ids": request.conversation_ids or []}, db)
 
-        buffer.write(json.dumps(conversation_data) + "\n")
+    export_id = uuid.uuid4().hex
+    training_exports[export_id] = {"status": "running"}
+    background_tasks.add_task(run_training_export, export_id, conversation_ids, request)
 
-    buffer.seek(0)
+    return {"export_id": export_id, "directory": os.path.join(TRAINING_EXPORT_DIR, export_id)}
 
-    return StreamingResponse(buffer, media_type="application/jsonlines")
+@router.get("/training_exports/{export_id}")
+def get_training_export(export_id: str):
+    export = load_training_export(export_id) if export_id.isalnum() else None
+    if export is None:
+        raise HTTPException(status_code=404, detail="Training export not found")
+    return export
 
 # POST /characters/{character_id}/image
 @router.post("/characters/{character_id}/image")
-async def upload_character_image(character_id: int, image: UploadFile = File(...), db: Session = Depends(get_db)):
+async def upload_character_image(character_id: int, image: UploadFile = File(...), db: AsyncSession = Depends(get_async_db)):
     validate_image(image)
     filename = save_image(image)
 
-    character = db.query(Character).filter(Character.id == character_id).first()
+    character = await db.get(Character, character_id)
     if not character:
         raise HTTPException(status_code=404, detail="Character not found")
 
     character.image = filename
-    db.commit()
+    await db.commit()
     return character
 
 # GET /characters/{character_id}/image
 @router.get("/characters/{character_id}/image")
-async def get_character_image(character_id: int, db: Session = Depends(get_db)):
-    character = db.query(Character).filter(Character.id == character_id).first()
+async def get_character_image(character_id: int, db: AsyncSession = Depends(get_async_db)):
+    character = await db.get(Character, character_id)
     if not character or not character.image:
         raise HTTPException(status_code=404, detail="Image not found for the character")
 
@@ -998,23 +1895,23 @@ async def get_character_image(character_id: int, db: Session = Depends(get_db)):
 
 # POST /personas/{persona_id}/image
 @router.post("/personas/{persona_id}/image")
-async def upload_persona_image(persona_id: int, image: UploadFile = File(...), db: Session = Depends(get_db)):
+async def upload_persona_image(persona_id: int, image: UploadFile = File(...), db: AsyncSession = Depends(get_async_db)):
     validate_image(image)
     filename = save_image(image)
 
-    persona = db.query(Persona).filter(Persona.id == persona_id).first()
+    persona = await db.get(Persona, persona_id)
     if not persona:
         raise HTTPException(status_code=404, detail="Persona not found")
 
     persona.image = filename
-    db.commit()
+    await db.commit()
     return persona
 
 
 # GET /personas/{persona_id}/image
 @router.get("/personas/{persona_id}/image")
-async def get_persona_image(persona_id: int, db: Session = Depends(get_db)):
-    persona = db.query(Persona).filter(Persona.id == persona_id).first()
+async def get_persona_image(persona_id: int, db: AsyncSession = Depends(get_async_db)):
+    persona = await db.get(Persona, persona_id)
     if not persona or not persona.image:
         raise HTTPException(status_code=404, detail="Image not found for the persona")
 
@@ -1070,18 +1967,18 @@ def delete_prompt(prompt_id: int, db: Session = Depends(get_db)):
 
 # Delete a conversation
 @router.delete("/conversations/{conversation_id}")
-async def delete_conversation(conversation_id: int, db: Session = Depends(get_db)):
-    conversation = db.query(Conversation).filter(Conversation.id == conversation_id).first()
+async def delete_conversation(conversation_id: int, db: AsyncSession = Depends(get_async_db)):
+    conversation = await db.get(Conversation, conversation_id)
     if not conversation:
         raise HTTPException(status_code=404, detail="Conversation not found")
 
-    db.query(Message).filter(Message.conversation_id == conversation_id).delete()
-    db.query(ConversationTag).filter(ConversationTag.conversation_id == conversation_id).delete()
+    await db.execute(delete(Message).where(Message.conversation_id == conversation_id))
+    await db.execute(delete(ConversationTag).where(ConversationTag.conversation_id == conversation_id))
 
-    db.delete(conversation)
-    db.commit()
+    await db.delete(conversation)
+    await db.commit()
 
-    await invalidate_caches(conversation_id=conversation_id)
+    await invalidate_caches(conversation_id)
 
     return {"message": "Conversation and its related data deleted successfully"}
 
@@ -1096,6 +1993,7 @@ def create_preset(
     max_context: Annotated[int, Body()],
     engine: Annotated[str, Body()],
     api_key: Annotated[str, Body()],
+    backend_urls: Annotated[List[str], Body()] = None,
     db: Session = Depends(get_db),
 ):
     if not name or not samplers or not sampler_order or not model_name or not llm_url or not max_context or not engine:
@@ -1110,6 +2008,7 @@ def create_preset(
         sampler_order=sampler_order,
         model_name=model_name,
         llm_url=llm_url,
+        backend_urls=backend_urls or None,
         max_context=max_context,
         engine=engine,
     )
@@ -1135,6 +2034,8 @@ def update_preset(
     max_context: Annotated[int, Body()],
     engine: Annotated[str, Body()],
     api_key: Annotated[str, Body()] = None,
+    # Left as is when not sent, which is how the preset form saves; [] clears the pool.
+    backend_urls: Annotated[Optional[List[str]], Body()] = None,
     db: Session = Depends(get_db),
 ):
     preset = db.query(Preset).filter(Preset.id == preset_id).first()
@@ -1148,6 +2049,8 @@ def update_preset(
     preset.sampler_order = sampler_order
     preset.model_name = model_name
     preset.llm_url = llm_url
+    if backend_urls is not None:
+        preset.backend_urls = backend_urls or None
     preset.max_context = max_context
     preset.engine = engine
     
@@ -1183,6 +2086,7 @@ def list_presets(db: Session = Depends(get_db)):
             "sampler_order": preset.sampler_order,
             "model_name": preset.model_name,
             "llm_url": preset.llm_url,
+            "backend_urls": preset.backend_urls or [],
             "max_context": preset.max_context,
             "engine": preset.engine,
             "api_key": preset.api_key,
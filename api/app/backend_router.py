@@ -0,0 +1,135 @@
+import hashlib
+import os
+import time
+from collections import OrderedDict
+from typing import Optional
+
+# Seconds a backend that failed to answer is skipped before it's tried again.
+BACKEND_RETRY_SECONDS = float(os.getenv("BACKEND_RETRY_SECONDS", 30))
+# Queued requests on a conversation's backend before it moves to a less busy one.
+BACKEND_SPILL_QUEUE = int(os.getenv("BACKEND_SPILL_QUEUE", 2))
+# Conversations whose current backend is remembered.
+BACKEND_AFFINITY_SIZE = int(os.getenv("BACKEND_AFFINITY_SIZE", 10000))
+# Weight of the newest sample in the moving average latencies.
+LATENCY_SMOOTHING = 0.2
+
+class BackendStats:
+    def __init__(self):
+        self.requests = 0
+        self.failures = 0
+        self.affinity_hits = 0
+        self.spills = 0
+        self.down_until = 0.0
+        self.first_token_latency = None
+        self.total_latency = None
+        self.prompt_tokens = 0
+        self.cached_prompt_tokens = 0
+
+    def as_dict(self, now: float) -> dict:
+        return {
+            "healthy": self.down_until <= now,
+            "requests": self.requests,
+            "failures": self.failures,
+            "affinity_hits": self.affinity_hits,
+            "spills": self.spills,
+            "first_token_latency": self.first_token_latency,
+            "total_latency": self.total_latency,
+            "prompt_tokens": self.prompt_tokens,
+            "cached_prompt_tokens": self.cached_prompt_tokens,
+            "prompt_cache_hit_rate": (self.cached_prompt_tokens / self.prompt_tokens) if self.prompt_tokens else None,
+        }
+
+def smooth(average: Optional[float], sample: float) -> float:
+    if average is None:
+        return sample
+    return average + LATENCY_SMOOTHING * (sample - average)
+
+def rendezvous_order(urls: list, key: str) -> list:
+    """Highest-random-weight order: stable per key, and adding or removing a URL only moves the keys it owned."""
+    def weight(url: str) -> bytes:
+        return hashlib.sha256(f"{url}|{key}".encode("utf-8")).digest()
+
+    return sorted(urls, key=weight, reverse=True)
+
+class BackendRouter:
+    """
+    Picks which of a preset's backends serves a request.
+
+    Requests with the same affinity key (a conversation) keep going to the backend that
+    served it last, so its prompt prefix is still in that instance's KV cache. A key seen
+    for the first time gets its backend by rendezvous hashing. The request moves on when
+    its backend is down or has BACKEND_SPILL_QUEUE requests waiting while another is less
+    busy, and then stays where it landed.
+    """
+
+    def __init__(self, affinity_size: int = BACKEND_AFFINITY_SIZE):
+        self.affinity_size = affinity_size
+        self._affinity = OrderedDict()
+        self._backends = {}
+
+    def backend(self, url: str) -> BackendStats:
+        if url not in self._backends:
+            self._backends[url] = BackendStats()
+        return self._backends[url]
+
+    def route(self, urls: list, affinity_key: Optional[str], load: dict) -> list:
+        """
+        Returns `urls` in the order they should be tried. `load` maps a URL to how many
+        requests are waiting for it.
+        """
+        urls = list(dict.fromkeys(url.rstrip("/") for url in urls))
+        if len(urls) == 1:
+            return urls
+
+        now = time.time()
+        order = rendezvous_order(urls, affinity_key or str(now))
+        previous = self._affinity.get(affinity_key) if affinity_key else None
+        if previous in urls:
+            order.remove(previous)
+            order.insert(0, previous)
+
+        # Backends that are down go last, but stay in the list in case every one of them is.
+        order.sort(key=lambda url: self.backend(url).down_until > now)
+
+        preferred = order[0]
+        least_busy = min(order, key=lambda url: (self.backend(url).down_until > now, load.get(url, 0)))
+        if load.get(preferred, 0) >= BACKEND_SPILL_QUEUE and load.get(least_busy, 0) < load[preferred]:
+            order.remove(least_busy)
+            order.insert(0, least_busy)
+            self.backend(preferred).spills += 1
+
+        return order
+
+    def record_success(self, url: str, affinity_key: Optional[str], first_token_latency: Optional[float], total_latency: float, prompt_cache: Optional[tuple]):
+        stats = self.backend(url)
+        stats.requests += 1
+        stats.down_until = 0.0
+        if first_token_latency is not None:
+            stats.first_token_latency = smooth(stats.first_token_latency, first_token_latency)
+        stats.total_latency = smooth(stats.total_latency, total_latency)
+        if prompt_cache:
+            stats.prompt_tokens += prompt_cache[0]
+            stats.cached_prompt_tokens += prompt_cache[1]
+
+        if affinity_key:
+            if self._affinity.get(affinity_key) == url:
+                stats.affinity_hits += 1
+            self._affinity[affinity_key] = url
+            self._affinity.move_to_end(affinity_key)
+            while len(self._affinity) > self.affinity_size:
+                self._affinity.popitem(last=False)
+
+    def record_failure(self, url: str):
+        stats = self.backend(url)
+        stats.requests += 1
+        stats.failures += 1
+        stats.down_until = time.time() + BACKEND_RETRY_SECONDS
+
+    def stats(self) -> dict:
+        now = time.time()
+        return {
+            "conversations": len(self._affinity),
+            "backends": {url: stats.as_dict(now) for url, stats in self._backends.items()},
+        }
+
+backend_router = BackendRouter()
@@ -0,0 +1,58 @@
+import os
+from typing import Optional
+from redis import asyncio as aioredis
+
+CACHE_TTL = int(os.getenv("CACHE_TTL", 3600))
+
+async def cache_get_many(redis: aioredis.Redis, keys: list) -> list:
+    """Fetches several keys in one MGET round trip. Missing keys come back as None."""
+    if not keys:
+        return []
+
+    return await redis.mget(keys)
+
+async def cache_set_many(redis: aioredis.Redis, values: dict, ex: Optional[int] = CACHE_TTL):
+    """Writes several keys, each with its own TTL, in one pipelined round trip."""
+    if not values:
+        return
+
+    async with redis.pipeline(transaction=False) as pipe:
+        for key, value in values.items():
+            pipe.set(key, value, ex=ex)
+        await pipe.execute()
+
+def conversation_version_key(conversation_id: int) -> str:
+    return f"conversation:{conversation_id}:version"
+
+async def get_conversation_version(redis: aioredis.Redis, conversation_id: int) -> int:
+    version = await redis.get(conversation_version_key(conversation_id))
+    return int(version) if version else 0
+
+async def get_conversation_versions(redis: aioredis.Redis, conversation_ids: list) -> dict:
+    versions = await cache_get_many(redis, [conversation_version_key(conversation_id) for conversation_id in conversation_ids])
+    return {
+        conversation_id: int(version) if version else 0
+        for conversation_id, version in zip(conversation_ids, versions)
+    }
+
+async def bump_conversation_version(redis: aioredis.Redis, conversation_id: int) -> int:
+    """Moves a conversation onto fresh cache keys; entries under the old version just expire."""
+    return await redis.incr(conversation_version_key(conversation_id))
+
+async def bump_conversation_versions(redis: aioredis.Redis, conversation_ids: list):
+    """bump_conversation_version for several conversations in one pipelined round trip."""
+    if not conversation_ids:
+        return
+
+    async with redis.pipeline(transaction=False) as pipe:
+        for conversation_id in conversation_ids:
+            pipe.incr(conversation_version_key(conversation_id))
+        await pipe.execute()
+
+def prompt_components_key(*sources) -> str:
+    """
+    Key for text rendered from a conversation's character, persona and prompt. Each is
+    identified by id and updated_at, so an edit to any of them moves to a new key.
+    """
+    parts = [f"{source.id}@{source.updated_at.timestamp()}" if source is not None else "-" for source in sources]
+    return "prompt_components:" + ":".join(parts)
@@ -0,0 +1,145 @@
+import json
+import threading
+import weakref
+from datetime import datetime
+from functools import lru_cache
+from typing import Optional
+import jinja2
+from jinja2.ext import Extension, loopcontrols
+from jinja2.sandbox import ImmutableSandboxedEnvironment
+
+CHATML_TEMPLATE= """{% for message in messages %}
+        {{'<|im_start|>' + message['role'] + '\n' + message['content']}}
+        {% if (loop.last and add_generation_prompt) or not loop.last %}
+            {{ '<|im_end|>' + '\n'}}
+        {% endif %}
+    {% endfor %}
+    {% if add_generation_prompt and messages[-1]['role'] != 'assistant' %}
+        {{ '<|im_start|>assistant\n' }}
+    {% endif %}"""
+
+class GenerationBlock(Extension):
+    # Templates may wrap assistant turns in {% generation %} for loss masking; render them as-is.
+    tags = {"generation"}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        body = parser.parse_statements(["name:endgeneration"], drop_needle=True)
+        return jinja2.nodes.CallBlock(self.call_method("_render"), [], [], body).set_lineno(lineno)
+
+    def _render(self, caller):
+        return caller()
+
+def raise_exception(message):
+    raise jinja2.exceptions.TemplateError(message)
+
+def tojson(x, ensure_ascii=False, indent=None, separators=None, sort_keys=False):
+    # Same as transformers: Jinja's own tojson escapes HTML characters.
+    return json.dumps(x, ensure_ascii=ensure_ascii, indent=indent, separators=separators, sort_keys=sort_keys)
+
+def strftime_now(format):
+    return datetime.now().strftime(format)
+
+@lru_cache(maxsize=64)
+def compile_chat_template(chat_template: str) -> jinja2.Template:
+    """Compiles a chat template in the same environment transformers uses, once per template."""
+    jinja_env = ImmutableSandboxedEnvironment(trim_blocks=True, lstrip_blocks=True, extensions=[GenerationBlock, loopcontrols])
+    jinja_env.filters["tojson"] = tojson
+    jinja_env.globals["raise_exception"] = raise_exception
+    jinja_env.globals["strftime_now"] = strftime_now
+    return jinja_env.from_string(chat_template)
+
+def resolve_chat_template(chat_template) -> str:
+    if isinstance(chat_template, dict):
+        return chat_template.get("default") or next(iter(chat_template.values()), None) or CHATML_TEMPLATE
+    return chat_template or CHATML_TEMPLATE
+
+def normalize_messages(messages: list) -> list:
+    """
+    Rewrites a chat into the most conservative shape: no system role, strictly alternating
+    roles, and a lone message always from the user. Works on copies of the messages.
+    """
+    new_messages = []
+    for message in messages:
+        msg = dict(message)
+        if msg["role"] == "system":
+            msg["role"] = "user"
+
+        if new_messages and new_messages[-1]["role"] == msg["role"]:
+            new_messages[-1]["content"] += f"\n\n{msg['content']}"
+        else:
+            new_messages.append(msg)
+
+    if len(new_messages) == 1:
+        new_messages[0]["role"] = "user"
+
+    return new_messages
+
+class TemplateProfile:
+    """
+    What a tokenizer's chat template accepts, probed once per tokenizer so callers can
+    normalize messages up front instead of rendering, failing and retrying.
+    """
+
+    def __init__(self, chat_template, special_tokens: dict):
+        self.has_template = bool(chat_template)
+        self.template = compile_chat_template(resolve_chat_template(chat_template))
+        self.template_kwargs = dict(special_tokens)
+
+        self.supports_system = self._accepts([{"role": "system", "content": "a"}, {"role": "user", "content": "b"}])
+        self.strict_alternation = not self._accepts([{"role": "user", "content": "a"}, {"role": "user", "content": "b"}])
+        self.requires_user_first = not self._accepts([{"role": "assistant", "content": "a"}])
+
+        bos_token = self.template_kwargs.get("bos_token")
+        rendered = self._try_render([{"role": "user", "content": "a"}])
+        self.adds_bos = bool(bos_token and rendered and rendered.startswith(bos_token))
+
+    def render(self, messages: list, add_generation_prompt: bool = False) -> str:
+        return self.template.render(
+            messages=messages,
+            tools=None,
+            documents=None,
+            add_generation_prompt=add_generation_prompt,
+            **self.template_kwargs
+        )
+
+    def _try_render(self, messages: list) -> Optional[str]:
+        try:
+            return self.render(messages)
+        except Exception:
+            return None
+
+    def _accepts(self, messages: list) -> bool:
+        return self._try_render(messages) is not None
+
+    def needs_normalization(self, messages: list) -> bool:
+        roles = [message["role"] for message in messages]
+
+        if not self.supports_system and "system" in roles:
+            return True
+        if self.strict_alternation and any(a == b for a, b in zip(roles, roles[1:])):
+            return True
+        if self.requires_user_first and len(roles) == 1 and roles[0] != "user":
+            return True
+
+        return False
+
+    def as_dict(self) -> dict:
+        return {
+            "has_template": self.has_template,
+            "supports_system": self.supports_system,
+            "strict_alternation": self.strict_alternation,
+            "requires_user_first": self.requires_user_first,
+            "adds_bos": self.adds_bos,
+        }
+
+_profiles = weakref.WeakKeyDictionary()
+_profiles_lock = threading.Lock()
+
+def get_template_profile(tokenizer) -> TemplateProfile:
+    with _profiles_lock:
+        profile = _profiles.get(tokenizer)
+        if profile is None:
+            profile = TemplateProfile(tokenizer.chat_template, tokenizer.special_tokens_map)
+            _profiles[tokenizer] = profile
+        return profile
@@ -0,0 +1,374 @@
+import asyncio
+import json
+import os
+import time
+from typing import AsyncIterator, Callable, Optional
+import httpx
+from fastapi import HTTPException
+from app.backend_router import backend_router
+from app.generation_scheduler import GenerationCancelled, generation_scheduler
+
+GENERATION_TIMEOUT = float(os.getenv("GENERATION_TIMEOUT", 300))
+GENERATION_MAX_CONNECTIONS = int(os.getenv("GENERATION_MAX_CONNECTIONS", 32))
+
+_http_client: Optional[httpx.AsyncClient] = None
+
+def get_http_client() -> httpx.AsyncClient:
+    """One keep-alive connection pool shared by every generation request."""
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(GENERATION_TIMEOUT, connect=10.0),
+            limits=httpx.Limits(max_connections=GENERATION_MAX_CONNECTIONS, max_keepalive_connections=GENERATION_MAX_CONNECTIONS),
+        )
+    return _http_client
+
+def set_http_client(client: Optional[httpx.AsyncClient]):
+    global _http_client
+    _http_client = client
+
+async def close_http_client():
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+class GenerationSettings:
+    """
+    The parts of a Preset a generation needs, copied out of the ORM object because the
+    response keeps streaming after the request's database session has closed.
+    """
+
+    def __init__(
+        self,
+        engine: str,
+        llm_url: str,
+        api_key: Optional[str],
+        max_context: int,
+        samplers: dict,
+        sampler_order: list,
+        backend_urls: Optional[list] = None,
+    ):
+        self.engine = engine
+        self.llm_url = llm_url
+        # llm_url first, then any extra instances serving the same model.
+        self.backend_urls = list(dict.fromkeys(url.rstrip("/") for url in [llm_url, *(backend_urls or [])]))
+        self.api_key = api_key
+        self.max_context = max_context
+        self.samplers = dict(samplers or {})
+        self.sampler_order = list(sampler_order or [])
+
+    @classmethod
+    def from_preset(cls, preset) -> "GenerationSettings":
+        return cls(
+            preset.engine,
+            preset.llm_url,
+            preset.api_key,
+            preset.max_context,
+            preset.samplers,
+            preset.sampler_order,
+            preset.backend_urls,
+        )
+
+class BackendUnavailable(HTTPException):
+    """The backend answered with a server error, so another instance may still serve the request."""
+
+class EngineAdapter:
+    """
+    How one inference server takes a streamed completion request and what its SSE events
+    look like. Mirrors the browser workers in frontend/workers.
+    """
+
+    path = "/v1/completions"
+    accepts_token_ids = False
+    # Whether one request can ask for several completions with `n`.
+    supports_n = False
+
+    def headers(self, preset) -> dict:
+        return {"Content-Type": "application/json"}
+
+    async def payload(self, client: httpx.AsyncClient, preset, llm_url: str, prompt, eos_tokens: list, n: int = 1) -> dict:
+        samplers = preset.samplers
+        payload = {
+            "prompt": prompt,
+            "temperature": samplers.get("temperature"),
+            "min_p": samplers.get("min_p"),
+            "top_p": samplers.get("top_p"),
+            "top_k": samplers.get("top_k"),
+            "xtc_probability": samplers.get("xtc_probability"),
+            "xtc_threshold": samplers.get("xtc_threshold"),
+            "max_tokens": samplers.get("max_tokens"),
+            "max_context_length": preset.max_context,
+            "repetition_penalty": samplers.get("repetition_penalty"),
+            "repetition_penalty_range": samplers.get("repetition_penalty_range"),
+            "stop": eos_tokens,
+            "sampler_order": preset.sampler_order,
+            "skip_special_tokens": True,
+            "ignore_eos": False,
+            "typical": samplers.get("typical_p"),
+            "tfs": samplers.get("tfs"),
+            "sampler_seed": -1,
+            "stream": True,
+        }
+        if n > 1:
+            payload["n"] = n
+        return payload
+
+    def parse_event(self, data: str) -> Optional[list]:
+        """Returns (choice index, text, finish_reason) for each choice in one SSE data payload, or None to stop."""
+        if data == "[DONE]":
+            return None
+        return [
+            (choice.get("index", 0), choice.get("text") or "", choice.get("finish_reason"))
+            for choice in json.loads(data)["choices"]
+        ]
+
+    def prompt_cache(self, data: str) -> Optional[tuple]:
+        """(prompt tokens, prompt tokens served from the KV cache) if the event reports them."""
+        return None
+
+class KoboldAdapter(EngineAdapter):
+    path = "/api/extra/generate/stream"
+
+    async def payload(self, client, preset, llm_url, prompt, eos_tokens, n=1):
+        samplers = preset.samplers
+        return {
+            "prompt": prompt,
+            "temperature": samplers.get("temperature"),
+            "min_p": samplers.get("min_p"),
+            "top_p": samplers.get("top_p"),
+            "top_k": samplers.get("top_k"),
+            "xtc_probability": samplers.get("xtc_probability"),
+            "xtc_threshold": samplers.get("xtc_threshold"),
+            "max_length": samplers.get("max_tokens"),
+            "max_context_length": preset.max_context,
+            "rep_pen": samplers.get("repetition_penalty"),
+            "rep_pen_range": samplers.get("repetition_penalty_range"),
+            "stopping_strings": eos_tokens,
+            "sampler_order": preset.sampler_order,
+            "skip_special_tokens": True,
+            "ignore_eos": False,
+            "typical": samplers.get("typical_p"),
+            "tfs": samplers.get("tfs"),
+            "sampler_seed": -1,
+            "stream": True,
+        }
+
+    def parse_event(self, data):
+        parsed = json.loads(data)
+        return [(0, parsed.get("token") or "", parsed.get("finish_reason"))]
+
+class LlamaCppAdapter(EngineAdapter):
+    accepts_token_ids = True
+
+    def prompt_cache(self, data):
+        # The last event carries timings; prompt_n only counts the tokens it had to evaluate.
+        if '"timings"' not in data:
+            return None
+        timings = json.loads(data).get("timings") or {}
+        if "prompt_n" not in timings:
+            return None
+        cached = timings.get("cache_n", 0)
+        return timings["prompt_n"] + cached, cached
+
+class TabbyAdapter(EngineAdapter):
+    supports_n = True
+
+    def headers(self, preset):
+        if not preset.api_key:
+            raise HTTPException(status_code=400, detail="API Key Required for Tabby")
+        return {**super().headers(preset), "x-api-key": preset.api_key}
+
+class AphroditeAdapter(EngineAdapter):
+    supports_n = True
+
+    def __init__(self):
+        self._models = {}
+
+    async def served_model(self, client: httpx.AsyncClient, llm_url: str) -> str:
+        if llm_url not in self._models:
+            response = await client.get(f"{llm_url}/v1/models")
+            response.raise_for_status()
+            data = response.json()["data"]
+            if not data:
+                raise HTTPException(status_code=502, detail="Aphrodite is not serving any model.")
+            self._models[llm_url] = data[0]["id"]
+        return self._models[llm_url]
+
+    async def payload(self, client, preset, llm_url, prompt, eos_tokens, n=1):
+        payload = await super().payload(client, preset, llm_url, prompt, eos_tokens, n)
+        payload["model"] = await self.served_model(client, llm_url)
+        payload["top_k"] = payload["top_k"] or -1
+        del payload["sampler_order"]
+        return payload
+
+ENGINE_ADAPTERS = {
+    "kobold": KoboldAdapter(),
+    "llamacpp": LlamaCppAdapter(),
+    "tabby": TabbyAdapter(),
+    "aphrodite": AphroditeAdapter(),
+}
+
+def get_engine_adapter(engine: Optional[str]) -> EngineAdapter:
+    return ENGINE_ADAPTERS.get(engine or "kobold", ENGINE_ADAPTERS["kobold"])
+
+async def _stream_choices(
+    preset,
+    llm_url: str,
+    prompt: str,
+    eos_tokens: list,
+    prompt_token_ids: Optional[list],
+    n: int,
+    on_prompt_cache: Callable,
+) -> AsyncIterator[tuple]:
+    client = get_http_client()
+    adapter = get_engine_adapter(preset.engine)
+
+    request_prompt = prompt_token_ids if prompt_token_ids and adapter.accepts_token_ids else prompt
+    payload = await adapter.payload(client, preset, llm_url, request_prompt, eos_tokens, n)
+
+    async with client.stream("POST", f"{llm_url}{adapter.path}", headers=adapter.headers(preset), json=payload) as response:
+        if response.status_code >= 400:
+            detail = (await response.aread()).decode("utf-8", errors="replace")
+            error = BackendUnavailable if response.status_code >= 500 else HTTPException
+            raise error(status_code=502, detail=f"LLM server returned {response.status_code}: {detail}")
+
+        async for line in response.aiter_lines():
+            if not line.startswith("data:"):
+                continue
+
+            data = line[len("data:"):].strip()
+            events = adapter.parse_event(data)
+            if events is None:
+                break
+
+            prompt_cache = adapter.prompt_cache(data)
+            if prompt_cache:
+                on_prompt_cache(prompt_cache)
+            for event in events:
+                yield event
+
+async def stream_choices(
+    preset,
+    prompt: str,
+    eos_tokens: list,
+    prompt_token_ids: Optional[list] = None,
+    n: int = 1,
+    priority: str = "interactive",
+    request_id: Optional[str] = None,
+    affinity_key: Optional[str] = None,
+) -> AsyncIterator[tuple]:
+    """
+    Streams (choice index, text, finish_reason) deltas from one of the preset's inference
+    servers, once the scheduler gives this request a slot on it. The backend is chosen by
+    `affinity_key`; if it's unreachable or fails before streaming anything, the next one
+    is tried.
+    """
+    load = {url: generation_scheduler.queued(url) for url in preset.backend_urls}
+    last_error = None
+
+    for llm_url in backend_router.route(preset.backend_urls, affinity_key, load):
+        streamed = False
+        first_token_latency = None
+        prompt_cache = []
+        try:
+            async with generation_scheduler.slot(llm_url, priority, request_id) as job:
+                sent_at = time.time()
+                async for event in job.run(_stream_choices(preset, llm_url, prompt, eos_tokens, prompt_token_ids, n, prompt_cache.append)):
+                    if not streamed:
+                        streamed = True
+                        first_token_latency = time.time() - sent_at
+                    yield event
+        except (BackendUnavailable, httpx.TransportError) as e:
+            backend_router.record_failure(llm_url)
+            if streamed:
+                raise
+            last_error = e
+            continue
+
+        backend_router.record_success(llm_url, affinity_key, first_token_latency, time.time() - sent_at, prompt_cache[-1] if prompt_cache else None)
+        return
+
+    raise last_error
+
+async def stream_completion(
+    preset,
+    prompt: str,
+    eos_tokens: list,
+    prompt_token_ids: Optional[list] = None,
+    priority: str = "interactive",
+    request_id: Optional[str] = None,
+    affinity_key: Optional[str] = None,
+) -> AsyncIterator[tuple]:
+    """Streams (text, finish_reason) deltas for a prompt from the preset's inference server."""
+    async for _, text, finish_reason in stream_choices(preset, prompt, eos_tokens, prompt_token_ids, 1, priority, request_id, affinity_key):
+        yield text, finish_reason
+
+async def complete(
+    preset,
+    prompt: str,
+    eos_tokens: list,
+    prompt_token_ids: Optional[list] = None,
+    priority: str = "interactive",
+    request_id: Optional[str] = None,
+    affinity_key: Optional[str] = None,
+) -> tuple:
+    text = ""
+    finish_reason = None
+    async for delta, reason in stream_completion(preset, prompt, eos_tokens, prompt_token_ids, priority, request_id, affinity_key):
+        text += delta
+        finish_reason = reason or finish_reason
+    return text, finish_reason
+
+async def generate_candidates(
+    preset,
+    prompt: str,
+    eos_tokens: list,
+    n: int,
+    prompt_token_ids: Optional[list] = None,
+    priority: str = "batch",
+    request_id: Optional[str] = None,
+    affinity_key: Optional[str] = None,
+) -> AsyncIterator[dict]:
+    """
+    Generates `n` completions of one prompt and yields each as soon as it finishes, as
+    {"index", "text", "finish_reason", "error"}. Engines that support `n` get a single
+    request; the others get `n` concurrent requests, each queued for its own slot.
+    """
+    if get_engine_adapter(preset.engine).supports_n and n > 1:
+        texts = {}
+        finished = set()
+        async for index, delta, finish_reason in stream_choices(preset, prompt, eos_tokens, prompt_token_ids, n, priority, request_id, affinity_key):
+            texts[index] = texts.get(index, "") + delta
+            if finish_reason and index not in finished:
+                finished.add(index)
+                yield {"index": index, "text": texts[index], "finish_reason": finish_reason, "error": None}
+
+        for index in range(n):
+            if index not in finished:
+                yield {"index": index, "text": texts.get(index, ""), "finish_reason": None, "error": None}
+        return
+
+    async def run(index: int) -> dict:
+        try:
+            text, finish_reason = await complete(preset, prompt, eos_tokens, prompt_token_ids, priority, request_id, affinity_key)
+            return {"index": index, "text": text, "finish_reason": finish_reason, "error": None}
+        except GenerationCancelled:
+            # Ends the whole batch so the caller reports it as cancelled, not as n errors.
+            raise
+        except HTTPException as e:
+            return {"index": index, "text": None, "finish_reason": None, "error": e.detail}
+        except httpx.HTTPError as e:
+            return {"index": index, "text": None, "finish_reason": None, "error": f"Error contacting LLM server: {str(e)}"}
+
+    tasks = [asyncio.create_task(run(index)) for index in range(n)]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for task in tasks:
+            task.cancel()
+
+def sse_event(data: dict, event: Optional[str] = None) -> str:
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n"
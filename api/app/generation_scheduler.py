@@ -0,0 +1,242 @@
+import asyncio
+import heapq
+import itertools
+import os
+import time
+import uuid
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+from fastapi import HTTPException
+
+# In-flight requests allowed per backend unless GENERATION_BACKEND_SLOTS says otherwise.
+GENERATION_SLOTS = int(os.getenv("GENERATION_SLOTS", 1))
+# Comma-separated url=slots pairs, e.g. "http://kobold:5001=1,http://aphrodite:2242=8".
+GENERATION_BACKEND_SLOTS = os.getenv("GENERATION_BACKEND_SLOTS", "")
+# Requests allowed to wait per backend before new ones are turned away with a 429.
+GENERATION_QUEUE_SIZE = int(os.getenv("GENERATION_QUEUE_SIZE", 64))
+
+# Lower runs first.
+PRIORITIES = {"interactive": 0, "autoplay": 1, "batch": 2}
+
+def parse_backend_slots(setting: str) -> dict:
+    slots = {}
+    for entry in setting.split(","):
+        if "=" not in entry:
+            continue
+        url, count = entry.rsplit("=", 1)
+        slots[url.strip().rstrip("/")] = int(count)
+    return slots
+
+class GenerationCancelled(HTTPException):
+    def __init__(self):
+        super().__init__(status_code=499, detail="Generation was cancelled.")
+
+class GenerationJob:
+    def __init__(self, request_id: str, backend: str, priority: str):
+        self.request_id = request_id
+        self.backend = backend
+        self.priority = priority
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.cancelled = False
+        self._waiter = None
+        self._task = None
+
+    def cancel(self):
+        self.cancelled = True
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.cancel()
+        if self._task is not None:
+            self._task.cancel()
+
+    async def run(self, stream: AsyncIterator) -> AsyncIterator:
+        """
+        Consumes `stream` in a task of its own and relays its items, so cancel() can stop
+        the upstream request while the caller still gets to finish its response.
+        """
+        # Cancelled between getting its slot and starting; nothing to stop yet.
+        if self.cancelled:
+            raise GenerationCancelled()
+
+        end = object()
+        queue = asyncio.Queue()
+
+        async def pump():
+            try:
+                async for item in stream:
+                    queue.put_nowait((item, None))
+                queue.put_nowait((end, None))
+            except asyncio.CancelledError:
+                queue.put_nowait((end, GenerationCancelled()))
+            except Exception as e:
+                queue.put_nowait((end, e))
+
+        self._task = asyncio.create_task(pump())
+        try:
+            while True:
+                item, error = await queue.get()
+                if error is not None:
+                    raise error
+                if item is end:
+                    return
+                yield item
+        finally:
+            self._task.cancel()
+
+class BackendQueue:
+    def __init__(self, slots: int):
+        self.slots = slots
+        self.active = set()
+        self.waiting = []
+
+        self.submitted = 0
+        self.started = 0
+        self.completed = 0
+        self.cancelled = 0
+        self.failed = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+class GenerationScheduler:
+    """
+    Sits in front of every server-side LLM request.
+
+    Each backend (a Preset.llm_url) runs at most its slot count of requests at once; the
+    rest wait, interactive before autoplay before batch and first come first served within
+    a priority. Requests are tracked by a request ID that clients can use to cancel them,
+    whether they're still queued or already streaming.
+    """
+
+    def __init__(
+        self,
+        default_slots: int = GENERATION_SLOTS,
+        backend_slots: Optional[dict] = None,
+        queue_size: int = GENERATION_QUEUE_SIZE,
+    ):
+        self.default_slots = default_slots
+        self.backend_slots = parse_backend_slots(GENERATION_BACKEND_SLOTS) if backend_slots is None else backend_slots
+        self.queue_size = queue_size
+
+        self._backends = {}
+        self._jobs = {}
+        self._sequence = itertools.count()
+
+    def backend(self, backend: str) -> BackendQueue:
+        if backend not in self._backends:
+            self._backends[backend] = BackendQueue(self.backend_slots.get(backend, self.default_slots))
+        return self._backends[backend]
+
+    async def acquire(self, job: GenerationJob):
+        queue = self.backend(job.backend)
+        queue.submitted += 1
+
+        if len(queue.active) < queue.slots and not queue.waiting:
+            queue.active.add(job)
+        else:
+            if len(queue.waiting) >= self.queue_size:
+                queue.rejected += 1
+                raise HTTPException(status_code=429, detail="Generation queue is full, try again later.")
+
+            job._waiter = asyncio.get_running_loop().create_future()
+            heapq.heappush(queue.waiting, (PRIORITIES[job.priority], next(self._sequence), job))
+            try:
+                await job._waiter
+            except asyncio.CancelledError:
+                if job in queue.active:
+                    # The slot was handed over just as the wait was cancelled.
+                    self.release(job)
+                else:
+                    queue.waiting = [entry for entry in queue.waiting if entry[2] is not job]
+                    heapq.heapify(queue.waiting)
+                queue.cancelled += 1
+                if job.cancelled:
+                    raise GenerationCancelled()
+                raise
+            finally:
+                job._waiter = None
+
+        job.started_at = time.time()
+        queue.started += 1
+        wait = job.started_at - job.submitted_at
+        queue.total_wait += wait
+        queue.max_wait = max(queue.max_wait, wait)
+
+    def release(self, job: GenerationJob):
+        queue = self.backend(job.backend)
+        queue.active.discard(job)
+
+        while queue.waiting and len(queue.active) < queue.slots:
+            _, _, next_job = heapq.heappop(queue.waiting)
+            if next_job._waiter is None or next_job._waiter.done():
+                continue
+            queue.active.add(next_job)
+            next_job._waiter.set_result(None)
+
+    @asynccontextmanager
+    async def slot(self, llm_url: str, priority: str = "interactive", request_id: Optional[str] = None):
+        if priority not in PRIORITIES:
+            raise HTTPException(status_code=400, detail=f"Unknown priority: {priority}")
+
+        job = GenerationJob(request_id or str(uuid.uuid4()), llm_url.rstrip("/"), priority)
+        self._jobs.setdefault(job.request_id, set()).add(job)
+        try:
+            await self.acquire(job)
+            queue = self.backend(job.backend)
+            try:
+                yield job
+            except (GenerationCancelled, asyncio.CancelledError, GeneratorExit):
+                queue.cancelled += 1
+                raise
+            except BaseException:
+                queue.failed += 1
+                raise
+            else:
+                queue.completed += 1
+            finally:
+                self.release(job)
+        finally:
+            jobs = self._jobs.get(job.request_id)
+            jobs.discard(job)
+            if not jobs:
+                del self._jobs[job.request_id]
+
+    def queued(self, llm_url: str) -> int:
+        queue = self._backends.get(llm_url.rstrip("/"))
+        return len(queue.waiting) if queue else 0
+
+    def cancel(self, request_id: str) -> bool:
+        jobs = self._jobs.get(request_id)
+        if not jobs:
+            return False
+
+        for job in list(jobs):
+            job.cancel()
+        return True
+
+    def stats(self) -> dict:
+        backends = {}
+        for url, queue in self._backends.items():
+            now = time.time()
+            backends[url] = {
+                "slots": queue.slots,
+                "active": len(queue.active),
+                "queued": len(queue.waiting),
+                "queued_by_priority": {
+                    name: sum(1 for entry in queue.waiting if entry[0] == rank)
+                    for name, rank in PRIORITIES.items()
+                },
+                "oldest_wait": max((now - entry[2].submitted_at for entry in queue.waiting), default=0.0),
+                "submitted": queue.submitted,
+                "started": queue.started,
+                "completed": queue.completed,
+                "cancelled": queue.cancelled,
+                "failed": queue.failed,
+                "rejected": queue.rejected,
+                "average_wait": (queue.total_wait / queue.started) if queue.started else 0.0,
+                "max_wait": queue.max_wait,
+            }
+
+        return {"default_slots": self.default_slots, "queue_size": self.queue_size, "backends": backends}
+
+generation_scheduler = GenerationScheduler()
@@ -0,0 +1,123 @@
+import json
+import os
+from typing import Optional
+from huggingface_hub import hf_hub_download, try_to_load_from_cache
+from tokenizers import AddedToken, Tokenizer
+from app.chat_template import get_template_profile
+
+SPECIAL_TOKEN_NAMES = ["bos_token", "eos_token", "unk_token", "sep_token", "pad_token", "cls_token", "mask_token"]
+
+def resolve_tokenizer_file(model_identifier: str, filename: str, local_files_only: bool = False) -> Optional[str]:
+    """
+    Finds one of a model's tokenizer files: in the directory itself for local paths,
+    otherwise in the HF cache, downloading it only when it isn't cached yet and
+    `local_files_only` is off.
+    """
+    if os.path.isdir(model_identifier):
+        path = os.path.join(model_identifier, filename)
+        return path if os.path.isfile(path) else None
+
+    cached = try_to_load_from_cache(model_identifier, filename)
+    if isinstance(cached, str):
+        return cached
+    if local_files_only:
+        return None
+
+    try:
+        return hf_hub_download(model_identifier, filename)
+    except Exception:
+        return None
+
+def read_json(path: Optional[str]) -> dict:
+    if not path:
+        return {}
+
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+def token_content(token) -> Optional[str]:
+    # tokenizer_config.json stores special tokens either as strings or serialized AddedTokens.
+    if isinstance(token, dict):
+        return token.get("content")
+    return token
+
+class LightweightTokenizer:
+    """
+    The subset of a transformers fast tokenizer that tokens.py uses, built directly on
+    the `tokenizers` library so the API doesn't need torch or transformers installed.
+    """
+
+    def __init__(self, tokenizer: Tokenizer, config: dict, name_or_path: str = ""):
+        self._tokenizer = tokenizer
+        self.name_or_path = name_or_path
+
+        chat_template = config.get("chat_template")
+        if isinstance(chat_template, list):
+            chat_template = {template["name"]: template["template"] for template in chat_template}
+        self.chat_template = chat_template
+
+        for name in SPECIAL_TOKEN_NAMES:
+            setattr(self, name, token_content(config.get(name)))
+        self.additional_special_tokens = [token_content(token) for token in config.get("additional_special_tokens") or []]
+
+        # Same as transformers: tokens declared only in the config still get added.
+        for token in (config.get("added_tokens_decoder") or {}).values():
+            if tokenizer.token_to_id(token["content"]) is not None:
+                continue
+            added_token = AddedToken(
+                token["content"],
+                single_word=token.get("single_word", False),
+                lstrip=token.get("lstrip", False),
+                rstrip=token.get("rstrip", False),
+                normalized=token.get("normalized", not token.get("special", False)),
+                special=token.get("special", False),
+            )
+            if added_token.special:
+                tokenizer.add_special_tokens([added_token])
+            else:
+                tokenizer.add_tokens([added_token])
+
+    @property
+    def special_tokens_map(self) -> dict:
+        special_tokens = {name: getattr(self, name) for name in SPECIAL_TOKEN_NAMES if getattr(self, name)}
+        if self.additional_special_tokens:
+            special_tokens["additional_special_tokens"] = list(self.additional_special_tokens)
+        return special_tokens
+
+    @property
+    def added_tokens_decoder(self) -> dict:
+        return self._tokenizer.get_added_tokens_decoder()
+
+    def __len__(self):
+        return self._tokenizer.get_vocab_size(with_added_tokens=True)
+
+    def encode(self, text: str, add_special_tokens: bool = True) -> list:
+        return self._tokenizer.encode(text, add_special_tokens=add_special_tokens).ids
+
+    def encode_with_offsets(self, text: str) -> tuple:
+        encoding = self._tokenizer.encode(text, add_special_tokens=False)
+        return encoding.ids, encoding.offsets
+
+    def __call__(self, texts, add_special_tokens: bool = True) -> dict:
+        if isinstance(texts, str):
+            return {"input_ids": self.encode(texts, add_special_tokens=add_special_tokens)}
+
+        encoded = self._tokenizer.encode_batch(list(texts), add_special_tokens=add_special_tokens)
+        return {"input_ids": [encoding.ids for encoding in encoded]}
+
+    def apply_chat_template(self, conversation: list, tokenize: bool = True, add_generation_prompt: bool = False):
+        rendered = get_template_profile(self).render(conversation, add_generation_prompt=add_generation_prompt)
+        if tokenize:
+            return self.encode(rendered, add_special_tokens=False)
+        return rendered
+
+def load_lightweight_tokenizer(model_identifier: str, local_files_only: bool = False) -> LightweightTokenizer:
+    tokenizer_file = resolve_tokenizer_file(model_identifier, "tokenizer.json", local_files_only)
+    if not tokenizer_file:
+        raise OSError(f"No tokenizer.json found for {model_identifier}; sentencepiece-only models need TOKENIZER_BACKEND=transformers")
+
+    config = read_json(resolve_tokenizer_file(model_identifier, "tokenizer_config.json", local_files_only))
+    # Like transformers, special_tokens_map.json wins over tokenizer_config.json.
+    config.update(read_json(resolve_tokenizer_file(model_identifier, "special_tokens_map.json", local_files_only)))
+
+    return LightweightTokenizer(Tokenizer.from_file(tokenizer_file), config, name_or_path=model_identifier)
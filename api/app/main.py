@@ -1,11 +1,15 @@
+import asyncio
 import logging
 import sys
 from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request
 from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
-from app.database import init_db
+from app.database import async_engine, init_db
 from app.api import router  # Import the router
+from app.token_pool import tokenizer_pool
+from app.generation import close_http_client
+from app.tokenizer_warmup import warm_up_tokenizers, warmup_state
 from alembic.config import Config
 from starlette.exceptions import HTTPException
 from alembic import command
@@ -34,8 +38,14 @@ async def lifespan(app_: FastAPI):
     fastapi_logger.info("Starting up...")
     fastapi_logger.info("run alembic upgrade head...")
     run_migrations()
+    fastapi_logger.info("warming up tokenizers...")
+    warmup_task = asyncio.create_task(warm_up_tokenizers())
     yield
     fastapi_logger.info("Shutting down...")
+    warmup_task.cancel()
+    tokenizer_pool.shutdown()
+    await close_http_client()
+    await async_engine.dispose()
 
 app = FastAPI(lifespan=lifespan)
 
@@ -82,3 +92,11 @@ app.include_router(router)
 @app.get("/")
 def read_root():
     return {"message": "API is running on port 3001"}
+
+@app.get("/ready")
+def read_ready():
+    # Not ready until every preloaded tokenizer has been loaded and warmed up.
+    return JSONResponse(
+        status_code=200 if warmup_state.ready else 503,
+        content=warmup_state.as_dict(),
+    )
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, Text, Integer, ForeignKey, JSON, ARRAY
+from sqlalchemy import Column, String, Text, Integer, ForeignKey, Index, JSON, ARRAY
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.mutable import MutableList
 from sqlalchemy.ext.declarative import declarative_base
@@ -53,6 +53,10 @@ class Conversation(Base, TimestampMixin):
     persona = relationship("Persona", back_populates="conversations")
     prompt = relationship("Prompt", back_populates="conversations")
 
+    __table_args__ = (
+        Index('ix_conversation_updated_at_id', 'updated_at', 'id'),
+    )
+
 class Persona(Base, TimestampMixin):
     __tablename__ = 'persona'
 
@@ -87,6 +91,18 @@ class Message(Base, TimestampMixin):
 
     conversation = relationship("Conversation", back_populates="messages")
 
+    __table_args__ = (
+        Index('ix_message_conversation_id_order', 'conversation_id', 'order'),
+    )
+
+class MessageTokenCount(Base, TimestampMixin):
+    __tablename__ = 'message_token_count'
+
+    message_id = Column(Integer, ForeignKey('message.id', ondelete='CASCADE'), primary_key=True)
+    model_identifier = Column(String, primary_key=True, index=True)
+    content_hash = Column(String(64), primary_key=True)
+    token_count = Column(Integer, nullable=False)
+
 class TagCategory(Base, TimestampMixin):
     __tablename__ = 'tag_category'
 
@@ -132,6 +148,7 @@ class Preset(Base, TimestampMixin):
     sampler_order = Column(JSON, nullable=False)
     model_name = Column(String, nullable=False)
     llm_url = Column(String, nullable=False)
+    backend_urls = Column(ARRAY(String), nullable=True)
     max_context = Column(Integer, nullable=False, server_default='16384')
     engine = Column(String, nullable=False, server_default='kobold')
     api_key = Column(String, nullable=True)
\ No newline at end of file
@@ -0,0 +1,46 @@
+import base64
+import binascii
+import json
+from datetime import datetime
+from fastapi import HTTPException
+from sqlalchemy import DateTime, func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+# Below this many estimated rows an exact count is cheap enough to run instead.
+EXACT_COUNT_LIMIT = 10000
+
+def encode_cursor(sort: str, values: list) -> str:
+    """An opaque token for the keyset position just after a row with these sort values."""
+    payload = json.dumps({"sort": sort, "after": [value.isoformat() if isinstance(value, datetime) else value for value in values]})
+    return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor: str, sort: str, columns: tuple) -> list:
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        values = payload["after"]
+        if payload["sort"] != sort or len(values) != len(columns):
+            raise ValueError("cursor was made for another sort")
+        return [
+            datetime.fromisoformat(value) if isinstance(column.type, DateTime) else value
+            for column, value in zip(columns, values)
+        ]
+    except (binascii.Error, UnicodeDecodeError, json.JSONDecodeError, KeyError, TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid cursor.") from None
+
+async def estimate_count(db: AsyncSession, query) -> int:
+    """
+    The planner's row estimate for a query, which costs no scan on big tables but is only
+    approximate. Small results are counted exactly.
+    """
+    connection = await db.connection()
+    # Compiled for the connection's own driver, with values bound as parameters.
+    compiled = query.compile(dialect=connection.dialect, compile_kwargs={"render_postcompile": True})
+    parameters = tuple(compiled.params[name] for name in compiled.positiontup)
+    plan = (await connection.exec_driver_sql(f"EXPLAIN (FORMAT JSON) {compiled.string}", parameters)).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    estimate = int(plan[0]["Plan"]["Plan Rows"])
+
+    if estimate <= EXACT_COUNT_LIMIT:
+        return await db.scalar(select(func.count()).select_from(query.subquery()))
+    return estimate
@@ -0,0 +1,161 @@
+import json
+from bisect import bisect_left
+from typing import Callable, Optional
+from redis import asyncio as aioredis
+from redis.exceptions import WatchError
+from app.cache import CACHE_TTL, cache_get_many
+
+def prefix_sums(counts: list) -> list:
+    prefix = [0]
+    for count in counts:
+        prefix.append(prefix[-1] + count)
+    return prefix
+
+def fit_suffix(prefix: list, budget: int) -> int:
+    """
+    Returns the position of the first entry of the longest suffix whose tokens fit in
+    `budget`, given prefix sums with a leading zero. Everything before it gets shifted.
+    """
+    total = prefix[-1]
+    return min(bisect_left(prefix, total - budget), len(prefix) - 1)
+
+def fit_suffix_chunked(prefix: list, budget: int, chunk: int, previous_cutoff: Optional[int] = None) -> int:
+    """
+    Like fit_suffix, but keeps `previous_cutoff` for as long as the suffix after it still
+    fits, and when it doesn't, shifts an extra `chunk` tokens of history so the cutoff
+    (and with it the prompt prefix) stays put for the next several turns.
+    """
+    total = prefix[-1]
+    if previous_cutoff is not None and previous_cutoff < len(prefix) and total - prefix[previous_cutoff] <= budget:
+        return previous_cutoff
+
+    cutoff = fit_suffix(prefix, budget)
+    if cutoff == 0:
+        return 0
+
+    chunked_cutoff = fit_suffix(prefix, budget - chunk)
+    # A single huge recent message may not fit the reduced budget; never shift it out.
+    return chunked_cutoff if chunked_cutoff < len(prefix) - 1 else cutoff
+
+class ConversationTokenIndex:
+    """
+    Prefix sums of per-message token counts for one conversation and model.
+
+    `overhead` is the difference between templating the whole conversation at once and
+    the sum of templating each message alone (BOS tokens, separators), measured when the
+    index is built so `total` matches count_tokens.
+    """
+
+    def __init__(self, message_ids: list, counts: list, overhead: int = 0):
+        self.message_ids = list(message_ids)
+        self.prefix = prefix_sums(counts)
+        self.overhead = overhead
+
+    @property
+    def total(self) -> int:
+        return self.prefix[-1] + self.overhead
+
+    @property
+    def counts(self) -> list:
+        return [self.prefix[i + 1] - self.prefix[i] for i in range(len(self.message_ids))]
+
+    def __len__(self):
+        return len(self.message_ids)
+
+    def append(self, message_id: int, count: int):
+        self.message_ids.append(message_id)
+        self.prefix.append(self.prefix[-1] + count)
+
+    def set_count(self, message_id: int, count: int):
+        position = self.message_ids.index(message_id)
+        delta = count - (self.prefix[position + 1] - self.prefix[position])
+        for i in range(position + 1, len(self.prefix)):
+            self.prefix[i] += delta
+
+    def remove(self, message_id: int):
+        position = self.message_ids.index(message_id)
+        counts = self.counts
+        del self.message_ids[position]
+        del counts[position]
+        self.prefix = prefix_sums(counts)
+
+    def fit(self, budget: int) -> int:
+        return fit_suffix(self.prefix, budget)
+
+    def to_json(self) -> str:
+        return json.dumps({"ids": self.message_ids, "counts": self.counts, "overhead": self.overhead})
+
+    @classmethod
+    def from_json(cls, value: str) -> "ConversationTokenIndex":
+        data = json.loads(value)
+        return cls(data["ids"], data["counts"], data["overhead"])
+
+def token_index_key(conversation_id: int, version: int, model_identifier: str) -> str:
+    return f"conversation:{conversation_id}:{version}:index:{model_identifier}"
+
+def indexed_models_key(conversation_id: int, version: int) -> str:
+    return f"conversation:{conversation_id}:{version}:indexed_models"
+
+async def load_token_index(redis: aioredis.Redis, conversation_id: int, version: int, model_identifier: str) -> Optional[ConversationTokenIndex]:
+    value = await redis.get(token_index_key(conversation_id, version, model_identifier))
+    return ConversationTokenIndex.from_json(value) if value else None
+
+async def load_token_indexes(redis: aioredis.Redis, versions: dict, model_identifier: str) -> dict:
+    """Loads the indexes of several conversations, given {conversation_id: version}, in one MGET."""
+    conversation_ids = list(versions.keys())
+    values = await cache_get_many(redis, [
+        token_index_key(conversation_id, versions[conversation_id], model_identifier)
+        for conversation_id in conversation_ids
+    ])
+    return {
+        conversation_id: ConversationTokenIndex.from_json(value) if value else None
+        for conversation_id, value in zip(conversation_ids, values)
+    }
+
+async def save_token_indexes(redis: aioredis.Redis, versions: dict, model_identifier: str, indexes: dict):
+    async with redis.pipeline(transaction=False) as pipe:
+        for conversation_id, index in indexes.items():
+            version = versions[conversation_id]
+            models_key = indexed_models_key(conversation_id, version)
+            pipe.set(token_index_key(conversation_id, version, model_identifier), index.to_json(), ex=CACHE_TTL)
+            pipe.sadd(models_key, model_identifier)
+            pipe.expire(models_key, CACHE_TTL)
+        await pipe.execute()
+
+async def update_token_index(redis: aioredis.Redis, conversation_id: int, version: int, model_identifier: str, change: Callable[[ConversationTokenIndex], None]):
+    """
+    Applies `change` to a stored index under WATCH, retrying if another write got to the
+    key first, so concurrent edits to one conversation can't lose each other's counts.
+    The key keeps its TTL, so an index is rebuilt from the table at least every CACHE_TTL
+    however often it's updated.
+    """
+    key = token_index_key(conversation_id, version, model_identifier)
+    async with redis.pipeline(transaction=True) as pipe:
+        while True:
+            try:
+                await pipe.watch(key)
+                value = await pipe.get(key)
+                if not value:
+                    return
+
+                index = ConversationTokenIndex.from_json(value)
+                change(index)
+                pipe.multi()
+                pipe.set(key, index.to_json(), keepttl=True)
+                await pipe.execute()
+                return
+            except WatchError:
+                continue
+
+async def get_indexed_models(redis: aioredis.Redis, conversation_id: int, version: int) -> list:
+    return list(await redis.smembers(indexed_models_key(conversation_id, version)))
+
+def shift_state_key(conversation_id: int, model_identifier: str) -> str:
+    return f"conversation:{conversation_id}:shift:{model_identifier}"
+
+async def load_shift_state(redis: aioredis.Redis, conversation_id: int, model_identifier: str) -> Optional[dict]:
+    value = await redis.get(shift_state_key(conversation_id, model_identifier))
+    return json.loads(value) if value else None
+
+async def save_shift_state(redis: aioredis.Redis, conversation_id: int, model_identifier: str, state: dict):
+    await redis.set(shift_state_key(conversation_id, model_identifier), json.dumps(state), ex=CACHE_TTL)
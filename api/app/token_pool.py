@@ -0,0 +1,154 @@
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Optional
+from fastapi import HTTPException
+
+TOKENIZER_POOL_MODE = os.getenv("TOKENIZER_POOL_MODE", "thread")
+TOKENIZER_WORKERS = int(os.getenv("TOKENIZER_WORKERS", 2))
+TOKENIZER_QUEUE_SIZE = int(os.getenv("TOKENIZER_QUEUE_SIZE", 64))
+
+class TokenizationError(Exception):
+    """
+    What tokenizer work raises instead of HTTPException, which can't be unpickled on its
+    way back from a worker process. The pool turns it into an HTTPException.
+    """
+
+    def __init__(self, detail: str, status_code: int = 400):
+        super().__init__(detail, status_code)
+        self.detail = detail
+        self.status_code = status_code
+
+    def __str__(self):
+        return self.detail
+
+def _timed_call(fn: Callable, args: tuple):
+    # Runs in the worker, so the start time tells us how long the job sat in the queue.
+    return time.time(), fn(*args)
+
+class TokenizerPool:
+    """
+    Runs CPU-bound tokenizer work off the event loop.
+
+    At most `queue_size` jobs may be queued or running at once; beyond that callers get a
+    429 instead of piling more work onto the worker. Identical jobs submitted while one is
+    still pending share its result.
+    """
+
+    def __init__(
+        self,
+        mode: str = TOKENIZER_POOL_MODE,
+        workers: int = TOKENIZER_WORKERS,
+        queue_size: int = TOKENIZER_QUEUE_SIZE,
+    ):
+        self.mode = mode
+        self.workers = workers
+        self.queue_size = queue_size
+
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        self._pending = {}
+
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.shared = 0
+        self.total_queue_wait = 0.0
+        self.max_queue_wait = 0.0
+
+    @property
+    def executor(self):
+        with self._executor_lock:
+            if self._executor is None:
+                if self.mode == "process":
+                    self._executor = ProcessPoolExecutor(max_workers=self.workers)
+                else:
+                    self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="tokenizer")
+            return self._executor
+
+    def _discard_executor(self, executor):
+        # A worker process died, which leaves a process pool unusable; the next job gets a new one.
+        with self._executor_lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    async def _execute(self, fn: Callable, args: tuple):
+        executor = self.executor
+        try:
+            return await asyncio.get_running_loop().run_in_executor(executor, _timed_call, fn, args)
+        except TokenizationError as e:
+            raise HTTPException(status_code=e.status_code, detail=e.detail) from None
+        except BrokenProcessPool:
+            self._discard_executor(executor)
+            raise HTTPException(status_code=503, detail="Tokenizer worker crashed, try again.") from None
+
+    @staticmethod
+    def job_key(fn: Callable, args: tuple) -> str:
+        payload = json.dumps([fn.__module__, fn.__qualname__, args], sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    async def run(self, fn: Callable, *args, key: Optional[str] = None):
+        if key is None:
+            key = self.job_key(fn, args)
+
+        pending = self._pending.get(key)
+        if pending is not None:
+            self.shared += 1
+            _, result = await asyncio.shield(pending)
+            return result
+
+        if len(self._pending) >= self.queue_size:
+            self.rejected += 1
+            raise HTTPException(status_code=429, detail="Tokenizer queue is full, try again later.")
+
+        submitted_at = time.time()
+        future = asyncio.ensure_future(self._execute(fn, args))
+        self._pending[key] = future
+        self.submitted += 1
+
+        try:
+            started_at, result = await asyncio.shield(future)
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self._pending.pop(key, None)
+
+        queue_wait = max(0.0, started_at - submitted_at)
+        self.total_queue_wait += queue_wait
+        self.max_queue_wait = max(self.max_queue_wait, queue_wait)
+        self.completed += 1
+        return result
+
+    def stats(self) -> dict:
+        return {
+            "mode": self.mode,
+            "workers": self.workers,
+            "queue_size": self.queue_size,
+            "in_flight": len(self._pending),
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "shared": self.shared,
+            "average_queue_wait": (self.total_queue_wait / self.completed) if self.completed else 0.0,
+            "max_queue_wait": self.max_queue_wait,
+        }
+
+    def shutdown(self):
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+tokenizer_pool = TokenizerPool()
+
+async def run_tokenization(fn: Callable, *args, key: Optional[str] = None):
+    return await tokenizer_pool.run(fn, *args, key=key)
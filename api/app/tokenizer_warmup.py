@@ -0,0 +1,68 @@
+import logging
+import os
+import time
+from sqlalchemy import select
+from app.database import AsyncSessionLocal
+from app.models import Preset
+from app.tokens import warm_up_tokenizer
+from app.token_pool import run_tokenization
+
+logger = logging.getLogger(__name__)
+
+# Comma-separated model identifiers to load at startup, "presets" for every distinct
+# Preset.model_name, or "none" to skip warm-up entirely.
+TOKENIZER_PRELOAD = os.getenv("TOKENIZER_PRELOAD", "presets")
+
+class WarmupState:
+    def __init__(self):
+        self.ready = False
+        self.started_at = None
+        self.finished_at = None
+        self.models = {}
+
+    def as_dict(self) -> dict:
+        return {
+            "ready": self.ready,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "models": dict(self.models),
+        }
+
+warmup_state = WarmupState()
+
+async def preload_model_identifiers() -> list:
+    setting = TOKENIZER_PRELOAD.strip()
+    if setting.lower() == "none":
+        return []
+
+    if setting.lower() != "presets":
+        return [model.strip() for model in setting.split(",") if model.strip()]
+
+    async with AsyncSessionLocal() as db:
+        return (await db.scalars(select(Preset.model_name).distinct().order_by(Preset.model_name))).all()
+
+async def warm_up_tokenizers():
+    """
+    Loads and exercises every preloaded tokenizer, one at a time so warm-up never fills
+    the tokenizer queue. A model that fails is reported but doesn't block readiness.
+    """
+    warmup_state.started_at = time.time()
+
+    try:
+        model_identifiers = await preload_model_identifiers()
+    except Exception as e:
+        logger.error(f"Could not list models to preload: {e}")
+        model_identifiers = []
+
+    for model_identifier in model_identifiers:
+        try:
+            timings = await run_tokenization(warm_up_tokenizer, model_identifier)
+            warmup_state.models[model_identifier] = {"status": "ready", **timings}
+            logger.info(f"Warmed up tokenizer {model_identifier} (load {timings['load_time']:.2f}s, warm-up {timings['warmup_time']:.2f}s)")
+        except Exception as e:
+            detail = getattr(e, "detail", str(e))
+            warmup_state.models[model_identifier] = {"status": "failed", "error": detail}
+            logger.error(f"Failed to warm up tokenizer {model_identifier}: {detail}")
+
+    warmup_state.finished_at = time.time()
+    warmup_state.ready = True
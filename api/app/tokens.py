@@ -1,17 +1,178 @@
-from typing import Optional
-from transformers import AutoTokenizer
-from fastapi import HTTPException
+import base64
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import weakref
+from array import array
+from collections import OrderedDict
+from typing import Callable, Optional
 from redis import asyncio as aioredis
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+from app.models import MessageTokenCount
+from app.cache import cache_get_many, cache_set_many
+from app.chat_template import CHATML_TEMPLATE, get_template_profile, normalize_messages
+from app.lightweight_tokenizer import load_lightweight_tokenizer
+from app.token_index import fit_suffix, fit_suffix_chunked, load_shift_state, prefix_sums, save_shift_state
+from app.token_pool import TokenizationError, run_tokenization
 
-CHATML_TEMPLATE= """{% for message in messages %}
-        {{'<|im_start|>' + message['role'] + '\n' + message['content']}}
-        {% if (loop.last and add_generation_prompt) or not loop.last %}
-            {{ '<|im_end|>' + '\n'}}
-        {% endif %}
-    {% endfor %}
-    {% if add_generation_prompt and messages[-1]['role'] != 'assistant' %}
-        {{ '<|im_start|>assistant\n' }}
-    {% endif %}"""
+TOKENIZER_CACHE_SIZE = int(os.getenv("TOKENIZER_CACHE_SIZE", 8))
+TOKENIZER_CACHE_MAX_BYTES = int(os.getenv("TOKENIZER_CACHE_MAX_BYTES", 0))
+# "transformers" or "tokenizers"; the latter needs neither torch nor transformers installed.
+TOKENIZER_BACKEND = os.getenv("TOKENIZER_BACKEND", "transformers")
+# Pre-downloaded tokenizers laid out as <TOKENIZER_DIR>/<org>/<model>, used before the hub.
+TOKENIZER_DIR = os.getenv("TOKENIZER_DIR", "")
+# "message" shifts the oldest messages one at a time; "chunked" keeps the prompt prefix
+# stable between turns so backends can reuse their KV cache.
+CONTEXT_SHIFT_MODE = os.getenv("CONTEXT_SHIFT_MODE", "message")
+SHIFT_MODES = ("message", "chunked")
+# Fraction of the history budget freed at once when a chunked shift happens.
+CONTEXT_SHIFT_CHUNK = float(os.getenv("CONTEXT_SHIFT_CHUNK", 0.25))
+
+# Rough per-vocab-entry footprint of a loaded tokenizer (vocab dict, merges, added tokens).
+APPROX_BYTES_PER_TOKEN = 256
+
+def approximate_tokenizer_size(tokenizer) -> int:
+    try:
+        return len(tokenizer) * APPROX_BYTES_PER_TOKEN
+    except Exception:
+        return 0
+
+def local_tokenizer_path(model_identifier: str) -> Optional[str]:
+    if TOKENIZER_DIR:
+        path = os.path.join(TOKENIZER_DIR, model_identifier)
+        if os.path.isdir(path):
+            return path
+    return None
+
+def load_tokenizer(model_identifier: str, local_files_only: bool = False):
+    source = local_tokenizer_path(model_identifier) or model_identifier
+
+    if TOKENIZER_BACKEND == "tokenizers":
+        return load_lightweight_tokenizer(source, local_files_only=local_files_only)
+
+    # Imported here so the tokenizers backend works in images without transformers.
+    from transformers import AutoTokenizer
+    return AutoTokenizer.from_pretrained(source, local_files_only=local_files_only)
+
+def load_tokenizer_offline(model_identifier: str):
+    return load_tokenizer(model_identifier, local_files_only=True)
+
+class TokenizerRegistry:
+    """
+    Process-wide cache of loaded tokenizers.
+
+    Tokenizers are kept in LRU order and evicted once either the entry count or the
+    approximate memory budget is exceeded. Concurrent requests for a model that is not
+    loaded yet wait on a single load instead of each reading the files from disk.
+    """
+
+    def __init__(
+        self,
+        loader: Callable = load_tokenizer,
+        max_entries: int = TOKENIZER_CACHE_SIZE,
+        max_bytes: int = TOKENIZER_CACHE_MAX_BYTES,
+        sizer: Callable = approximate_tokenizer_size,
+    ):
+        self._loader = loader
+        self._sizer = sizer
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        self._lock = threading.Lock()
+        self._load_locks = {}
+        self._tokenizers = OrderedDict()
+        self._sizes = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.load_failures = 0
+        self.evictions = 0
+        self.load_times = {}
+
+    def get(self, model_identifier: str, loader: Optional[Callable] = None):
+        with self._lock:
+            tokenizer = self._lookup(model_identifier)
+            if tokenizer is not None:
+                return tokenizer
+            load_lock = self._load_locks.setdefault(model_identifier, threading.Lock())
+
+        with load_lock:
+            # Another request may have finished loading while we waited.
+            with self._lock:
+                tokenizer = self._lookup(model_identifier)
+                if tokenizer is not None:
+                    return tokenizer
+                self.misses += 1
+
+            start = time.perf_counter()
+            try:
+                tokenizer = (loader or self._loader)(model_identifier)
+            except Exception:
+                with self._lock:
+                    self.load_failures += 1
+                    self._load_locks.pop(model_identifier, None)
+                raise
+            elapsed = time.perf_counter() - start
+
+            with self._lock:
+                self._tokenizers[model_identifier] = tokenizer
+                self._sizes[model_identifier] = self._sizer(tokenizer)
+                self.load_times[model_identifier] = elapsed
+                self._load_locks.pop(model_identifier, None)
+                self._evict()
+
+        return tokenizer
+
+    def _lookup(self, model_identifier: str):
+        tokenizer = self._tokenizers.get(model_identifier)
+        if tokenizer is not None:
+            self._tokenizers.move_to_end(model_identifier)
+            self.hits += 1
+        return tokenizer
+
+    def _evict(self):
+        # Always keep the most recently used tokenizer, even if it alone exceeds the budget.
+        while len(self._tokenizers) > 1 and (
+            (self.max_entries and len(self._tokenizers) > self.max_entries)
+            or (self.max_bytes and sum(self._sizes.values()) > self.max_bytes)
+        ):
+            model_identifier, _ = self._tokenizers.popitem(last=False)
+            self._sizes.pop(model_identifier, None)
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._tokenizers.clear()
+            self._sizes.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "loaded": list(self._tokenizers.keys()),
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "approximate_bytes": sum(self._sizes.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits / lookups) if lookups else 0.0,
+                "load_failures": self.load_failures,
+                "evictions": self.evictions,
+                "load_times": dict(self.load_times),
+            }
+
+tokenizer_registry = TokenizerRegistry()
+
+def get_tokenizer(model_identifier: str):
+    try:
+        return tokenizer_registry.get(model_identifier)
+    except Exception as e:
+        raise TokenizationError(f"Error loading tokenizer: {str(e)}")
 
 def count_tokens(messages: list, model_identifier: str, with_chat_template: bool = True) -> int:
     """
@@ -25,70 +186,452 @@ def count_tokens(messages: list, model_identifier: str, with_chat_template: bool
     Returns:
         int: The total token count.
     """
-    try:
-        tokenizer = AutoTokenizer.from_pretrained(model_identifier)
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=f"Error loading tokenizer: {str(e)}")
+    tokenizer = get_tokenizer(model_identifier)
 
     try:
         tokens = attempt_difficult_chat_template(tokenizer, messages)
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
+        raise TokenizationError(f"An error occurred: {str(e)}", status_code=500)
 
     return len(tokens)
 
-async def cache_message(redis, message, result, model_identifier):
-    message_cache_key = f"prompt:message:{message['id']}:{model_identifier}"
-    await redis.set(message_cache_key, result)
+def render_chat(tokenizer, messages, add_generation_prompt=False) -> tuple:
+    """
+    Renders a chat with the tokenizer's template and returns the messages the template was
+    given along with the text, since they may have been normalized first.
+    """
+    # Falls back to chatml if no template found. Templates that reject system messages or
+    # repeated roles get the messages normalized up front, as probed in their profile.
+    profile = get_template_profile(tokenizer)
+
+    if profile.needs_normalization(messages):
+        messages = normalize_messages(messages)
 
-def attempt_difficult_chat_template(tokenizer: AutoTokenizer, messages, tokenize=True, add_generation_prompt=False):
-    # Fallback to chatml if no template found.
     try:
-        if tokenizer.chat_template: 
-            return_toks = tokenizer.apply_chat_template(
-                messages, 
-                tokenize=tokenize,
-                add_generation_prompt=add_generation_prompt
-            )
-        else:
-            return_toks = tokenizer.apply_chat_template(
-                messages, 
-                tokenize=tokenize,
-                add_generation_prompt=add_generation_prompt,
-                chat_template=CHATML_TEMPLATE
-            )
-    except Exception as e:
-        new_messages = []
-        for msg in messages:
-            if msg["role"] == "system":
-                msg["role"] = "user"
-            
-            if new_messages and new_messages[-1]["role"] == msg["role"]:
-                new_messages[-1]["content"] += f"\n\n{msg['content']}"
-            else:
-                new_messages.append(msg)
-        
-        if len(new_messages) == 1:
-            new_messages[0]["role"] = "user"
-        
+        return messages, profile.render(messages, add_generation_prompt=add_generation_prompt)
+    except Exception:
+        # A shape the probes didn't cover; retry once with everything normalized.
         try:
-            if tokenizer.chat_template:
-                return_toks = tokenizer.apply_chat_template(
-                    new_messages, 
-                    tokenize=tokenize,
-                    add_generation_prompt=add_generation_prompt
-                )
-            else:
-                return_toks = tokenizer.apply_chat_template(
-                    new_messages, 
-                    tokenize=tokenize,
-                    add_generation_prompt=add_generation_prompt,
-                    chat_template=CHATML_TEMPLATE
-                )
+            messages = normalize_messages(messages)
+            return messages, profile.render(messages, add_generation_prompt=add_generation_prompt)
         except Exception as ei:
-            raise HTTPException(status_code=400, detail=f"Error tokenizing messages: {str(ei)} {tokenizer.chat_template}")
-    
-    return return_toks
+            raise TokenizationError(f"Error tokenizing messages: {str(ei)} {tokenizer.chat_template}")
+
+def attempt_difficult_chat_template(tokenizer, messages, tokenize=True, add_generation_prompt=False):
+    _, rendered = render_chat(tokenizer, messages, add_generation_prompt)
+
+    if tokenize:
+        # Same as apply_chat_template: the template already places any special tokens.
+        return tokenizer.encode(rendered, add_special_tokens=False)
+
+    return rendered
+
+def render_message_fragments(tokenizer, messages: list) -> list:
+    """Renders each message as its own single-message chat."""
+    return [
+        attempt_difficult_chat_template(tokenizer, [message], tokenize=False, add_generation_prompt=False)
+        for message in messages
+    ]
+
+def count_message_tokens_batch(tokenizer, messages: list) -> list:
+    """
+    Counts tokens for each message separately, as attempt_difficult_chat_template would for
+    a single-message chat, but with one template pass and one batched encode call.
+    """
+    if not messages:
+        return []
+
+    fragments = render_message_fragments(tokenizer, messages)
+    # apply_chat_template(tokenize=True) encodes without adding special tokens; match it.
+    encoded = tokenizer(fragments, add_special_tokens=False)
+    return [len(input_ids) for input_ids in encoded["input_ids"]]
+
+def get_chat_tokenizer(model_identifier: str):
+    tokenizer = get_tokenizer(model_identifier)
+
+    if not hasattr(tokenizer, "apply_chat_template"):
+        raise TokenizationError("Tokenizer does not support apply_chat_template")
+
+    return tokenizer
+
+# The functions below take a model identifier rather than a tokenizer so they can be
+# shipped to the tokenizer pool, which may run them in another process.
+
+def count_chat_tokens(chats: list, model_identifier: str) -> list:
+    """Counts templated tokens for each chat (a list of messages) on its own."""
+    tokenizer = get_chat_tokenizer(model_identifier)
+    return [
+        len(attempt_difficult_chat_template(tokenizer, chat, tokenize=True, add_generation_prompt=False))
+        for chat in chats
+    ]
+
+def count_message_tokens(messages: list, model_identifier: str) -> list:
+    return count_message_tokens_batch(get_chat_tokenizer(model_identifier), messages)
+
+def end_of_turn_token(tokenizer) -> str:
+    eos_token = '<|im_end|>'
+    if tokenizer.chat_template:
+        eos_token = tokenizer.eos_token
+
+    return eos_token
+
+def render_chat_history(messages: list, model_identifier: str) -> tuple:
+    tokenizer = get_chat_tokenizer(model_identifier)
+    chat_history = attempt_difficult_chat_template(tokenizer, messages, tokenize=False, add_generation_prompt=True)
+
+    return chat_history, end_of_turn_token(tokenizer)
+
+def describe_template(model_identifier: str) -> dict:
+    return get_template_profile(get_chat_tokenizer(model_identifier)).as_dict()
+
+# Chats whose rendering is encoded both whole and piecewise to check that a tokenizer
+# can be fed a prompt one special-token-delimited segment at a time.
+SEGMENT_PROBE_CHATS = [
+    [{"role": "system", "content": "Be brief."}, {"role": "user", "content": " Hello,  world!\n"}],
+    [{"role": "user", "content": "Ünïcödé ☃\n\n  indented"}, {"role": "assistant", "content": "\tok "}],
+]
+
+_segment_patterns = weakref.WeakKeyDictionary()
+_segment_patterns_lock = threading.Lock()
+
+def special_token_pattern(tokenizer) -> Optional[re.Pattern]:
+    tokens = {token.content for token in tokenizer.added_tokens_decoder.values() if token.special}
+    if not tokens:
+        return None
+
+    # Longest first, so the alternation matches leftmost-longest like the tokenizer does.
+    return re.compile("(" + "|".join(re.escape(token) for token in sorted(tokens, key=len, reverse=True)) + ")")
+
+def split_on_special_tokens(text: str, pattern: re.Pattern) -> list:
+    return [segment for segment in pattern.split(text) if segment]
+
+def get_segment_pattern(tokenizer) -> Optional[re.Pattern]:
+    """
+    The pattern that splits prompts into independently encodable segments, or None when
+    encoding segment by segment would not reproduce encoding the whole prompt (e.g.
+    special tokens that strip neighbouring whitespace, or prefix-space normalizers).
+    """
+    with _segment_patterns_lock:
+        if tokenizer in _segment_patterns:
+            return _segment_patterns[tokenizer]
+
+        pattern = special_token_pattern(tokenizer)
+        if pattern is not None:
+            for chat in SEGMENT_PROBE_CHATS:
+                rendered = attempt_difficult_chat_template(tokenizer, chat, tokenize=False, add_generation_prompt=True)
+                piecewise = [
+                    token_id
+                    for segment in split_on_special_tokens(rendered, pattern)
+                    for token_id in tokenizer.encode(segment, add_special_tokens=False)
+                ]
+                if piecewise != tokenizer.encode(rendered, add_special_tokens=False):
+                    pattern = None
+                    break
+
+        _segment_patterns[tokenizer] = pattern
+        return pattern
+
+def leading_bos_ids(tokenizer, rendered: str) -> list:
+    # Servers add BOS to text prompts themselves but take token arrays as given, so add it
+    # when the tokenizer would and the template didn't.
+    bos_token = tokenizer.bos_token
+    if not bos_token or rendered.startswith(bos_token):
+        return []
+
+    bos_ids = tokenizer.encode(bos_token, add_special_tokens=False)
+    default_ids = tokenizer.encode("a", add_special_tokens=True)
+    return bos_ids if len(bos_ids) == 1 and default_ids[:1] == bos_ids else []
+
+def plan_prompt_encoding(rendered: str, model_identifier: str) -> dict:
+    """How to encode a rendered prompt: its segments, or None to encode it whole."""
+    tokenizer = get_chat_tokenizer(model_identifier)
+    pattern = get_segment_pattern(tokenizer)
+
+    return {
+        "bos": leading_bos_ids(tokenizer, rendered),
+        "segments": split_on_special_tokens(rendered, pattern) if pattern is not None else None,
+    }
+
+def encode_segments(segments: list, model_identifier: str) -> list:
+    tokenizer = get_chat_tokenizer(model_identifier)
+    return tokenizer(segments, add_special_tokens=False)["input_ids"]
+
+def encode_prompt(rendered: str, model_identifier: str) -> list:
+    return get_chat_tokenizer(model_identifier).encode(rendered, add_special_tokens=False)
+
+def encode_with_offsets(tokenizer, text: str) -> tuple:
+    """Token IDs for `text` without added special tokens, and the character span of each."""
+    if hasattr(tokenizer, "encode_with_offsets"):
+        return tokenizer.encode_with_offsets(text)
+    if getattr(tokenizer, "is_fast", False):
+        encoded = tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)
+        return encoded["input_ids"], encoded["offset_mapping"]
+
+    raise TokenizationError("Training exports need a fast tokenizer (one with a tokenizer.json).")
+
+def assistant_spans(profile, messages: list, rendered: str, special_tokens: Optional[re.Pattern]) -> list:
+    """
+    Character spans of the assistant turns in `rendered`, the whole of `messages` as the
+    template saw them. Each is what rendering the chat through the turn adds to rendering
+    it up to the turn with a generation prompt, so role headers and text the template
+    injects stay out, and the template's own end-of-turn token is in so a model trained
+    on the spans learns to stop. A template that leaves a final turn open gets the special
+    token closing it in the whole chat instead. Turns the template renders differently
+    once later turns follow are left out.
+    """
+    spans = []
+    for i, message in enumerate(messages):
+        if message["role"] != "assistant":
+            continue
+
+        try:
+            before = profile.render(messages[:i], add_generation_prompt=True)
+            through = profile.render(messages[:i + 1]).rstrip()
+        except Exception:
+            continue
+        if not through.startswith(before) or not rendered.startswith(through) or len(through) == len(before):
+            continue
+
+        end = len(through)
+        content = message["content"].strip()
+        if special_tokens is not None and content and through.endswith(content):
+            following = rendered[end:]
+            closing = special_tokens.match(following.lstrip(" \t\n"))
+            if closing:
+                end += len(following) - len(following.lstrip(" \t\n")) + len(closing.group())
+        spans.append((len(before), end))
+
+    return spans
+
+def tokenize_training_chats(chats: list, model_identifier: str) -> list:
+    """
+    Templated token IDs and an assistant-only loss mask for each chat, as int32 and byte
+    strings so the results come back from a worker process cheaply.
+    """
+    tokenizer = get_chat_tokenizer(model_identifier)
+    profile = get_template_profile(tokenizer)
+    special_tokens = special_token_pattern(tokenizer)
+
+    results = []
+    for chat in chats:
+        messages, rendered = render_chat(tokenizer, chat)
+        spans = assistant_spans(profile, messages, rendered, special_tokens)
+        token_ids, offsets = encode_with_offsets(tokenizer, rendered)
+
+        loss_mask = bytearray(len(token_ids))
+        span = 0
+        for position, (start, end) in enumerate(offsets):
+            while span < len(spans) and spans[span][1] <= start:
+                span += 1
+            if span < len(spans) and end > spans[span][0]:
+                loss_mask[position] = 1
+
+        bos_ids = leading_bos_ids(tokenizer, rendered)
+        results.append((array("i", bos_ids + list(token_ids)).tobytes(), bytes(len(bos_ids)) + bytes(loss_mask)))
+
+    return results
+
+WARMUP_MESSAGES = [{"role": "system", "content": "Warm-up."}, {"role": "user", "content": "Hello!"}]
+
+def warm_up_tokenizer(model_identifier: str) -> dict:
+    """
+    Loads a tokenizer without touching the hub and runs one templated encode, so the
+    template is compiled and probed before the first real request needs it.
+    """
+    start = time.perf_counter()
+    tokenizer = tokenizer_registry.get(model_identifier, loader=load_tokenizer_offline)
+    loaded = time.perf_counter()
+    attempt_difficult_chat_template(tokenizer, WARMUP_MESSAGES, tokenize=True)
+
+    return {"load_time": loaded - start, "warmup_time": time.perf_counter() - loaded}
+
+def tokenizer_fingerprint(model_identifier: str) -> str:
+    """Identifies the tokenizer and chat template that token counts for a model depend on."""
+    tokenizer = get_chat_tokenizer(model_identifier)
+    payload = json.dumps([
+        model_identifier,
+        tokenizer.chat_template or CHATML_TEMPLATE,
+        tokenizer.bos_token,
+        tokenizer.eos_token,
+        len(tokenizer),
+    ], default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+_fingerprints = {}
+
+async def get_template_identity(model_identifier: str) -> str:
+    if model_identifier not in _fingerprints:
+        _fingerprints[model_identifier] = await run_tokenization(tokenizer_fingerprint, model_identifier)
+    return _fingerprints[model_identifier]
+
+def content_hash(messages: list) -> str:
+    payload = json.dumps([[message["role"], message["content"]] for message in messages], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def message_cache_key(message_hash, template_identity):
+    return f"tokens:{template_identity}:{message_hash}"
+
+def load_durable_counts(db: Session, messages: list, hashes: list, model_identifier: str) -> dict:
+    """Looks up stored counts for messages that exist in the database, keyed by (id, hash)."""
+    message_ids = {message["id"] for message in messages if "id" in message}
+    if not message_ids:
+        return {}
+
+    rows = db.query(MessageTokenCount).filter(
+        MessageTokenCount.model_identifier == model_identifier,
+        MessageTokenCount.message_id.in_(message_ids),
+        MessageTokenCount.content_hash.in_(set(hashes))
+    ).all()
+
+    return {(row.message_id, row.content_hash): row.token_count for row in rows}
+
+def store_durable_counts(db: Session, rows: list):
+    if not rows:
+        return
+
+    db.execute(insert(MessageTokenCount).values(rows).on_conflict_do_nothing())
+    db.commit()
+
+async def count_messages_cached(messages: list, model_identifier: str, redis: aioredis, db: Optional[AsyncSession] = None) -> list:
+    """
+    Per-message templated token counts, cached by rendered content and template identity.
+    Edited messages or swapped personas render differently and so land on new keys; nothing
+    ever has to be invalidated.
+
+    Redis is checked first, then (for messages with an id, when a session is given) the
+    message_token_count table, and only what is left gets tokenized.
+    """
+    if not messages:
+        return []
+
+    template_identity = await get_template_identity(model_identifier)
+    # Hash before tokenizing; the template fallback may rewrite roles in place.
+    hashes = [content_hash([message]) for message in messages]
+    keys = [message_cache_key(message_hash, template_identity) for message_hash in hashes]
+    cached_values = await cache_get_many(redis, keys)
+
+    counts = [int(value) if value is not None else None for value in cached_values]
+    uncached_indices = [index for index, count in enumerate(counts) if count is None]
+
+    if uncached_indices and db is not None:
+        durable_counts = await db.run_sync(
+            load_durable_counts,
+            [messages[index] for index in uncached_indices],
+            [hashes[index] for index in uncached_indices],
+            model_identifier
+        )
+
+        for index in uncached_indices:
+            if "id" in messages[index]:
+                counts[index] = durable_counts.get((messages[index]["id"], hashes[index]))
+
+    to_tokenize = [index for index in uncached_indices if counts[index] is None]
+
+    if to_tokenize:
+        tokenized_counts = await run_tokenization(
+            count_message_tokens,
+            [messages[index] for index in to_tokenize],
+            model_identifier
+        )
+
+        for index, count in zip(to_tokenize, tokenized_counts):
+            counts[index] = count
+
+        if db is not None:
+            await db.run_sync(store_durable_counts, [
+                {
+                    "message_id": messages[index]["id"],
+                    "model_identifier": model_identifier,
+                    "content_hash": hashes[index],
+                    "token_count": counts[index],
+                }
+                for index in to_tokenize
+                if "id" in messages[index]
+            ])
+
+    await cache_set_many(redis, {keys[index]: counts[index] for index in uncached_indices})
+
+    return counts
+
+async def count_chats_cached(chats: list, model_identifier: str, redis: aioredis) -> list:
+    """
+    Templated token counts for whole chats (system message, author's note, example block),
+    cached like count_messages_cached. A one-message chat counts the same as that message
+    alone, so the two share keys.
+    """
+    if not chats:
+        return []
+
+    template_identity = await get_template_identity(model_identifier)
+    keys = [message_cache_key(content_hash(chat), template_identity) for chat in chats]
+    cached_values = await cache_get_many(redis, keys)
+
+    counts = [int(value) if value is not None else None for value in cached_values]
+    uncached_indices = [index for index, count in enumerate(counts) if count is None]
+
+    if uncached_indices:
+        tokenized_counts = await run_tokenization(count_chat_tokens, [chats[index] for index in uncached_indices], model_identifier)
+        for index, count in zip(uncached_indices, tokenized_counts):
+            counts[index] = count
+
+        await cache_set_many(redis, {keys[index]: counts[index] for index in uncached_indices})
+
+    return counts
+
+def pack_token_ids(token_ids: list) -> str:
+    # uint32s, base64'd for the text-mode Redis client: about 5.3 bytes a token.
+    return base64.b64encode(array("I", token_ids).tobytes()).decode("ascii")
+
+def unpack_token_ids(value: str) -> list:
+    return array("I", base64.b64decode(value)).tolist()
+
+def token_ids_cache_key(segment: str, template_identity: str) -> str:
+    return f"token_ids:{template_identity}:{hashlib.sha256(segment.encode('utf-8')).hexdigest()}"
+
+async def tokenize_prompt_cached(rendered: str, model_identifier: str, redis: aioredis) -> list:
+    """
+    Token IDs for a rendered prompt, assembled from cached ID arrays of its segments (the
+    text between special tokens, so mostly one segment per message plus template glue).
+    Only segments not seen before get encoded.
+    """
+    plan = await run_tokenization(plan_prompt_encoding, rendered, model_identifier)
+    if plan["segments"] is None:
+        return plan["bos"] + await run_tokenization(encode_prompt, rendered, model_identifier)
+
+    template_identity = await get_template_identity(model_identifier)
+    segments = plan["segments"]
+    unique_segments = list(dict.fromkeys(segments))
+    keys = [token_ids_cache_key(segment, template_identity) for segment in unique_segments]
+    cached_values = await cache_get_many(redis, keys)
+
+    segment_ids = {
+        segment: unpack_token_ids(value)
+        for segment, value in zip(unique_segments, cached_values)
+        if value is not None
+    }
+    missing = [segment for segment in unique_segments if segment not in segment_ids]
+
+    if missing:
+        encoded = await run_tokenization(encode_segments, missing, model_identifier)
+        segment_ids.update(zip(missing, encoded))
+        await cache_set_many(redis, {
+            token_ids_cache_key(segment, template_identity): pack_token_ids(segment_ids[segment])
+            for segment in missing
+        })
+
+    token_ids = list(plan["bos"])
+    for segment in segments:
+        token_ids.extend(segment_ids[segment])
+    return token_ids
+
+def prompt_prefix_hash(model_identifier: str, prefix_messages: list, authors_note: Optional[str], authors_note_loc: Optional[int]) -> str:
+    payload = json.dumps([
+        model_identifier,
+        [[message["role"], message["content"]] for message in prefix_messages],
+        authors_note,
+        authors_note_loc,
+    ], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
 
 async def apply_template_with_context_limit(
     messages: list,
@@ -99,65 +642,81 @@ async def apply_template_with_context_limit(
     redis: aioredis,
     example_messages: list = [],
     authors_note: Optional[str] = None,
-    authors_note_loc: Optional[int] = None
+    authors_note_loc: Optional[int] = None,
+    db: Optional[AsyncSession] = None,
+    conversation_id: Optional[int] = None,
+    shift_mode: str = CONTEXT_SHIFT_MODE,
+    older_message_count: int = 0,
+    include_token_ids: bool = False
 ):
-    try:
-        tokenizer = AutoTokenizer.from_pretrained(model_identifier)
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=f"Error loading tokenizer: {str(e)}")
-    
-    if not hasattr(tokenizer, "apply_chat_template"):
-        raise HTTPException(status_code=400, detail="Tokenizer does not support apply_chat_template")
-
-    # Tokenize system message and postfix
+    # `older_message_count` is history older than `messages[1:]` that the caller never
+    # loaded because the messages it did load already fill the context; it counts as shifted.
+    # Tokenize system message, author's note and example block in one job.
     system_message = messages[0]
-    templated_system_message = attempt_difficult_chat_template(tokenizer, [system_message], tokenize=True, add_generation_prompt=False)
-    system_tokens = len(templated_system_message)
-    current_context_tokens = system_tokens
+    fixed_chats = [[system_message]]
 
+    authors_note_message = None
     if authors_note and authors_note_loc:
         authors_note_message = {
             "role": "system",
             "content": authors_note
         }
-        templated_an_message = attempt_difficult_chat_template(tokenizer, [authors_note_message], tokenize=True, add_generation_prompt=False)
-        authors_note_tokens = len(templated_an_message)
+        fixed_chats.append([authors_note_message])
+
+    if len(example_messages) > 0:
+        fixed_chats.append(example_messages)
+
+    fixed_counts = await count_chats_cached(fixed_chats, model_identifier, redis)
+    system_tokens = fixed_counts[0]
+    current_context_tokens = system_tokens
+
+    if authors_note_message:
+        authors_note_tokens = fixed_counts[1]
         current_context_tokens = current_context_tokens + authors_note_tokens
 
     # Take off 50 toks for generation prompt & postfix.
     context_budget_remaining = max_context - current_context_tokens - max_length - 50 
 
-    included_messages = []
-
-    # Process chat messages backward
-    shifted_messages = []
-    for message in reversed(messages[1:]):
-        if "id" in message:
-            message_cache_key = f"prompt:message:{message['id']}:{model_identifier}"
-            cached_message = await redis.get(message_cache_key)
-
-            if cached_message:
-                message_tokens = int(cached_message)
-            else:
-                message_text = attempt_difficult_chat_template(tokenizer, [message], tokenize=True, add_generation_prompt=False)
-                message_tokens = len(message_text)
-                await cache_message(redis, message, message_tokens, model_identifier)
-        else:
-            message_text = attempt_difficult_chat_template(tokenizer, [message], tokenize=True, add_generation_prompt=False)
-            message_tokens = len(message_text)
-
-        if context_budget_remaining >= message_tokens:
-            included_messages.append(message)
-            context_budget_remaining -= message_tokens
-        else:
-            shifted_messages.append(message)
-            context_budget_remaining = 0
-
-    included_messages.reverse()
+    # In chunked mode the example block belongs to the fixed prefix instead of filling
+    # whatever space the history leaves, which would change from turn to turn.
+    chunked = shift_mode == "chunked"
+    include_examples = False
+    if chunked and len(example_messages) > 0 and context_budget_remaining >= fixed_counts[-1]:
+        include_examples = True
+        context_budget_remaining -= fixed_counts[-1]
 
-    if len(example_messages) > 0:
-        example_tokens = attempt_difficult_chat_template(tokenizer, example_messages, tokenize=True, add_generation_prompt=False)
-        example_tokens = len(example_tokens)
+    chat_messages = messages[1:]
+    message_token_counts = await count_messages_cached(chat_messages, model_identifier, redis, db)
+    prefix = prefix_sums(message_token_counts)
+
+    shift_state = None
+    if chunked:
+        # Keep the previous cutoff while the history after it still fits.
+        if conversation_id is not None:
+            shift_state = await load_shift_state(redis, conversation_id, model_identifier)
+        message_ids = [message.get("id") for message in chat_messages]
+        previous_cutoff = None
+        if shift_state and shift_state["message_id"] in message_ids:
+            previous_cutoff = message_ids.index(shift_state["message_id"])
+
+        chunk = int(max(context_budget_remaining, 0) * CONTEXT_SHIFT_CHUNK)
+        cutoff = fit_suffix_chunked(prefix, context_budget_remaining, chunk, previous_cutoff)
+    else:
+        # Keep the longest run of recent messages that fits; everything before it is shifted.
+        cutoff = fit_suffix(prefix, context_budget_remaining)
+
+    included_messages = chat_messages[cutoff:]
+    shifted_message_count = older_message_count + cutoff
+
+    if shifted_message_count:
+        context_budget_remaining = 0
+    else:
+        context_budget_remaining -= prefix[-1]
+
+    if include_examples:
+        included_messages = example_messages + included_messages
+    elif len(example_messages) > 0 and not chunked:
+        example_tokens = fixed_counts[-1]
 
         if context_budget_remaining >= example_tokens:
             included_messages = example_messages + included_messages
@@ -165,22 +724,38 @@ async def apply_template_with_context_limit(
 
     included_messages.insert(0, system_message)
 
-    if authors_note and authors_note_loc:
-        authors_note_message = {
-            "role": "system",
-            "content": authors_note
-        }
+    # Everything up to the first kept history message stays the same until the next shift.
+    prefix_length = len(included_messages) - len(chat_messages) + cutoff + 1
+    prefix_hash = prompt_prefix_hash(model_identifier, included_messages[:prefix_length], authors_note if authors_note_message else None, authors_note_loc)
+
+    if authors_note_message:
         included_messages.insert(authors_note_loc, authors_note_message)
 
-    chat_history = attempt_difficult_chat_template(tokenizer, included_messages, tokenize=False, add_generation_prompt=True)
+    prefix_reused = None
+    if chunked:
+        prefix_reused = bool(shift_state) and shift_state.get("prefix_hash") == prefix_hash
+        if conversation_id is not None:
+            await save_shift_state(redis, conversation_id, model_identifier, {
+                "message_id": chat_messages[cutoff].get("id") if cutoff < len(chat_messages) else None,
+                "prefix_hash": prefix_hash,
+            })
+
+    chat_history, eos_token = await run_tokenization(render_chat_history, included_messages, model_identifier)
     chat_history_with_postfix = f"{chat_history}{postfix}"
 
-    eos_token = '<|im_end|>'
-    if tokenizer.chat_template:
-        eos_token = tokenizer.eos_token
+    prompt_token_ids = None
+    if include_token_ids:
+        prompt_token_ids = await tokenize_prompt_cached(chat_history_with_postfix, model_identifier, redis)
 
     return {
         "history": chat_history_with_postfix,
+        "prompt_token_ids": prompt_token_ids,
         "eos_token": eos_token,
-        "shifted_messages": shifted_messages
-    }
\ No newline at end of file
+        "shifted_message_count": shifted_message_count,
+        "shift": {
+            "mode": shift_mode,
+            "cutoff": cutoff,
+            "prefix_hash": prefix_hash,
+            "prefix_reused": prefix_reused,
+        }
+    }
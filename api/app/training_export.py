@@ -0,0 +1,189 @@
+import asyncio
+import json
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import AsyncIterator, Optional
+import numpy as np
+from app.tokens import tokenize_training_chats
+
+# Where training exports are written, one directory per export.
+TRAINING_EXPORT_DIR = os.getenv("TRAINING_EXPORT_DIR", "training_exports")
+# Processes tokenizing an export.
+TRAINING_EXPORT_WORKERS = int(os.getenv("TRAINING_EXPORT_WORKERS", os.cpu_count() or 2))
+# Rows of max_seq_length tokens per shard.
+TRAINING_SHARD_ROWS = int(os.getenv("TRAINING_SHARD_ROWS", 1024))
+# Longest max_seq_length an export may ask for; a shard's arrays take 10 bytes per row token.
+TRAINING_MAX_SEQ_LENGTH = int(os.getenv("TRAINING_MAX_SEQ_LENGTH", 32768))
+
+COLUMNS = {
+    "input_ids": np.int32,
+    "attention_mask": np.uint8,
+    "loss_mask": np.uint8,
+    "position_ids": np.int32,
+}
+SEGMENT_DTYPE = np.dtype([
+    ("conversation_id", np.int64),
+    ("row", np.int32),
+    ("offset", np.int32),
+    ("length", np.int32),
+    ("truncated", np.bool_),
+])
+
+# Exports started by this process, by ID.
+training_exports = {}
+
+class ShardWriter:
+    """
+    Lays tokenized conversations out in fixed-width rows and writes them as shards of
+    .npy files, which trainers can open with np.load(mmap_mode="r").
+
+    Each shard is a directory holding one [rows, max_seq_length] array per column in
+    COLUMNS, a segments.npy saying where each conversation sits, and a metadata.jsonl
+    with each segment's tags and character. With packing, conversations share a row
+    until the next one doesn't fit, and position_ids restart at each conversation so
+    attention can be kept within it. Conversations longer than a row are truncated.
+    """
+
+    def __init__(self, directory: str, max_seq_length: int, packing: bool = True, shard_rows: int = TRAINING_SHARD_ROWS):
+        self.directory = directory
+        self.max_seq_length = max_seq_length
+        self.packing = packing
+        self.shard_rows = shard_rows
+
+        self.shards = []
+        self.conversations = 0
+        self.truncated = 0
+        self._reset()
+
+    def _reset(self):
+        self._columns = {name: np.zeros((self.shard_rows, self.max_seq_length), dtype=dtype) for name, dtype in COLUMNS.items()}
+        self._segments = []
+        self._metadata = []
+        self._row = -1
+        self._fill = self.max_seq_length
+
+    def add(self, token_ids: np.ndarray, loss_mask: np.ndarray, metadata: dict):
+        length = min(len(token_ids), self.max_seq_length)
+        if length == 0:
+            return
+
+        if not self.packing or self._fill + length > self.max_seq_length:
+            if self._row + 1 == self.shard_rows:
+                self.flush()
+            self._row += 1
+            self._fill = 0
+
+        row, offset = self._row, self._fill
+        window = slice(offset, offset + length)
+        self._columns["input_ids"][row, window] = token_ids[:length]
+        self._columns["attention_mask"][row, window] = 1
+        self._columns["loss_mask"][row, window] = loss_mask[:length]
+        self._columns["position_ids"][row, window] = np.arange(length)
+        self._fill += length
+
+        truncated = len(token_ids) > length
+        self._segments.append((metadata["conversation_id"], row, offset, length, truncated))
+        self._metadata.append(metadata)
+        self.conversations += 1
+        self.truncated += truncated
+
+    def flush(self):
+        rows = self._row + 1
+        if rows == 0:
+            return
+
+        name = f"shard-{len(self.shards):05d}"
+        path = os.path.join(self.directory, name)
+        os.makedirs(path, exist_ok=True)
+        for column, values in self._columns.items():
+            np.save(os.path.join(path, f"{column}.npy"), values[:rows])
+        np.save(os.path.join(path, "segments.npy"), np.array(self._segments, dtype=SEGMENT_DTYPE))
+        with open(os.path.join(path, "metadata.jsonl"), "w") as f:
+            for metadata in self._metadata:
+                f.write(json.dumps(metadata) + "\n")
+
+        self.shards.append({
+            "path": name,
+            "rows": rows,
+            "tokens": int(self._columns["attention_mask"][:rows].sum(dtype=np.int64)),
+            "loss_tokens": int(self._columns["loss_mask"][:rows].sum(dtype=np.int64)),
+        })
+        self._reset()
+
+    def close(self, manifest: dict) -> dict:
+        """Writes the last shard and then manifest.json, whose presence marks the export complete."""
+        self.flush()
+        manifest = {
+            **manifest,
+            "max_seq_length": self.max_seq_length,
+            "packing": self.packing,
+            "columns": {name: np.dtype(dtype).name for name, dtype in COLUMNS.items()},
+            "conversations": self.conversations,
+            "truncated": self.truncated,
+            "shards": self.shards,
+        }
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, "manifest.json"), "w") as f:
+            json.dump(manifest, f, indent=2)
+        return manifest
+
+async def write_training_shards(
+    chat_batches: AsyncIterator,
+    model_identifier: str,
+    directory: str,
+    max_seq_length: int,
+    packing: bool = True,
+    workers: int = TRAINING_EXPORT_WORKERS,
+) -> dict:
+    """
+    Tokenizes batches of (metadata, chat) pairs across `workers` processes and writes
+    them in order with a ShardWriter. A few batches per worker are in flight at once,
+    so memory stays flat while the database, the workers and the writer keep busy. The
+    writer and the pool's shutdown run in a thread, off the event loop.
+    """
+    writer = ShardWriter(directory, max_seq_length, packing)
+    loop = asyncio.get_running_loop()
+    pending = deque()
+
+    def write(metadata: list, results: list):
+        for entry, (token_ids, loss_mask) in zip(metadata, results):
+            writer.add(np.frombuffer(token_ids, dtype=np.int32), np.frombuffer(loss_mask, dtype=np.uint8), entry)
+
+    async def write_next():
+        metadata, future = pending.popleft()
+        results = await future
+        await loop.run_in_executor(None, write, metadata, results)
+
+    executor = ProcessPoolExecutor(max_workers=workers)
+    try:
+        async for batch in chat_batches:
+            if not batch:
+                continue
+            metadata = [entry for entry, _ in batch]
+            chats = [chat for _, chat in batch]
+            pending.append((metadata, loop.run_in_executor(executor, tokenize_training_chats, chats, model_identifier)))
+
+            while len(pending) > workers * 2:
+                await write_next()
+
+        while pending:
+            await write_next()
+    except BaseException:
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+
+    await loop.run_in_executor(None, executor.shutdown)
+    return await loop.run_in_executor(None, writer.close, {"model_identifier": model_identifier})
+
+def load_training_export(export_id: str) -> Optional[dict]:
+    """An export's status, from memory while it runs and from its manifest once done."""
+    if export_id in training_exports:
+        return training_exports[export_id]
+
+    manifest_path = os.path.join(TRAINING_EXPORT_DIR, export_id, "manifest.json")
+    if os.path.isfile(manifest_path):
+        with open(manifest_path) as f:
+            return {"status": "done", "manifest": json.load(f)}
+
+    return None
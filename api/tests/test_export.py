@@ -0,0 +1,87 @@
+import asyncio
+import json
+import numpy as np
+import pytest
+from types import SimpleNamespace
+from app.api import preference_records
+from app.token_pool import TokenizationError
+from app.training_export import ShardWriter, write_training_shards
+
+def make_message(id, author, content, rejected=None, variants=None, content_variant_index=None, rejected_variant_index=None):
+    return SimpleNamespace(
+        id=id,
+        author=author,
+        content=content,
+        rejected=rejected,
+        variants=variants,
+        content_variant_index=content_variant_index,
+        rejected_variant_index=rejected_variant_index,
+    )
+
+conversation = SimpleNamespace(id=1, character=None, persona=None, prompt=None)
+messages = [
+    make_message(1, "user", "Hi {{char}}"),
+    make_message(2, "assistant", "Hello", rejected="Go away", variants=["Hello", "Go away", "Hey"], content_variant_index=0, rejected_variant_index=1),
+    make_message(3, "user", "How are you?", variants=["How are you?", "Sup?"], content_variant_index=0),
+    make_message(4, "assistant", "unused", variants=["Bad", "Good"], content_variant_index=1),
+]
+
+def test_dpo_pairs():
+    records = [json.loads(record) for record in preference_records(conversation, [], messages)]
+
+    assert [(record["chosen"][0]["content"], record["rejected"][0]["content"]) for record in records] == [
+        ("Hello", "Go away"),
+        ("Hello", "Hey"),
+        ("Good", "Bad"),
+    ]
+    assert records[0]["prompt"] == [{"role": "user", "content": "Hi assistant"}]
+    assert records[2]["prompt"] == [
+        {"role": "user", "content": "Hi assistant"},
+        {"role": "assistant", "content": "Hello"},
+        {"role": "user", "content": "How are you?"},
+    ]
+
+def test_orpo_pairs_have_implicit_prompt():
+    records = [json.loads(record) for record in preference_records(conversation, [], messages, implicit_prompt=True)]
+
+    assert "prompt" not in records[2]
+    assert records[2]["chosen"][:-1] == records[2]["rejected"][:-1]
+    assert records[2]["chosen"][-1] == {"role": "assistant", "content": "Good"}
+    assert records[2]["rejected"][-1] == {"role": "assistant", "content": "Bad"}
+
+def test_shard_writer_packs_rows(tmp_path):
+    writer = ShardWriter(str(tmp_path), max_seq_length=8, packing=True, shard_rows=2)
+    for conversation_id, length in [(1, 3), (2, 4), (3, 5), (4, 12)]:
+        writer.add(np.arange(1, length + 1, dtype=np.int32), np.ones(length, dtype=np.uint8), {"conversation_id": conversation_id})
+    manifest = writer.close({})
+
+    assert [shard["rows"] for shard in manifest["shards"]] == [2, 1]
+    assert manifest["truncated"] == 1
+
+    input_ids = np.load(tmp_path / "shard-00000" / "input_ids.npy", mmap_mode="r")
+    position_ids = np.load(tmp_path / "shard-00000" / "position_ids.npy", mmap_mode="r")
+    assert input_ids[0].tolist() == [1, 2, 3, 1, 2, 3, 4, 0]
+    assert position_ids[0].tolist() == [0, 1, 2, 0, 1, 2, 3, 0]
+    segments = np.load(tmp_path / "shard-00001" / "segments.npy")
+    assert segments.tolist() == [(4, 0, 0, 8, True)]
+
+def test_long_conversation_without_pairs_encodes_each_message_once(monkeypatch):
+    long_messages = [make_message(id, "user" if id % 2 else "assistant", "x" * 1000) for id in range(2000)]
+    dumps = json.dumps
+    calls = []
+    monkeypatch.setattr(json, "dumps", lambda *args, **kwargs: calls.append(args) or dumps(*args, **kwargs))
+
+    records = list(preference_records(conversation, [], long_messages))
+
+    assert records == []
+    # Each message is encoded once; nothing re-encodes or re-joins the history per message.
+    assert len(calls) == len(long_messages)
+
+def test_worker_errors_reach_the_export(tmp_path):
+    async def batches():
+        yield [({"conversation_id": 1}, [{"role": "user", "content": "Hi"}])]
+
+    # The worker's exception has to survive pickling, or the pool breaks instead.
+    with pytest.raises(TokenizationError) as error:
+        asyncio.run(write_training_shards(batches(), "/nonexistent/model", str(tmp_path), 8, workers=1))
+    assert "/nonexistent/model" in str(error.value)
@@ -0,0 +1,294 @@
+import asyncio
+import json
+import httpx
+import pytest
+from fastapi import HTTPException
+from app.backend_router import BackendRouter
+from app.generation import generate_candidates, set_http_client, stream_completion
+from app import generation
+from app.generation_scheduler import GenerationCancelled, GenerationScheduler
+
+class FakePreset:
+    def __init__(self, engine, api_key=None, backend_urls=None):
+        self.engine = engine
+        self.llm_url = "http://llm.local/"
+        self.backend_urls = backend_urls or [self.llm_url]
+        self.api_key = api_key
+        self.max_context = 4096
+        self.samplers = {"temperature": 0.8, "max_tokens": 64, "top_k": 0, "repetition_penalty": 1.1}
+        self.sampler_order = [6, 0, 1]
+
+def sse(*payloads):
+    return "".join(f"data: {payload}\n\n" for payload in payloads).encode("utf-8")
+
+class StubLLMServer:
+    """Answers like koboldcpp on its kobold route and like an OpenAI-style server elsewhere."""
+
+    def __init__(self):
+        self.requests = []
+        self.down_hosts = set()
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request)
+
+        if request.url.host in self.down_hosts:
+            return httpx.Response(503, text="Loading model")
+
+        if request.url.path == "/v1/models":
+            return httpx.Response(200, json={"data": [{"id": "served-model"}]})
+
+        if request.url.path == "/api/extra/generate/stream":
+            body = sse(
+                json.dumps({"token": "Hel", "finish_reason": None}),
+                json.dumps({"token": "lo", "finish_reason": "stop"}),
+            )
+            return httpx.Response(200, content=body, headers={"Content-Type": "text/event-stream"})
+
+        if request.url.path == "/v1/completions" and json.loads(request.content).get("n", 1) > 1:
+            # Choices stream interleaved and finish in reverse order.
+            n = json.loads(request.content)["n"]
+            body = sse(
+                *[json.dumps({"choices": [{"index": i, "text": f"Reply {i}", "finish_reason": None}]}) for i in range(n)],
+                *[json.dumps({"choices": [{"index": i, "text": ".", "finish_reason": "stop"}]}) for i in reversed(range(n))],
+                "[DONE]",
+            )
+            return httpx.Response(200, content=body, headers={"Content-Type": "text/event-stream"})
+
+        if request.url.path == "/v1/completions":
+            body = sse(
+                json.dumps({"choices": [{"text": "Hel", "finish_reason": None}]}),
+                json.dumps({"choices": [{"text": "lo", "finish_reason": "length"}], "timings": {"prompt_n": 4, "cache_n": 12}}),
+                "[DONE]",
+            )
+            return httpx.Response(200, content=body, headers={"Content-Type": "text/event-stream"})
+
+        return httpx.Response(404)
+
+@pytest.fixture
+def stub_server():
+    server = StubLLMServer()
+    set_http_client(httpx.AsyncClient(transport=httpx.MockTransport(server)))
+    yield server
+    set_http_client(None)
+
+def collect(preset, prompt="Hi", prompt_token_ids=None):
+    async def run():
+        return [event async for event in stream_completion(preset, prompt, ["\nBob:"], prompt_token_ids)]
+    return asyncio.run(run())
+
+# Test: Kobold requests use kobold sampler names and parse token events
+def test_stream_completion_kobold(stub_server):
+    events = collect(FakePreset("kobold"))
+    payload = json.loads(stub_server.requests[0].content)
+
+    assert events == [("Hel", None), ("lo", "stop")]
+    assert stub_server.requests[0].url.path == "/api/extra/generate/stream"
+    assert payload["max_length"] == 64
+    assert payload["rep_pen"] == 1.1
+    assert payload["stopping_strings"] == ["\nBob:"]
+
+# Test: llama.cpp gets OpenAI-style requests and token arrays when available
+def test_stream_completion_llamacpp(stub_server):
+    events = collect(FakePreset("llamacpp"), prompt_token_ids=[1, 2, 3])
+    payload = json.loads(stub_server.requests[0].content)
+
+    assert events == [("Hel", None), ("lo", "length")]
+    assert payload["prompt"] == [1, 2, 3]
+    assert payload["max_tokens"] == 64
+    assert payload["stop"] == ["\nBob:"]
+
+# Test: Tabby sends its API key and refuses to run without one
+def test_stream_completion_tabby(stub_server):
+    collect(FakePreset("tabby", api_key="secret"), prompt_token_ids=[1, 2, 3])
+
+    assert stub_server.requests[0].headers["x-api-key"] == "secret"
+    assert json.loads(stub_server.requests[0].content)["prompt"] == "Hi"
+
+    with pytest.raises(HTTPException):
+        collect(FakePreset("tabby"))
+
+# Test: Aphrodite looks up the served model once and drops sampler_order
+def test_stream_completion_aphrodite(stub_server):
+    collect(FakePreset("aphrodite"))
+    collect(FakePreset("aphrodite"))
+    paths = [request.url.path for request in stub_server.requests]
+    payload = json.loads(stub_server.requests[-1].content)
+
+    assert paths == ["/v1/models", "/v1/completions", "/v1/completions"]
+    assert payload["model"] == "served-model"
+    assert payload["top_k"] == -1
+    assert "sampler_order" not in payload
+
+def collect_candidates(preset, n):
+    async def run():
+        return [candidate async for candidate in generate_candidates(preset, "Hi", ["\nBob:"], n)]
+    return asyncio.run(run())
+
+# Test: Engines with `n` get one request whose choices are split by index
+def test_generate_candidates_batched(stub_server):
+    candidates = collect_candidates(FakePreset("tabby", api_key="secret"), 3)
+
+    assert len(stub_server.requests) == 1
+    assert json.loads(stub_server.requests[0].content)["n"] == 3
+    assert [(c["index"], c["text"], c["finish_reason"]) for c in candidates] == [
+        (2, "Reply 2.", "stop"),
+        (1, "Reply 1.", "stop"),
+        (0, "Reply 0.", "stop"),
+    ]
+
+# Test: Other engines get one concurrent request per candidate
+def test_generate_candidates_parallel(stub_server):
+    candidates = collect_candidates(FakePreset("kobold"), 3)
+
+    assert len(stub_server.requests) == 3
+    assert all("n" not in json.loads(request.content) for request in stub_server.requests)
+    assert sorted(c["index"] for c in candidates) == [0, 1, 2]
+    assert all(c["text"] == "Hello" and c["finish_reason"] == "stop" for c in candidates)
+
+# Test: A cancelled parallel batch raises once instead of yielding an error per candidate
+def test_generate_candidates_parallel_cancelled(monkeypatch):
+    async def cancelled(*args):
+        raise GenerationCancelled()
+    monkeypatch.setattr(generation, "complete", cancelled)
+
+    with pytest.raises(GenerationCancelled):
+        collect_candidates(FakePreset("kobold"), 3)
+
+# Test: One slot per backend, waiting requests start interactive-first, FIFO within a priority
+def test_scheduler_priorities():
+    scheduler = GenerationScheduler(default_slots=1, backend_slots={})
+    order = []
+
+    async def job(name, priority, gate=None):
+        async with scheduler.slot("http://llm/", priority):
+            order.append(name)
+            if gate:
+                await gate.wait()
+
+    async def run():
+        gate = asyncio.Event()
+        first = asyncio.create_task(job("first", "batch", gate))
+        await asyncio.sleep(0)
+        waiting = [
+            asyncio.create_task(job(name, priority))
+            for name, priority in [("batch", "batch"), ("autoplay", "autoplay"), ("chat-1", "interactive"), ("chat-2", "interactive")]
+        ]
+        await asyncio.sleep(0)
+        stats = scheduler.stats()["backends"]["http://llm"]
+        gate.set()
+        await asyncio.gather(first, *waiting)
+        return stats
+
+    stats = asyncio.run(run())
+
+    assert order == ["first", "chat-1", "chat-2", "autoplay", "batch"]
+    assert stats["active"] == 1
+    assert stats["queued"] == 4
+    assert stats["queued_by_priority"] == {"interactive": 2, "autoplay": 1, "batch": 1}
+    assert scheduler.stats()["backends"]["http://llm"]["completed"] == 5
+
+# Test: Cancelling by request ID works for queued and running generations
+def test_scheduler_cancel():
+    scheduler = GenerationScheduler(default_slots=1, backend_slots={}, queue_size=1)
+
+    async def endless():
+        while True:
+            await asyncio.sleep(0.01)
+            yield "token"
+
+    async def stream(request_id):
+        received = []
+        async with scheduler.slot("http://llm", "interactive", request_id) as job:
+            async for item in job.run(endless()):
+                received.append(item)
+        return received
+
+    async def run():
+        running = asyncio.create_task(stream("running"))
+        await asyncio.sleep(0.05)
+        queued = asyncio.create_task(stream("queued"))
+        await asyncio.sleep(0)
+
+        with pytest.raises(HTTPException) as full:
+            await stream("rejected")
+        assert full.value.status_code == 429
+
+        assert scheduler.cancel("queued")
+        with pytest.raises(GenerationCancelled):
+            await queued
+
+        assert scheduler.cancel("running")
+        with pytest.raises(GenerationCancelled):
+            await running
+        assert not scheduler.cancel("running")
+
+    asyncio.run(run())
+    stats = scheduler.stats()["backends"]["http://llm"]
+
+    assert (stats["active"], stats["queued"]) == (0, 0)
+    assert (stats["cancelled"], stats["rejected"], stats["completed"]) == (2, 1, 0)
+
+# Test: A cancel that lands between getting a slot and streaming stops the stream before it starts
+def test_scheduler_cancel_before_run():
+    scheduler = GenerationScheduler(default_slots=1, backend_slots={})
+    started = []
+
+    async def tokens():
+        started.append(True)
+        yield "token"
+
+    async def run():
+        async with scheduler.slot("http://llm", "interactive", "early") as job:
+            assert scheduler.cancel("early")
+            async for _ in job.run(tokens()):
+                pass
+
+    with pytest.raises(GenerationCancelled):
+        asyncio.run(run())
+    assert started == []
+    assert scheduler.stats()["backends"]["http://llm"]["cancelled"] == 1
+
+# Test: A conversation sticks to one backend, and fails over when that backend errors
+def test_backend_affinity_and_failover(stub_server, monkeypatch):
+    router = BackendRouter()
+    monkeypatch.setattr(generation, "backend_router", router)
+    urls = ["http://llm-a", "http://llm-b", "http://llm-c"]
+    preset = FakePreset("llamacpp", backend_urls=urls)
+    preset.llm_url = urls[0]
+
+    async def run(key):
+        return [event async for event in stream_completion(preset, "Hi", [], None, "interactive", None, key)]
+
+    for _ in range(3):
+        asyncio.run(run("conversation:1"))
+    hosts = {request.url.host for request in stub_server.requests}
+    assert len(hosts) == 1
+
+    [home] = hosts
+    stub_server.down_hosts.add(home)
+    assert asyncio.run(run("conversation:1"))[-1] == ("lo", "length")
+    moved = stub_server.requests[-1].url.host
+    assert moved != home
+
+    # It stays on the new backend even after the old one recovers.
+    stub_server.down_hosts.clear()
+    asyncio.run(run("conversation:1"))
+    assert stub_server.requests[-1].url.host == moved
+
+    stats = router.stats()["backends"]
+    assert stats[f"http://{home}"]["failures"] == 1
+    assert not stats[f"http://{home}"]["healthy"]
+    assert stats[f"http://{home}"]["affinity_hits"] == 2
+    assert stats[f"http://{moved}"]["prompt_tokens"] == 32
+    assert stats[f"http://{moved}"]["prompt_cache_hit_rate"] == 0.75
+
+# Test: A busy backend spills new requests to a less busy one
+def test_backend_spill():
+    router = BackendRouter()
+    urls = ["http://llm-a", "http://llm-b"]
+    home = router.route(urls, "conversation:1", {})[0]
+    other = next(url for url in urls if url != home)
+
+    assert router.route(urls, "conversation:1", {home: 1})[0] == home
+    assert router.route(urls, "conversation:1", {home: 5, other: 1})[0] == other
+    assert router.stats()["backends"][home]["spills"] == 1
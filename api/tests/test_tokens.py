@@ -0,0 +1,373 @@
+import asyncio
+import os
+import pytest
+import threading
+import time
+from fastapi import HTTPException
+from app.token_index import ConversationTokenIndex, fit_suffix, fit_suffix_chunked, prefix_sums
+from app.token_pool import TokenizerPool
+from app.chat_template import TemplateProfile
+from app.lightweight_tokenizer import load_lightweight_tokenizer
+import app.tokenizer_warmup as tokenizer_warmup
+import app.tokens as tokens
+from app.tokens import (
+    TokenizerRegistry,
+    attempt_difficult_chat_template,
+    count_message_tokens_batch,
+    get_segment_pattern,
+    pack_token_ids,
+    split_on_special_tokens,
+    tokenize_training_chats,
+    unpack_token_ids,
+)
+
+class FakeTokenizer:
+    def __init__(self, name, size=10):
+        self.name = name
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+class FakeChatTokenizer:
+    chat_template = "{% for message in messages %}<{{ message['role'] }}> {{ message['content'] }} {% endfor %}"
+    special_tokens_map = {}
+
+    def __init__(self):
+        self.encode_calls = 0
+
+    def __call__(self, texts, add_special_tokens=True):
+        self.encode_calls += 1
+        return {"input_ids": [text.split() for text in texts]}
+
+    def encode(self, text, add_special_tokens=True):
+        return text.split()
+
+# Test: Tokenizers are loaded once and served from memory afterwards
+def test_registry_caches_loaded_tokenizer():
+    loads = []
+    registry = TokenizerRegistry(loader=lambda name: loads.append(name) or FakeTokenizer(name), max_entries=2)
+
+    first = registry.get("model-a")
+    second = registry.get("model-a")
+
+    assert first is second
+    assert loads == ["model-a"]
+    assert registry.stats()["hits"] == 1
+    assert registry.stats()["misses"] == 1
+
+# Test: Least recently used tokenizer is evicted when the entry cap is hit
+def test_registry_evicts_least_recently_used():
+    registry = TokenizerRegistry(loader=FakeTokenizer, max_entries=2)
+
+    registry.get("model-a")
+    registry.get("model-b")
+    registry.get("model-a")
+    registry.get("model-c")
+
+    assert registry.stats()["loaded"] == ["model-a", "model-c"]
+    assert registry.stats()["evictions"] == 1
+
+# Test: Approximate memory budget evicts tokenizers too
+def test_registry_evicts_on_memory_budget():
+    registry = TokenizerRegistry(loader=FakeTokenizer, max_entries=0, max_bytes=15, sizer=len)
+
+    registry.get("model-a")
+    registry.get("model-b")
+
+    assert registry.stats()["loaded"] == ["model-b"]
+
+# Test: Concurrent requests for the same model share one load
+def test_registry_single_flight_load():
+    loads = []
+
+    def slow_loader(name):
+        loads.append(name)
+        time.sleep(0.05)
+        return FakeTokenizer(name)
+
+    registry = TokenizerRegistry(loader=slow_loader)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(registry.get("model-a"))) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert loads == ["model-a"]
+    assert all(result is results[0] for result in results)
+
+# Test: Batched counting encodes every message in a single call
+def test_count_message_tokens_batch():
+    tokenizer = FakeChatTokenizer()
+    messages = [
+        {"role": "user", "content": "hello there"},
+        {"role": "assistant", "content": "hi"},
+    ]
+
+    assert count_message_tokens_batch(tokenizer, messages) == [3, 2]
+    assert tokenizer.encode_calls == 1
+
+def slow_count(messages):
+    time.sleep(0.05)
+    return len(messages)
+
+# Test: Identical jobs queued at the same time share a single result
+def test_pool_shares_identical_jobs():
+    pool = TokenizerPool(workers=2, queue_size=8)
+
+    async def run():
+        return await asyncio.gather(*[pool.run(slow_count, ["a", "b"]) for _ in range(4)])
+
+    assert asyncio.run(run()) == [2, 2, 2, 2]
+    assert pool.stats()["submitted"] == 1
+    assert pool.stats()["shared"] == 3
+    pool.shutdown()
+
+# Test: A saturated pool rejects work with a 429
+def test_pool_rejects_when_full():
+    pool = TokenizerPool(workers=1, queue_size=1)
+
+    async def run():
+        return await asyncio.gather(
+            pool.run(slow_count, ["a"]),
+            pool.run(slow_count, ["b"]),
+            return_exceptions=True
+        )
+
+    results = asyncio.run(run())
+    assert results[0] == 1
+    assert isinstance(results[1], HTTPException)
+    assert results[1].status_code == 429
+    pool.shutdown()
+
+def crash_worker(code):
+    os._exit(code)
+
+# Test: Process workers report tokenizer errors as HTTPExceptions and survive a crashed worker
+def test_process_pool_errors_and_recovery():
+    pool = TokenizerPool(mode="process", workers=1, queue_size=4)
+
+    async def run():
+        return await asyncio.gather(
+            pool.run(tokens.get_tokenizer, "/nonexistent/model"),
+            return_exceptions=True
+        )
+
+    [error] = asyncio.run(run())
+    assert isinstance(error, HTTPException)
+    assert error.status_code == 400
+    assert "Error loading tokenizer" in error.detail
+
+    with pytest.raises(HTTPException) as crashed:
+        asyncio.run(pool.run(crash_worker, 1))
+    assert crashed.value.status_code == 503
+
+    assert asyncio.run(pool.run(slow_count, ["a", "b"])) == 2
+    pool.shutdown()
+
+# Test: Token index keeps totals in step with incremental updates
+def test_token_index_incremental_updates():
+    index = ConversationTokenIndex([1, 2, 3], [10, 20, 30], overhead=1)
+    assert index.total == 61
+
+    index.append(4, 5)
+    index.set_count(2, 25)
+    index.remove(1)
+
+    assert index.message_ids == [2, 3, 4]
+    assert index.counts == [25, 30, 5]
+    assert index.total == 61
+    assert ConversationTokenIndex.from_json(index.to_json()).counts == index.counts
+
+# Test: Context fitting keeps the longest suffix that fits the budget
+def test_fit_suffix():
+    prefix = prefix_sums([10, 20, 30, 40])
+
+    assert fit_suffix(prefix, 100) == 0
+    assert fit_suffix(prefix, 75) == 2
+    assert fit_suffix(prefix, 70) == 2
+    assert fit_suffix(prefix, 39) == 4
+    assert fit_suffix(prefix, -5) == 4
+
+# Test: Chunked shifting frees a chunk at once and then keeps its cutoff while history fits
+def test_fit_suffix_chunked():
+    counts = [10] * 10
+    prefix = prefix_sums(counts)
+
+    assert fit_suffix_chunked(prefix, 100, 25) == 0
+
+    counts.append(10)
+    cutoff = fit_suffix_chunked(prefix_sums(counts), 100, 25)
+    assert cutoff == 4
+
+    cutoffs = []
+    for _ in range(4):
+        counts.append(10)
+        cutoffs.append(fit_suffix_chunked(prefix_sums(counts), 100, 25, cutoff))
+    assert cutoffs == [4, 4, 4, 8]
+
+    # A recent message bigger than the reduced budget is never shifted out.
+    assert fit_suffix_chunked(prefix_sums([10, 90]), 95, 25) == 1
+
+STRICT_TEMPLATE = (
+    "{% for message in messages %}"
+    "{% if message['role'] == 'system' %}{{ raise_exception('no system') }}{% endif %}"
+    "{% if loop.index0 > 0 and message['role'] == messages[loop.index0 - 1]['role'] %}{{ raise_exception('alternate') }}{% endif %}"
+    "[{{ message['role'] }}] {{ message['content'] }}\n"
+    "{% endfor %}"
+)
+
+# Test: Template capabilities are probed up front
+def test_template_profile_probes_capabilities():
+    profile = TemplateProfile(STRICT_TEMPLATE, {})
+
+    assert profile.supports_system is False
+    assert profile.strict_alternation is True
+    assert profile.needs_normalization([{"role": "system", "content": "a"}, {"role": "user", "content": "b"}])
+    assert not profile.needs_normalization([{"role": "user", "content": "a"}, {"role": "assistant", "content": "b"}])
+
+# Test: Normalization happens on copies and merges repeated roles
+def test_attempt_difficult_chat_template_normalizes_without_mutating():
+    tokenizer = FakeChatTokenizer()
+    tokenizer.chat_template = STRICT_TEMPLATE
+    messages = [
+        {"role": "system", "content": "rules"},
+        {"role": "user", "content": "hi"},
+        {"role": "assistant", "content": "hello"},
+    ]
+
+    rendered = attempt_difficult_chat_template(tokenizer, messages, tokenize=False)
+
+    assert rendered == "[user] rules\n\nhi\n[assistant] hello\n"
+    assert messages[0]["role"] == "system"
+
+PARITY_TEMPLATE = (
+    "{{ bos_token }}{% for message in messages %}<|im_start|>{{ message['role'] }}\n"
+    "{{ message['content'] }}<|im_end|>\n{% endfor %}"
+    "{% if add_generation_prompt %}<|im_start|>assistant\n{% endif %}"
+)
+
+PARITY_CHATS = [
+    [{"role": "user", "content": "Hello there, how are you?"}],
+    [{"role": "system", "content": "You are a pirate."}, {"role": "user", "content": "Ahoy!"}],
+    [{"role": "user", "content": "Tabs\tand\nnewlines,   spaces"}, {"role": "assistant", "content": "Ünïcödé ☃ 日本語"}],
+    [{"role": "user", "content": "Literal <|im_end|> and <s> in content"}],
+    [{"role": "assistant", "content": "First"}, {"role": "assistant", "content": "Second"}],
+]
+
+# Turns end in <|eot_id|> rather than the eos token, and a system turn is injected.
+LLAMA3_TEMPLATE = (
+    "{{ bos_token }}<|start_header_id|>system<|end_header_id|>\n\nHi<|eot_id|>"
+    "{% for message in messages %}<|start_header_id|>{{ message['role'] }}<|end_header_id|>\n\n"
+    "{{ message['content'] }}<|eot_id|>{% endfor %}"
+    "{% if add_generation_prompt %}<|start_header_id|>assistant<|end_header_id|>\n\n{% endif %}"
+)
+
+def save_tokenizer(path, chat_template, bos_token, eos_token, additional_special_tokens):
+    transformers = pytest.importorskip("transformers")
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    corpus = [message["content"] for chat in PARITY_CHATS for message in chat] * 10
+    tokenizer.train_from_iterator(corpus, trainers.BpeTrainer(
+        vocab_size=300,
+        special_tokens=[bos_token, eos_token, *additional_special_tokens],
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+    ))
+
+    fast = transformers.PreTrainedTokenizerFast(tokenizer_object=tokenizer, bos_token=bos_token, eos_token=eos_token, additional_special_tokens=additional_special_tokens)
+    fast.chat_template = chat_template
+    fast.save_pretrained(path)
+    return str(path)
+
+@pytest.fixture
+def parity_tokenizer_dir(tmp_path):
+    return save_tokenizer(tmp_path, PARITY_TEMPLATE, "<s>", "<|im_end|>", ["<|im_start|>"])
+
+@pytest.fixture
+def llama3_tokenizer_dir(tmp_path):
+    return save_tokenizer(
+        tmp_path,
+        LLAMA3_TEMPLATE,
+        "<|begin_of_text|>",
+        "<|end_of_text|>",
+        ["<|start_header_id|>", "<|end_header_id|>", "<|eot_id|>"],
+    )
+
+# Test: The tokenizers backend counts exactly like transformers
+def test_lightweight_tokenizer_matches_transformers(parity_tokenizer_dir):
+    from transformers import AutoTokenizer
+
+    reference = AutoTokenizer.from_pretrained(parity_tokenizer_dir)
+    lightweight = load_lightweight_tokenizer(parity_tokenizer_dir)
+
+    assert len(lightweight) == len(reference)
+    assert lightweight.special_tokens_map == reference.special_tokens_map
+    for chat in PARITY_CHATS:
+        assert attempt_difficult_chat_template(lightweight, chat) == attempt_difficult_chat_template(reference, chat)
+        assert lightweight.apply_chat_template(chat, add_generation_prompt=True) == reference.apply_chat_template(chat, add_generation_prompt=True)
+    assert count_message_tokens_batch(lightweight, [chat[0] for chat in PARITY_CHATS]) == count_message_tokens_batch(reference, [chat[0] for chat in PARITY_CHATS])
+
+# Test: Prompts assembled from per-segment token arrays match encoding the whole prompt
+def test_segmented_prompt_encoding_matches_whole(parity_tokenizer_dir):
+    tokenizer = load_lightweight_tokenizer(parity_tokenizer_dir)
+    pattern = get_segment_pattern(tokenizer)
+    assert pattern is not None
+
+    for chat in PARITY_CHATS:
+        rendered = attempt_difficult_chat_template(tokenizer, chat, tokenize=False, add_generation_prompt=True) + "Bob: "
+        token_ids = []
+        for segment in split_on_special_tokens(rendered, pattern):
+            token_ids.extend(unpack_token_ids(pack_token_ids(tokenizer.encode(segment, add_special_tokens=False))))
+
+        assert token_ids == tokenizer.encode(rendered, add_special_tokens=False)
+
+# Test: Training exports only put loss on assistant turns and the end-of-turn token closing them
+def test_training_loss_mask_covers_assistant_turns(parity_tokenizer_dir):
+    from array import array
+    chat = [{"role": "user", "content": "Ahoy!"}, {"role": "assistant", "content": "Hello there, how are you?"}]
+
+    [(token_ids, loss_mask)] = tokenize_training_chats([chat], parity_tokenizer_dir)
+    tokenizer = tokens.get_tokenizer(parity_tokenizer_dir)
+    tokens.tokenizer_registry.clear()
+    token_ids = array("i", token_ids).tolist()
+
+    assert len(token_ids) == len(loss_mask)
+    assert tokenizer.decode(token_ids) == attempt_difficult_chat_template(tokenizer, chat, tokenize=False)
+    assert tokenizer.decode([token_id for token_id, masked in zip(token_ids, loss_mask) if masked]) == "Hello there, how are you?<|im_end|>"
+
+# Test: Loss masks come from the template, so injected text and other end-of-turn tokens are handled
+def test_training_loss_mask_follows_template(llama3_tokenizer_dir):
+    from array import array
+    chat = [
+        {"role": "assistant", "content": "Hi"},
+        {"role": "user", "content": "Hello there"},
+        {"role": "assistant", "content": "How are you?"},
+    ]
+
+    [(token_ids, loss_mask)] = tokenize_training_chats([chat], llama3_tokenizer_dir)
+    tokenizer = tokens.get_tokenizer(llama3_tokenizer_dir)
+    tokens.tokenizer_registry.clear()
+    masked = [token_id for token_id, masked in zip(array("i", token_ids).tolist(), loss_mask) if masked]
+
+    # The injected system turn also says "Hi"; only the assistant's does counts.
+    assert tokenizer.decode(masked) == "Hi<|eot_id|>How are you?<|eot_id|>"
+
+# Test: Warm-up loads preloaded tokenizers from TOKENIZER_DIR and reports failures without blocking readiness
+def test_warm_up_tokenizers(parity_tokenizer_dir, monkeypatch):
+    tokenizer_dir, model_identifier = parity_tokenizer_dir.rsplit("/", 1)
+    monkeypatch.setattr(tokens, "TOKENIZER_DIR", tokenizer_dir)
+    monkeypatch.setattr(tokenizer_warmup, "TOKENIZER_PRELOAD", f"{model_identifier}, missing-org/missing-model")
+    monkeypatch.setattr(tokenizer_warmup, "warmup_state", tokenizer_warmup.WarmupState())
+
+    asyncio.run(tokenizer_warmup.warm_up_tokenizers())
+    state = tokenizer_warmup.warmup_state.as_dict()
+    tokens.tokenizer_registry.clear()
+
+    assert state["ready"] is True
+    assert state["models"][model_identifier]["status"] == "ready"
+    assert state["models"][model_identifier]["load_time"] >= 0
+    assert state["models"]["missing-org/missing-model"]["status"] == "failed"
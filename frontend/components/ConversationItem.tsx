@@ -1,6 +1,7 @@
 import { useState, useEffect } from 'react';
 import MessageList from './MessageList';
 import apiClient from '../lib/api';
+import { fetchConversationTokenCount } from '../lib/tokenCounts';
 import FormattedText from './FormattedText';
 import { toast } from 'react-toastify';
 import ExpandableTextarea from './ExpandableTextarea';
@@ -47,14 +48,12 @@ const ConversationItem = ({
   useEffect(() => {
     const fetchTagsAndTokens = async () => {
       try {
-        const [tagsResponse, tokenResponse] = await Promise.all([
+        const [tagsResponse, tokenCounts] = await Promise.all([
           apiClient.get(`/conversations/${conversation.id}/tags`),
-          apiClient.get(
-            `/conversations/${conversation.id}/token_count?model_identifier=${modelIdentifier}`
-          ),
+          fetchConversationTokenCount(conversation.id, modelIdentifier),
         ]);
         setTags(tagsResponse.data);
-        setTokenCount(tokenResponse.data.token_count);
+        setTokenCount(tokenCounts.token_count);
         setNeedsTokenRecount(false);
       } catch (_error) {
         toast.error('Error fetching tags or token count.');
@@ -1,5 +1,6 @@
 import { useState, useEffect, useRef } from 'react';
 import apiClient from '../lib/api';
+import { fetchMessageTokenCount } from '../lib/tokenCounts';
 import { toast } from 'react-toastify';
 import {
   extractAndHighlightCodeBlocks,
@@ -61,6 +62,8 @@ const MessageItem = ({
   const [editRejected, setEditRejected] = useState(false);
   const [greetings, setGreetings] = useState([]);
   const [variants, setVariants] = useState<string[]>(['', '']);
+  const [variantsLoaded, setVariantsLoaded] = useState(false);
+  const [generateWhenLoaded, setGenerateWhenLoaded] = useState(false);
   const [currentContentVariantIndex, setCurrentContentVariantIndex] = useState<number>(0);
   const [currentRejectedVariantIndex, setCurrentRejectedVariantIndex] = useState<number>(1);
   const [prevGreeting, setPrevGreeting] = useState({ exists: false, index: 0 });
@@ -124,16 +127,34 @@ const MessageItem = ({
 
       setVariants(localVariants);
     }
+
+    // Message lists leave variants out, so they're fetched when the message is edited.
+    setVariantsLoaded(!!message.variants || !message.variant_count);
   }, [message]);
 
+  useEffect(() => {
+    if (!isEditing || variantsLoaded) {
+      return;
+    }
+
+    apiClient
+      .get(`/messages/${message.id}/variants`)
+      .then((response) => {
+        const { content_variant_index, rejected_variant_index } = response.data;
+        setCurrentContentVariantIndex(content_variant_index ?? OUT_OF_BOUNDS);
+        setCurrentRejectedVariantIndex(rejected_variant_index ?? OUT_OF_BOUNDS);
+        setVariants(response.data.variants);
+        setVariantsLoaded(true);
+      })
+      .catch(() => toast.error('Error fetching message variants.'));
+  }, [isEditing, variantsLoaded]);
+
   useEffect(() => {
     const fetchTokenCount = async () => {
       try {
-        const response = await apiClient.get(`/messages/${message.id}/token_count`, {
-          params: { model_identifier: modelIdentifier },
-        });
-        setTokenCount(response.data.token_count);
-        setRejectedTokenCount(response.data.rejected_token_count);
+        const counts = await fetchMessageTokenCount(message.id, modelIdentifier);
+        setTokenCount(counts.token_count);
+        setRejectedTokenCount(counts.rejected_token_count);
       } catch (_error) {
         toast.error('Error fetching token count for message.');
       }
@@ -227,6 +248,11 @@ const MessageItem = ({
     if (!isEditing) {
       setIsEditing(true);
     }
+    if (!variantsLoaded) {
+      // The new variant is added to the fetched list, so wait for it rather than race it.
+      setGenerateWhenLoaded(true);
+      return;
+    }
     if (!aiGenerating) {
       setAiGenerating(true);
 
@@ -255,11 +281,12 @@ const MessageItem = ({
               authors_note: authorsNote || undefined,
               authors_note_loc: authorsNoteLoc || undefined,
               message_id: message.id,
+              include_token_ids: engine === 'llamacpp' || undefined,
             },
           }
         );
 
-        const { history, eos_token } = response.data;
+        const { history, eos_token, prompt_token_ids } = response.data;
         const eosTokens = [eos_token];
 
         if (character) {
@@ -272,6 +299,7 @@ const MessageItem = ({
 
         generateWithWorker({
           prompt: history,
+          promptTokenIds: prompt_token_ids,
           eosTokens,
           samplers,
           samplerOrder,
@@ -314,6 +342,13 @@ const MessageItem = ({
     }
   };
 
+  useEffect(() => {
+    if (variantsLoaded && generateWhenLoaded) {
+      setGenerateWhenLoaded(false);
+      handleGenerateVariant();
+    }
+  }, [variantsLoaded, generateWhenLoaded]);
+
   const handleScrollLeft = () => {
     if (editRejected) {
       if (currentRejectedVariantIndex === OUT_OF_BOUNDS) {
@@ -356,6 +391,7 @@ const MessageItem = ({
   const handleCancel = () => {
     setIsEditing(false);
     setAiGenerating(false);
+    setGenerateWhenLoaded(false);
     setCurrentContentVariantIndex(
       message.content_variant_index
         ? message.content_variant_index
@@ -539,7 +575,8 @@ const MessageItem = ({
             {!aiGenerating && !alternateGreetings && (
               <button
                 onClick={handleGenerateVariant}
-                className="text-grey-300 hover:text-brightOrange"
+                disabled={isEditing && !variantsLoaded}
+                className={`text-grey-300 ${(!isEditing || variantsLoaded) && 'hover:text-brightOrange'}`}
               >
                 <SparklesIcon className="h-5 w-5" />
               </button>
@@ -563,6 +600,7 @@ const MessageItem = ({
                       disabled={
                         variants.length === 0 ||
                         aiGenerating ||
+                        !variantsLoaded ||
                         (editRejected &&
                           currentRejectedVariantIndex <= 0 &&
                           currentRejectedVariantIndex !== OUT_OF_BOUNDS) ||
@@ -571,15 +609,15 @@ const MessageItem = ({
                           currentContentVariantIndex !== OUT_OF_BOUNDS)
                       }
                       onClick={handleScrollLeft}
-                      className={`text-grey-300 ${!aiGenerating && variants.length > 1 && !(editRejected && currentRejectedVariantIndex <= 0) && !(!editRejected && currentContentVariantIndex <= 0) && 'hover:text-brightOrange'}`}
+                      className={`text-grey-300 ${!aiGenerating && variantsLoaded && variants.length > 1 && !(editRejected && currentRejectedVariantIndex <= 0) && !(!editRejected && currentContentVariantIndex <= 0) && 'hover:text-brightOrange'}`}
                     >
                       <ArrowLeftIcon className="h-5 w-5" />
                     </button>
 
                     <button
-                      disabled={variants.length <= 1 || aiGenerating}
+                      disabled={variants.length <= 1 || aiGenerating || !variantsLoaded}
                       className={
-                        variants.length > 1 && !aiGenerating ? 'hover:text-brightOrange' : ''
+                        variants.length > 1 && !aiGenerating && variantsLoaded ? 'hover:text-brightOrange' : ''
                       }
                       onClick={() => setIsModalOpen(true)}
                     >
@@ -590,6 +628,7 @@ const MessageItem = ({
                       disabled={
                         variants.length === 0 ||
                         aiGenerating ||
+                        !variantsLoaded ||
                         (editRejected &&
                           currentRejectedVariantIndex >= variants.length - 1 &&
                           currentRejectedVariantIndex !== OUT_OF_BOUNDS) ||
@@ -598,7 +637,7 @@ const MessageItem = ({
                           currentContentVariantIndex !== OUT_OF_BOUNDS)
                       }
                       onClick={handleScrollRight}
-                      className={`text-grey-300 ${!aiGenerating && variants.length > 1 && !(editRejected && currentRejectedVariantIndex >= variants.length - 1) && !(!editRejected && currentContentVariantIndex >= variants.length - 1) && 'hover:text-brightOrange'}`}
+                      className={`text-grey-300 ${!aiGenerating && variantsLoaded && variants.length > 1 && !(editRejected && currentRejectedVariantIndex >= variants.length - 1) && !(!editRejected && currentContentVariantIndex >= variants.length - 1) && 'hover:text-brightOrange'}`}
                     >
                       <ArrowRightIcon className="h-5 w-5" />
                     </button>
@@ -698,7 +737,7 @@ const MessageItem = ({
         {isEditing ? (
           <div
             ref={contentRef}
-            contentEditable={!aiGenerating}
+            contentEditable={!aiGenerating && variantsLoaded}
             suppressContentEditableWarning={true}
             className="text-gray-300 mt-2 w-10/12 h-full outline-none flex-grow"
             style={{ whiteSpace: 'pre-wrap' }}
@@ -760,8 +799,8 @@ const MessageItem = ({
             </button>
             <button
               onClick={handleSave}
-              disabled={aiGenerating}
-              className={`px-4 py-2 bg-fadedGreen text-white rounded ${!aiGenerating && 'hover:bg-brightGreen'}`}
+              disabled={aiGenerating || !variantsLoaded}
+              className={`px-4 py-2 bg-fadedGreen text-white rounded ${!aiGenerating && variantsLoaded && 'hover:bg-brightGreen'}`}
             >
               Save
             </button>
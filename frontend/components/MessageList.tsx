@@ -11,6 +11,19 @@ import { useSelector } from 'react-redux';
 import { RootState } from '../context/store';
 import useAiWorker from '../hooks/useAiWorker';
 
+const MESSAGE_PAGE_SIZE = 100;
+
+const withSlopHighlights = (messages: any[]) =>
+  messages.map((message) => {
+    const { highlightedText, count } = highlightSlop(message.content || '');
+
+    return {
+      ...message,
+      highlightedText: highlightedText,
+      slopCount: count,
+    };
+  });
+
 const MessageList = ({
   conversationId,
   modelIdentifier,
@@ -32,6 +45,9 @@ const MessageList = ({
 }) => {
   const [messages, setMessages] = useState<any[]>([]);
   const [isLoading, setIsLoading] = useState(true);
+  const [hasOlderMessages, setHasOlderMessages] = useState(false);
+  const [isLoadingOlder, setIsLoadingOlder] = useState(false);
+  const keepScrollRef = useRef(false);
   const [isAddingMessage, setIsAddingMessage] = useState(false);
   const [mostRecentMessage, setMostRecentMessage] = useState<any | null>(null);
   const [warnings, setWarnings] = useState<string[]>([]); // State to store warnings
@@ -72,6 +88,12 @@ const MessageList = ({
   };
 
   useEffect(() => {
+    if (keepScrollRef.current) {
+      // Older messages were added above what the user is reading.
+      keepScrollRef.current = false;
+      return;
+    }
+
     if (messages) {
       // Scroll to bottom after 200ms. This gives messages time to render on a re-fetch.
       setTimeout(scrollToBottom, 200);
@@ -153,23 +175,17 @@ const MessageList = ({
     return () => window.removeEventListener('keydown', handleKeyPress);
   }, [isAddingMessage, editingId, messages, isGeneratingMessage, expanded, rpMode]);
 
-  // Fetch messages for the conversation
+  // Fetch the latest messages for the conversation
   const fetchMessages = async () => {
     setIsLoading(true);
     try {
-      const response = await apiClient.get(`/conversations/${conversationId}/messages`);
-      const sortedMessages = response.data.sort((a: any, b: any) => a.order - b.order);
-      const messagesWithSlopEnhancement = sortedMessages.map((message) => {
-        const { highlightedText, count } = highlightSlop(message.content || '');
-
-        return {
-          ...message,
-          highlightedText: highlightedText,
-          slopCount: count,
-        };
+      const response = await apiClient.get(`/conversations/${conversationId}/messages`, {
+        params: { limit: MESSAGE_PAGE_SIZE },
       });
+      const sortedMessages = response.data.messages;
 
-      setMessages(messagesWithSlopEnhancement);
+      setMessages(withSlopHighlights(sortedMessages));
+      setHasOlderMessages(response.data.has_before);
       onMessagesChange(true);
 
       // Get the most recent message (highest 'order') by picking the last item after sorting
@@ -186,6 +202,26 @@ const MessageList = ({
     }
   };
 
+  // Fetch the page of messages before the earliest one loaded
+  const fetchOlderMessages = async () => {
+    setIsLoadingOlder(true);
+    try {
+      const response = await apiClient.get(`/conversations/${conversationId}/messages`, {
+        params: { limit: MESSAGE_PAGE_SIZE, before: messages[0].order },
+      });
+      const allMessages = [...withSlopHighlights(response.data.messages), ...messages];
+
+      keepScrollRef.current = true;
+      setMessages(allMessages);
+      setHasOlderMessages(response.data.has_before);
+      setWarnings(checkForWarnings(allMessages));
+    } catch (_error) {
+      toast.error('Error fetching messages.');
+    } finally {
+      setIsLoadingOlder(false);
+    }
+  };
+
   // Function to check for warnings
   const checkForWarnings = (messages: any[]) => {
     const warnings: string[] = [];
@@ -314,10 +350,11 @@ const MessageList = ({
       const authorsNoteQs = authorsNote ? `&authors_note=${encodeURIComponent(authorsNote)}` : '';
       const authorsNoteLocQs =
         authorsNote && authorsNoteLoc ? `&authors_note_loc=${authorsNoteLoc}` : '';
+      const tokenIdsQs = engine === 'llamacpp' ? '&include_token_ids=true' : '';
       const response = await apiClient.get(
-        `/conversations/${conversationId}/with_chat_template?model_identifier=${selectedModel}&invert=${invert}&max_length=${samplers['max_tokens']}&max_context=${maxContext}${authorsNoteQs}${authorsNoteLocQs}`
+        `/conversations/${conversationId}/with_chat_template?model_identifier=${selectedModel}&invert=${invert}&max_length=${samplers['max_tokens']}&max_context=${maxContext}${authorsNoteQs}${authorsNoteLocQs}${tokenIdsQs}`
       );
-      const { history, eos_token } = response.data;
+      const { history, eos_token, prompt_token_ids } = response.data;
       const eosTokens = [eos_token];
 
       if (character) {
@@ -331,6 +368,7 @@ const MessageList = ({
       return new Promise((resolve, reject) => {
         generateWithWorker({
           prompt: history,
+          promptTokenIds: prompt_token_ids,
           eosTokens,
           samplers,
           samplerOrder,
@@ -427,7 +465,7 @@ const MessageList = ({
     }
   };
 
-  const accordionTitle = `${warnings.length > 0 ? '⚠️ ' : ''} Messages (${messages.length})`;
+  const accordionTitle = `${warnings.length > 0 ? '⚠️ ' : ''} Messages (${messages.length}${hasOlderMessages ? '+' : ''})`;
 
   return (
     <Accordion title={accordionTitle} isOpen={expanded} onToggle={setExpanded}>
@@ -443,6 +481,18 @@ const MessageList = ({
         </div>
       )}
 
+      {!isLoading && hasOlderMessages && (
+        <div className="mb-4 text-center">
+          <button
+            onClick={fetchOlderMessages}
+            disabled={isLoadingOlder}
+            className="px-4 py-2 bg-dark1 text-white rounded hover:bg-dark2"
+          >
+            {isLoadingOlder ? 'Loading...' : 'Load earlier messages'}
+          </button>
+        </div>
+      )}
+
       {isLoading ? (
         <div>Loading messages...</div>
       ) : messages.length > 0 ? (
@@ -466,6 +516,7 @@ const MessageList = ({
               persona={persona || null}
               alternateGreetings={
                 character &&
+                !hasOlderMessages &&
                 i === 1 &&
                 message.author === 'assistant' &&
                 character.alternate_greetings
@@ -32,6 +32,7 @@ const useAiWorker = () => {
 
   const generateWithWorker = ({
     prompt,
+    promptTokenIds,
     eosTokens,
     samplers,
     samplerOrder,
@@ -60,6 +61,7 @@ const useAiWorker = () => {
     workerRef.current.postMessage({
       type: 'generate',
       prompt,
+      promptTokenIds,
       eosTokens,
       samplers,
       samplerOrder,
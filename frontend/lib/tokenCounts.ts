@@ -0,0 +1,64 @@
+import apiClient from './api';
+
+interface PendingRequest {
+  id: number;
+  resolve: (value: any) => void;
+  reject: (reason?: any) => void;
+}
+
+type BatchKind = 'messages' | 'conversations';
+
+const queues: Record<string, PendingRequest[]> = {};
+
+// Token count requests made in the same tick (e.g. every MessageItem mounting at once)
+// are collected and sent as a single POST /token_counts.
+const flush = async (kind: BatchKind, modelIdentifier: string) => {
+  const queueKey = `${kind}:${modelIdentifier}`;
+  const pending = queues[queueKey] || [];
+  delete queues[queueKey];
+
+  const ids = Array.from(new Set(pending.map((request) => request.id)));
+
+  try {
+    const response = await apiClient.post('/token_counts', {
+      model_identifier: modelIdentifier,
+      message_ids: kind === 'messages' ? ids : [],
+      conversation_ids: kind === 'conversations' ? ids : [],
+    });
+    const results = response.data[kind];
+
+    pending.forEach((request) => {
+      if (results[request.id]) {
+        request.resolve(results[request.id]);
+      } else {
+        request.reject(new Error(`No token count returned for ${request.id}`));
+      }
+    });
+  } catch (error) {
+    pending.forEach((request) => request.reject(error));
+  }
+};
+
+const enqueue = (kind: BatchKind, id: number, modelIdentifier: string): Promise<any> => {
+  const queueKey = `${kind}:${modelIdentifier}`;
+
+  return new Promise((resolve, reject) => {
+    if (!queues[queueKey]) {
+      queues[queueKey] = [];
+      setTimeout(() => flush(kind, modelIdentifier), 0);
+    }
+
+    queues[queueKey].push({ id, resolve, reject });
+  });
+};
+
+export const fetchMessageTokenCount = (
+  messageId: number,
+  modelIdentifier: string
+): Promise<{ token_count: number; rejected_token_count: number }> =>
+  enqueue('messages', messageId, modelIdentifier);
+
+export const fetchConversationTokenCount = (
+  conversationId: number,
+  modelIdentifier: string
+): Promise<{ token_count: number }> => enqueue('conversations', conversationId, modelIdentifier);
@@ -1,4 +1,4 @@
-import { useEffect, useState } from 'react';
+import { useState } from 'react';
 import Layout from '../components/Layout';
 import apiClient from '../lib/api';
 import { DownloadIcon } from '@heroicons/react/outline';
@@ -6,33 +6,21 @@ import { toast } from 'react-toastify';
 
 export default function ImportExport() {
   const [loading, setLoading] = useState(false);
-  const [conversations, setConversations] = useState([]);
-
-  const fetchConversations = async () => {
-    setLoading(true);
-    try {
-      const response = await apiClient.get('/conversations');
-      const sortedConversations = response.data.sort((a: any, b: any) => b.id - a.id); // Newest first
-      setConversations(sortedConversations);
-    } catch (_error) {
-      toast.error('Failed loading conversations.');
-    } finally {
-      setLoading(false);
-    }
-  };
+  const [exportFormat, setExportFormat] = useState('sharegpt');
+  const [gzip, setGzip] = useState(false);
 
   const exportAsJsonl = async (includeAllConversations: boolean) => {
     setLoading(true);
     try {
-      // Extract conversation IDs
-      const conversationIds = includeAllConversations
-        ? conversations.map((conversation: any) => conversation.id)
-        : []; // Modify to allow specific conversations if needed
+      // Select conversations
+      const selection = includeAllConversations
+        ? { all: true }
+        : { conversation_ids: [] }; // Modify to allow specific conversations if needed
 
-      // Call the backend API with POST request to export JSONL
+      // Call the backend API with POST request to export JSONL, gzipped if asked
       const response = await apiClient.post(
         '/conversations_jsonl',
-        { conversation_ids: conversationIds },
+        { ...selection, format: exportFormat, gzip },
         {
           responseType: 'blob', // Get the response as a Blob to handle the file
         }
@@ -40,11 +28,14 @@ export default function ImportExport() {
 
       // Create a link element to trigger the download
       const url = window.URL.createObjectURL(
-        new Blob([response.data], { type: 'application/jsonlines' })
+        new Blob([response.data], { type: gzip ? 'application/gzip' : 'application/jsonlines' })
       );
       const link = document.createElement('a');
       link.href = url;
-      link.setAttribute('download', 'conversations.jsonl'); // Set the default file name
+      link.setAttribute(
+        'download',
+        `${exportFormat === 'sharegpt' ? 'conversations' : exportFormat}.jsonl${gzip ? '.gz' : ''}`
+      ); // Set the default file name
       document.body.appendChild(link);
       link.click(); // Programmatically click the link to trigger the download
       document.body.removeChild(link);
@@ -55,22 +46,48 @@ export default function ImportExport() {
     }
   };
 
-  useEffect(() => {
-    fetchConversations();
-  }, []);
-
   return (
     <Layout>
       <div className="container mx-auto p-4">
         <div className="flex justify-between items-center mb-4">
           <h1 className="text-2xl font-bold">Import / Export</h1>
-          <button
-            className="bg-fadedYellow text-white px-4 py-2 rounded hover:bg-brightYellow"
-            onClick={() => exportAsJsonl(true)}
-            disabled={loading}
-          >
-            <DownloadIcon className="h-6 w-6" />
-          </button>
+          <div className="flex items-center gap-2">
+            <select
+              className="p-2 bg-dark1 text-white rounded"
+              value={exportFormat}
+              onChange={(e) => setExportFormat(e.target.value)}
+              disabled={loading}
+            >
+              <option value="sharegpt">ShareGPT</option>
+              <option value="dpo">DPO (prompt/chosen/rejected)</option>
+              <option value="orpo">ORPO (chosen/rejected conversations)</option>
+            </select>
+            <label className="flex items-center space-x-2">
+              <div className="relative inline-block w-12 h-5 mt-1">
+                <input
+                  type="checkbox"
+                  checked={gzip}
+                  onChange={() => setGzip(!gzip)}
+                  disabled={loading}
+                  className="toggle-checkbox absolute opacity-0 w-0 h-0"
+                />
+                <span
+                  className={`toggle-label block w-full h-full rounded-full cursor-pointer transition-colors duration-300 ${gzip ? 'bg-fadedGreen' : 'bg-fadedRed'}`}
+                ></span>
+                <span
+                  className={`toggle-indicator absolute top-0 left-0 w-5 h-5 rounded-full bg-white border-4 transform transition-transform duration-300 ${gzip ? 'translate-x-8' : 'translate-x-0'}`}
+                ></span>
+              </div>
+              <div>Gzip</div>
+            </label>
+            <button
+              className="bg-fadedYellow text-white px-4 py-2 rounded hover:bg-brightYellow"
+              onClick={() => exportAsJsonl(true)}
+              disabled={loading}
+            >
+              <DownloadIcon className="h-6 w-6" />
+            </button>
+          </div>
         </div>
       </div>
     </Layout>
@@ -9,8 +9,12 @@ import { toast } from 'react-toastify';
 import FilterBox from '../components/FilterBox';
 import { PlusIcon } from '@heroicons/react/outline';
 
+const PAGE_SIZE = 50;
+
 const Conversations = () => {
   const [conversations, setConversations] = useState<any[]>([]);
+  const [nextCursor, setNextCursor] = useState<string | null>(null);
+  const [totalEstimate, setTotalEstimate] = useState<number | null>(null);
   const [isAdding, setIsAdding] = useState(false);
   const [expandedConversationId, setExpandedConversationId] = useState(null);
   const [filters, setFilters] = useState({
@@ -26,9 +30,14 @@ const Conversations = () => {
     fetchConversations(filters);
   }, [filters]);
 
-  const fetchConversations = async (filters: any) => {
+  const fetchConversations = async (filters: any, cursor: string | null = null) => {
     try {
-      let url = '/conversations?';
+      let url = `/conversations?limit=${PAGE_SIZE}&`;
+      if (cursor) {
+        url += `cursor=${encodeURIComponent(cursor)}&`;
+      } else {
+        url += 'include_total=true&';
+      }
       if (filters.tags.length > 0) {
         filters.tags.forEach((tag: any) => {
           url += `tags=${encodeURIComponent(tag.name)}&`;
@@ -52,7 +61,12 @@ const Conversations = () => {
 
       // Make the API call
       const response = await apiClient.get(url);
-      setConversations(response.data);
+      const page = response.data.conversations;
+      setConversations((previous) => (cursor ? [...previous, ...page] : page));
+      setNextCursor(response.data.next_cursor);
+      if (!cursor) {
+        setTotalEstimate(response.data.total_estimate);
+      }
     } catch (_error) {
       toast.error('Error fetching conversations.');
     }
@@ -122,6 +136,17 @@ const Conversations = () => {
             }
           />
         ))}
+        {nextCursor && (
+          <div className="flex justify-center mt-4">
+            <button
+              className="bg-dark1 text-white px-4 py-2 rounded hover:bg-dark2"
+              onClick={() => fetchConversations(filters, nextCursor)}
+            >
+              Load more
+              {totalEstimate !== null && ` (${conversations.length} of ~${totalEstimate})`}
+            </button>
+          </div>
+        )}
       </div>
     </Layout>
   );
@@ -1,7 +1,7 @@
 let abortController;
 
 self.onmessage = async (e) => {
-  const { type, prompt, eosTokens, samplers, samplerOrder, llmUrl, maxContext } = e.data;
+  const { type, prompt, promptTokenIds, eosTokens, samplers, samplerOrder, llmUrl, maxContext } = e.data;
 
   if (type === 'abort') {
     if (abortController) {
@@ -24,7 +24,8 @@ self.onmessage = async (e) => {
       let lastFinishReason = '';
 
       const promptData = {
-        prompt,
+        // llama.cpp takes the prompt as token IDs too, which saves it re-tokenizing.
+        prompt: promptTokenIds || prompt,
         temperature: samplers['temperature'],
         min_p: samplers['min_p'],
         top_p: samplers['top_p'],